@@ -21,6 +21,7 @@ from buildfarm import (
     BuildFarm,
     hostdb,
     )
+from buildfarm.sqldb import schema_version
 import commands
 import os
 import smtplib
@@ -28,8 +29,6 @@ import sys
 import time
 from email.MIMEText import MIMEText
 
-buildfarm = BuildFarm()
-
 def update_rsyncd_secrets():
     temp_rsyncd_secrets = os.path.join(os.path.dirname(__file__), "../rsyncd.secrets.new")
     f = open(temp_rsyncd_secrets, "w")
@@ -49,6 +48,7 @@ try:
     op = args.pop(0)
 except IndexError:
     print "Initialize the buildfarm:       init"
+    print "Upgrade the database schema:    migrate"
     print "Add Machine to build farm:      add"
     print "Remove Machine from build farm: remove"
     print "Modify build farm account:      modify"
@@ -60,8 +60,17 @@ except IndexError:
     if op == "":
         op = "add"
 
+# Only init and migrate change the database schema; all other operations
+# require it to be up to date.
+buildfarm = BuildFarm(upgrade=(op in ("init", "migrate")))
+
 if op == "init":
     buildfarm.commit()
+elif op == "migrate":
+    for name in buildfarm.applied_upgrades:
+        print "Applied %s" % name
+    buildfarm.commit()
+    print "Database schema is at version %d" % schema_version(buildfarm.store)
 elif op == "remove":
     if not args:
         args = [raw_input("Please enter hostname to delete: ")]
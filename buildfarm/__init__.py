@@ -17,8 +17,22 @@
 #   along with this program; if not, write to the Free Software
 #   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
-from buildfarm.build import BuildStatus
-from buildfarm.sqldb import distinct_builds, Cast, StormBuild, setup_schema, StormHostDatabase
+from buildfarm.build import (
+    BuildStatus,
+    TEST_FAILURES,
+    TEST_SUCCESS,
+    bump_data_generation,
+    )
+from buildfarm.sqldb import (
+    SchemaOutOfDate,
+    StormBuild,
+    StormHostDatabase,
+    StormLatestBuild,
+    StormTest,
+    StormTestResult,
+    check_schema,
+    setup_schema,
+    )
 from buildfarm.tree import Tree
 from storm.database import create_database
 from storm.expr import Desc
@@ -28,17 +42,18 @@ import ConfigParser
 import os
 import re
 
-def read_trees_from_conf(path):
+def read_trees_from_conf(path, history_dir=None):
     """Read trees from a configuration file.
 
     :param path: tree path
+    :param history_dir: Directory for the commit indexes of the trees
     :return: Dictionary with trees
     """
     ret = {}
     cfp = ConfigParser.ConfigParser()
     cfp.read(path)
     for s in cfp.sections():
-        ret[s] = Tree(name=s, **dict(cfp.items(s)))
+        ret[s] = Tree(name=s, history_dir=history_dir, **dict(cfp.items(s)))
     return ret
 
 
@@ -57,21 +72,45 @@ class BuildFarm(object):
     OLDAGE = 60*60*4,
     DEADAGE = 60*60*24*4
 
-    def __init__(self, path=None, store=None, timeout=0.5):
+    # SQLite settings for connections that can write. The journal mode is
+    # stored in the database file, so read-only connections use it too.
+    # In WAL mode readers don't block on the writer, and synchronous=NORMAL
+    # only syncs at checkpoints.
+    JOURNAL_MODE = "WAL"
+    SYNCHRONOUS = "NORMAL"
+    # Page cache size, in kB.
+    CACHE_SIZE = 20000
+
+    def __init__(self, path=None, store=None, timeout=0.5, upgrade=True,
+                 readonly=False):
+        """Open the build farm.
+
+        :param path: Base directory of the build farm
+        :param store: Storm store to use, if already open
+        :param timeout: Timeout for database locks, in seconds
+        :param upgrade: Whether to create or upgrade the database schema if
+            necessary. If False, an out of date schema raises
+            `SchemaOutOfDate` instead.
+        :param readonly: Whether to open the database read-only. This
+            implies upgrade=False.
+        """
         self.timeout = timeout
         self.store = store
+        self.readonly = readonly
+        self.upgrade = upgrade and not readonly
+        self.applied_upgrades = []
         if path is None:
             path = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
         self.path = path
         self.webdir = os.path.join(self.path, "web")
         if not os.path.isdir(path):
             raise Exception("web directory %s does not exist" % self.webdir)
-        self.trees = read_trees_from_conf(os.path.join(self.webdir, "trees.conf"))
+        self._load_config()
         self.builds = self._open_build_results()
         self.upload_builds = self._open_upload_build_results()
         self.hostdb = self._open_hostdb()
-        self.compilers = self._load_compilers()
         self.lcovdir = os.path.join(self.path, "lcov/data")
+        self.fragments = self._open_fragment_cache()
 
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.path)
@@ -86,6 +125,11 @@ class BuildFarm(object):
         path = os.path.join(self.path, "data", "upload")
         return UploadBuildResultStore(path)
 
+    def _open_fragment_cache(self):
+        from buildfarm.build import LogFragmentCache
+        path = os.path.join(self.path, "cache", "fragments")
+        return LogFragmentCache(path)
+
     def _open_hostdb(self):
         return StormHostDatabase(self._get_store())
 
@@ -93,10 +137,96 @@ class BuildFarm(object):
         from buildfarm import util
         return set(util.load_list(os.path.join(self.webdir, "compilers.list")))
 
+    def _config_stamp(self):
+        ret = []
+        for name in ["trees.conf", "compilers.list"]:
+            try:
+                st = os.stat(os.path.join(self.webdir, name))
+            except OSError:
+                ret.append(None)
+            else:
+                ret.append((st.st_mtime, st.st_size))
+        return ret
+
+    def _load_config(self):
+        self._config_loaded = self._config_stamp()
+        self.trees = read_trees_from_conf(os.path.join(self.webdir, "trees.conf"),
+            os.path.join(self.path, "cache", "history"))
+        self.compilers = self._load_compilers()
+
+    def reload_config(self):
+        """Reload the trees and compilers if their configuration files have
+        changed.
+
+        :return: Whether the configuration was reloaded
+        """
+        if self._config_stamp() == self._config_loaded:
+            return False
+        self._load_config()
+        return True
+
+    def config_stamp(self):
+        """Return a stamp of the loaded configuration.
+
+        This changes whenever a changed configuration is loaded.
+        """
+        return self._config_loaded
+
     def commit(self):
         if self.store is not None:
             self.store.commit()
 
+    def rollback(self):
+        if self.store is not None:
+            self.store.rollback()
+
+    def data_generation(self):
+        """Return the data generation.
+
+        This changes whenever builds are imported, so anything derived from
+        the database can be cached as long as the generation stays the same.
+        """
+        (generation, ) = self._get_store().execute(
+            "SELECT generation FROM data_generation WHERE id = 1").get_one()
+        return generation
+
+    def bump_data_generation(self):
+        """Mark the data as changed.
+
+        This should be called in the same transaction as the change.
+        """
+        bump_data_generation(self._get_store())
+
+    def prune_analysis_cache(self):
+        """Remove cached data for builds whose logs no longer exist.
+
+        :return: Number of builds for which cached data was removed
+        """
+        from buildfarm.build import StormBuildAnalysis, open_opt_compressed_file
+        store = self._get_store()
+        stale = set()
+        for (checksum, basename) in store.execute("""
+SELECT build_analysis.checksum, build.basename
+FROM build_analysis LEFT JOIN build ON build.checksum = build_analysis.checksum
+"""):
+            if basename is not None:
+                try:
+                    open_opt_compressed_file(str(basename) + ".log").close()
+                except IOError:
+                    pass
+                else:
+                    continue
+            stale.add(str(checksum))
+        for checksum in stale:
+            store.find(StormBuildAnalysis,
+                StormBuildAnalysis.checksum == checksum).remove()
+        known = set([str(c) for (c,) in store.execute(
+            "SELECT checksum FROM build_analysis")])
+        for checksum in self.fragments.checksums() - known:
+            self.fragments.remove(checksum)
+            stale.add(checksum)
+        return len(stale)
+
     def lcov_status(self, tree):
         """get status of build"""
         from buildfarm.build import NoSuchBuildError
@@ -140,9 +270,13 @@ class BuildFarm(object):
                 build.host in hostnames):
                 yield build
 
+    def _get_latest_builds(self, *args):
+        result = self._get_store().find(StormBuild,
+            StormBuild.id == StormLatestBuild.build_id, *args)
+        return result.order_by(Desc(StormBuild.upload_time))
+
     def get_last_builds(self):
-        result = self._get_store().find(StormBuild)
-        return distinct_builds(result.order_by(Desc(StormBuild.upload_time)))
+        return self._get_latest_builds()
 
     def get_summary_builds(self, min_age=0):
         """Return last build age, status for each tree/host/compiler.
@@ -153,35 +287,89 @@ class BuildFarm(object):
         store = self._get_store()
         return ((tree, BuildStatus.__deserialize__(status_str))
                 for (tree, status_str) in store.execute("""
-SELECT obd.tree, obd.status AS status_str
-FROM build obd
-INNER JOIN(
-    SELECT MAX(age) age, tree, host, compiler
-    FROM build
-    WHERE age > ?
-    GROUP BY tree, host, compiler
-) ibd ON obd.age = ibd.age AND
-         obd.tree = ibd.tree AND
-         obd.host = ibd.host AND
-         obd.compiler = ibd.compiler;
+SELECT build.tree, build.status AS status_str
+FROM latest_build
+INNER JOIN build ON build.id = latest_build.build
+WHERE latest_build.age > ?;
 """, (min_age, )))
 
+    def get_summary_counts(self, min_age=0):
+        """Return the number of builds, broken builds and panics for each
+        tree, looking only at the last build for each tree/host/compiler.
+
+        :param min_age: Minimum timestamp of builds to report
+        :return: iterator over tree, total, broken, panic
+        """
+        store = self._get_store()
+        return store.execute("""
+SELECT latest_build.tree, COUNT(*), ifnull(SUM(build.failed), 0),
+       ifnull(SUM(build.panic), 0)
+FROM latest_build
+INNER JOIN build ON build.id = latest_build.build
+WHERE latest_build.age > ?
+GROUP BY latest_build.tree;
+""", (min_age, ))
+
     def get_tree_builds(self, tree):
-        result = self._get_store().find(StormBuild,
-            Cast(StormBuild.tree, "TEXT") == Cast(tree, "TEXT"))
-        return distinct_builds(result.order_by(Desc(StormBuild.upload_time)))
+        return self._get_latest_builds(StormLatestBuild.tree == tree)
 
     def host_last_build(self, host):
         return max([build.upload_time for build in self.get_host_builds(host)])
 
     def get_host_builds(self, host):
-        result = self._get_store().find(StormBuild, StormBuild.host == host)
-        return distinct_builds(result.order_by(Desc(StormBuild.upload_time)))
+        return self._get_latest_builds(StormLatestBuild.host == host)
 
     def latest_tree_builds(self, tree):
         store = self._get_store()
         return store.find(StormBuild, StormBuild.tree == tree).order_by(Desc(StormBuild.upload_time))
 
+    def failed_tree_builds(self, tree):
+        store = self._get_store()
+        return store.find(StormBuild, StormBuild.tree == tree,
+            StormBuild.failed == True).order_by(Desc(StormBuild.upload_time))
+
+    def get_test_results(self, test, limit=20):
+        """Return the most recently imported results for a test, across all
+        trees and hosts.
+
+        :param test: Name of the test
+        :param limit: Maximum number of results to return
+        :return: list of (build, result) tuples
+        """
+        store = self._get_store()
+        result = store.find((StormBuild, StormTestResult),
+            StormTestResult.build_id == StormBuild.id,
+            StormTestResult.test_id == StormTest.id,
+            StormTest.name == test)
+        result = result.order_by(Desc(StormTestResult.build_id))
+        return [(build, test_result.result) for (build, test_result) in result[:limit]]
+
+    def get_flaky_tests(self, tree, min_age=0):
+        """Find tests that both succeeded and failed for the same revision
+        of a tree.
+
+        :param tree: Name of the tree
+        :param min_age: Minimum timestamp of builds to look at
+        :return: iterator over test name, number of revisions on which the
+            test both succeeded and failed, most flaky tests first
+        """
+        store = self._get_store()
+        return store.execute("""
+SELECT test.name, COUNT(*) AS revisions
+FROM (
+    SELECT test_result.test AS test
+    FROM build
+    INNER JOIN test_result ON test_result.build = build.id
+    WHERE build.tree = ? AND build.age > ?
+    GROUP BY test_result.test, build.revision
+    HAVING SUM(test_result.result = %d) > 0 AND
+           SUM(test_result.result IN (%s)) > 0
+) flaky
+INNER JOIN test ON test.id = flaky.test
+GROUP BY flaky.test
+ORDER BY revisions DESC, test.name;
+""" % (TEST_SUCCESS, ", ".join(map(str, TEST_FAILURES))), (tree, min_age))
+
     def _get_store(self):
         if self.store is not None:
             return self.store
@@ -189,12 +377,27 @@ INNER JOIN(
         if not os.path.isdir(db_dir_path):
             os.mkdir(db_dir_path)
         db_path = os.path.join(db_dir_path, "hostdb.sqlite")
-        db = create_database("sqlite:%s?timeout=%f" % (db_path, self.timeout))
+        if self.readonly:
+            db = create_database("sqlite:%s?timeout=%f" % (db_path, self.timeout))
+        else:
+            db = create_database("sqlite:%s?timeout=%f&journal_mode=%s&synchronous=%s" % (
+                db_path, self.timeout, self.JOURNAL_MODE, self.SYNCHRONOUS))
         self.store = Store(db)
-        setup_schema(self.store)
+        self.store.execute("PRAGMA foreign_keys = 1;", noresult=True)
+        self.store.execute("PRAGMA cache_size = -%d;" % self.CACHE_SIZE,
+            noresult=True)
+        if self.readonly:
+            self.store.execute("PRAGMA query_only = 1;", noresult=True)
+        try:
+            check_schema(self.store)
+        except SchemaOutOfDate:
+            if not self.upgrade:
+                raise
+            self.applied_upgrades = setup_schema(self.store)
+            self.store.commit()
         return self.store
 
     def get_revision_builds(self, tree, revision=None):
         return self._get_store().find(StormBuild,
-            Cast(StormBuild.tree, "TEXT") == Cast(tree, "TEXT"),
-            Cast(StormBuild.revision, "TEXT") == Cast(revision, "TEXT"))
+            StormBuild.tree == tree,
+            StormBuild.revision == revision)
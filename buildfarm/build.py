@@ -21,15 +21,16 @@
 #   along with this program; if not, write to the Free Software
 #   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
+import ast
 import bz2
 from cStringIO import StringIO
 import collections
 import hashlib
 import os
 import re
-from storm.locals import Int, RawStr
+from storm.locals import Bool, Desc, Int, RawStr
 from storm.store import Store
-from storm.expr import Desc
+import tempfile
 import time
 
 
@@ -81,6 +82,12 @@ class LogFileMissing(Exception):
 
 class BuildStatus(object):
 
+    # Version of the format written by __serialize__. A serialized status
+    # consists of the version on the first line, followed by a line
+    # "S <result> <name>" per stage and a line "F <failure>" per other
+    # failure.
+    SERIALIZE_VERSION = "1"
+
     def __init__(self, stages=None, other_failures=None):
         if stages is not None:
             self.stages = [BuildStageResult(n, r) for (n, r) in stages]
@@ -97,12 +104,66 @@ class BuildStatus(object):
             return True
         return not all([x.result == 0 for x in self.stages])
 
+    @property
+    def worst_stage(self):
+        """Index of the first stage that failed, or None."""
+        for (i, stage) in enumerate(self.stages):
+            if stage.result != 0:
+                return i
+        return None
+
+    def summary_columns(self):
+        """Return the values of the build columns that are derived from
+        the status.
+
+        :return: Tuple with failed, panic, timeout, disk full and worst
+            stage values
+        """
+        return (self.failed, "panic" in self.other_failures,
+                "timeout" in self.other_failures,
+                "disk full" in self.other_failures, self.worst_stage)
+
     def __serialize__(self):
-        return repr(self)
+        lines = [self.SERIALIZE_VERSION]
+        lines.extend(["S %d %s" % (result, name) for (name, result) in self.stages])
+        lines.extend(["F %s" % failure for failure in sorted(self.other_failures)])
+        return "\n".join(lines)
 
     @classmethod
     def __deserialize__(cls, text):
-        return eval(text)
+        lines = text.split("\n")
+        if lines[0] != cls.SERIALIZE_VERSION:
+            return cls._deserialize_repr(text)
+        ret = cls()
+        for l in lines[1:]:
+            if l[0] == "S":
+                (result, name) = l[2:].split(" ", 1)
+                ret.stages.append(BuildStageResult(name, int(result)))
+            elif l[0] == "F":
+                ret.other_failures.add(l[2:])
+            else:
+                raise ValueError("Invalid line %r in build status" % l)
+        return ret
+
+    re_repr_stage = re.compile(
+        r"BuildStageResult\(name=('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"), result=(-?\d+)L?\)")
+    re_repr_other_failures = re.compile(r"set\((\[.*\])\)\)$")
+
+    @classmethod
+    def _deserialize_repr(cls, text):
+        """Parse a status in the format used by older versions, which
+        stored the repr() of the status."""
+        if not text.startswith(cls.__name__ + "("):
+            raise ValueError("Invalid build status %r" % text)
+        ret = cls()
+        for m in cls.re_repr_stage.finditer(text):
+            ret.stages.append(
+                BuildStageResult(ast.literal_eval(m.group(1)), int(m.group(2))))
+        m = cls.re_repr_other_failures.search(text)
+        if m is None:
+            raise ValueError("Invalid build status %r" % text)
+        ret.other_failures = set(ast.literal_eval(m.group(1)))
+        return ret
 
     def __str__(self):
         if self.other_failures:
@@ -200,71 +261,201 @@ def extract_test_output(f):
     raise NoTestOutput()
 
 
-def build_status_from_logs(log, err):
-    """get status of build"""
-    # FIXME: Perhaps also extract revision here?
+# Values stored in test_result.result, by subunit outcome
+TEST_RESULTS = {
+    "success": 0,
+    "successful": 0,
+    "failure": 1,
+    "fail": 1,
+    "error": 2,
+    "skip": 3,
+    "xfail": 4,
+    "uxsuccess": 5,
+    }
 
-    test_failures = 0
-    test_successes = 0
-    test_seen = 0
-    ret = BuildStatus()
+TEST_SUCCESS = 0
+TEST_SKIP = 3
+TEST_FAILURES = (1, 2, 5)
+
+
+def parse_test_results(f):
+    """Parse the outcomes of the tests in a subunit stream.
+
+    :param f: Iterable over the lines of a (version 1) subunit stream
+    :return: Iterator over (test name, result) tuples, with the results
+        as in `TEST_RESULTS`
+    """
+    in_details = False
+    for l in f:
+        if in_details:
+            if l.rstrip("\n") == "]":
+                in_details = False
+            continue
+        (keyword, sep, name) = l.partition(":")
+        if not sep or keyword not in TEST_RESULTS:
+            continue
+        name = name.strip()
+        if name.endswith("[ multipart"):
+            name = name[:-len("[ multipart")].rstrip()
+            in_details = True
+        elif name.endswith("["):
+            name = name[:-1].rstrip()
+            in_details = True
+        yield (name, TEST_RESULTS[keyword])
+
+
+LogPhase = collections.namedtuple("LogPhase", "name start end")
+
+
+class LogAnalysis(object):
+    """Information extracted from the logs of a build in a single pass.
+
+    The stdout log is only read (and decompressed) once; while doing so
+    the build status, revision, checksum, host details and the byte offsets
+    of the output of each phase are collected.
+    """
 
-    stages = []
     re_status = re.compile("^([A-Z_]+) STATUS:(\s*\d+)$")
-    re_action = re.compile("^ACTION (PASSED|FAILED):\s+test$")
+    re_action = re.compile("^ACTION (PASSED|FAILED):\s+(.*)$")
 
-    for l in log:
+    def __init__(self):
+        self.revision = None
+        self.checksum = None
+        self.status = None
+        self.phases = []
+        self.err_lines = 0
+        self.uname = None
+        self.cflags = None
+        self.config = None
+        self._sha1 = hashlib.sha1()
+        self._offset = 0
+        self._phase = None
+        self._stages = []
+        self._other_failures = set()
+        self._test_failures = 0
+        self._test_successes = 0
+        self._test_seen = False
+
+    def __getstate__(self):
+        # The parser state can't be pickled, and isn't needed anymore once
+        # the analysis has finished.
+        return dict([(k, v) for (k, v) in self.__dict__.iteritems()
+                     if not k.startswith("_")])
+
+    @property
+    def test_output(self):
+        """Offsets of the output of the test phase, or None."""
+        for phase in self.phases:
+            if phase.name == "test":
+                return phase
+        return None
+
+    def feed_log(self, l):
+        start = self._offset
+        self._offset += len(l)
+        self._sha1.update(l)
+        self._track_phase(l, start)
+        if l.startswith("BUILD COMMIT REVISION: "):
+            self.revision = l.split(":", 1)[1].strip()
+        self._track_host_details(l, start)
+        self._track_status(l)
+
+    def _track_host_details(self, l, start):
+        if start == 0:
+            self.uname = l.rstrip("\n")
+        if self.cflags is None and "CFLAGS=" in l:
+            self.cflags = l.split("CFLAGS=", 1)[1].rstrip("\n")
+        if self.config is None and "configure options: " in l:
+            self.config = l.split("configure options: ", 1)[1].rstrip("\n")
+
+    def _track_phase(self, l, start):
+        if l.startswith("Running action "):
+            self._phase = (l[len("Running action "):].strip(), self._offset)
+            return
+        m = self.re_action.match(l)
+        if m and self._phase is not None:
+            (name, phase_start) = self._phase
+            self.phases.append(LogPhase(name, phase_start, start))
+            self._phase = None
+
+    def _track_status(self, l):
         if l.startswith("No space left on device"):
-            ret.other_failures.add("disk full")
-            continue
+            self._other_failures.add("disk full")
+            return
         if "Maximum time expired in timelimit" in l: # Ugh.
-            ret.other_failures.add("timeout")
-            continue
+            self._other_failures.add("timeout")
+            return
         if "maximum runtime exceeded" in l: # Ugh.
-            ret.other_failures.add("timeout")
-            continue
+            self._other_failures.add("timeout")
+            return
         if l.startswith("PANIC:") or l.startswith("INTERNAL ERROR:"):
-            ret.other_failures.add("panic")
-            continue
+            self._other_failures.add("panic")
+            return
         if l.startswith("testsuite-failure: ") or l.startswith("testsuite-error: "):
-            test_failures += 1
-            continue
+            self._test_failures += 1
+            return
         if l.startswith("testsuite-success: "):
-            test_successes += 1
-            continue
-        m = re_status.match(l)
+            self._test_successes += 1
+            return
+        m = self.re_status.match(l)
         if m:
-            stages.append(BuildStageResult(m.group(1), int(m.group(2).strip())))
+            self._stages.append(BuildStageResult(m.group(1), int(m.group(2).strip())))
             if m.group(1) == "TEST":
-                test_seen = 1
-            continue
-        m = re_action.match(l)
-        if m and not test_seen:
+                self._test_seen = True
+            return
+        m = self.re_action.match(l)
+        if m and m.group(2) == "test" and not self._test_seen:
             if m.group(1) == "PASSED":
-                stages.append(BuildStageResult("TEST", 0))
+                self._stages.append(BuildStageResult("TEST", 0))
             else:
-                stages.append(BuildStageResult("TEST", 1))
-            continue
+                self._stages.append(BuildStageResult("TEST", 1))
 
-    # Scan err file for specific errors
-    for l in err:
+    def feed_err(self, l):
+        self.err_lines += 1
+        # Scan err file for specific errors
         if "No space left on device" in l:
-            ret.other_failures.add("disk full")
+            self._other_failures.add("disk full")
+
+    def finish(self):
+        """Finish the analysis, once both logs have been fed."""
+        ret = BuildStatus(other_failures=self._other_failures)
+
+        def map_stage(sr):
+            if sr.name != "TEST":
+                return sr
+            # TEST is special
+            if self._test_successes + self._test_failures == 0:
+                # No granular test output
+                return BuildStageResult("TEST", sr.result)
+            if sr.result == 1 and self._test_failures == 0:
+                ret.other_failures.add("inconsistent test result")
+                return BuildStageResult("TEST", -1)
+            return BuildStageResult("TEST", self._test_failures)
+
+        ret.stages = map(map_stage, self._stages)
+        self.status = ret
+        self.checksum = self._sha1.hexdigest()
+
+
+def analyse_logs(log, err):
+    """Analyse the stdout and stderr logs of a build.
+
+    :param log: Iterator over the lines in the stdout log
+    :param err: Iterator over the lines in the stderr log
+    :return: A `LogAnalysis`
+    """
+    analysis = LogAnalysis()
+    for l in log:
+        analysis.feed_log(l)
+    for l in err:
+        analysis.feed_err(l)
+    analysis.finish()
+    return analysis
 
-    def map_stage(sr):
-        if sr.name != "TEST":
-            return sr
-        # TEST is special
-        if test_successes + test_failures == 0:
-            # No granular test output
-            return BuildStageResult("TEST", sr.result)
-        if sr.result == 1 and test_failures == 0:
-            ret.other_failures.add("inconsistent test result")
-            return BuildStageResult("TEST", -1)
-        return BuildStageResult("TEST", test_failures)
 
-    ret.stages = map(map_stage, stages)
-    return ret
+def build_status_from_logs(log, err):
+    """get status of build"""
+    return analyse_logs(log, err).status
 
 
 def revision_from_log(log):
@@ -301,6 +492,7 @@ class Build(object):
         self.host = host
         self.compiler = compiler
         self.revision = rev
+        self._analysis = None
 
     def __cmp__(self, other):
         return cmp(
@@ -338,9 +530,49 @@ class Build(object):
         """get the age of build"""
         return time.time() - self.upload_time
 
+    def cached_analysis(self):
+        """Return the analysis of this build, if it is available without
+        reading the logs.
+
+        :return: A `LogAnalysis`, or None
+        """
+        return getattr(self, "_analysis", None)
+
+    def analyse(self):
+        """Analyse the logs of this build.
+
+        The logs are only read once; later calls return the same analysis.
+
+        :return: A `LogAnalysis`
+        """
+        analysis = self.cached_analysis()
+        if analysis is None:
+            log = self.read_log()
+            try:
+                err = self.read_err()
+                try:
+                    analysis = analyse_logs(log, err)
+                finally:
+                    err.close()
+            finally:
+                log.close()
+            self._analysis = analysis
+        return analysis
+
     def read_subunit(self):
         """read the test output as subunit"""
-        return StringIO("".join(extract_test_output(self.read_log())))
+        analysis = self.cached_analysis()
+        f = self.read_log()
+        try:
+            if analysis is None:
+                return StringIO("".join(extract_test_output(f)))
+            test_output = analysis.test_output
+            if test_output is None:
+                raise NoTestOutput()
+            f.seek(test_output.start)
+            return StringIO(f.read(test_output.end - test_output.start))
+        finally:
+            f.close()
 
     def read_log(self):
         """read full log file"""
@@ -367,47 +599,42 @@ class Build(object):
             return StringIO()
 
     def log_checksum(self):
-        f = self.read_log()
-        try:
-            return hashlib.sha1(f.read()).hexdigest()
-        finally:
-            f.close()
+        return self.analyse().checksum
 
     def summary(self):
-        revid = self.revision_details()
-        status = self.status()
-        return BuildSummary(self.host, self.tree, self.compiler, revid, status)
+        analysis = self.analyse()
+        if analysis.revision is None:
+            raise MissingRevisionInfo(self)
+        return BuildSummary(self.host, self.tree, self.compiler,
+            analysis.revision, analysis.status)
 
     def revision_details(self):
         """get the revision of build
 
         :return: revision id
         """
-        f = self.read_log()
-        try:
-            return revision_from_log(f)
-        finally:
-            f.close()
+        revid = self.analyse().revision
+        if revid is None:
+            raise MissingRevisionInfo(self)
+        return revid
 
     def status(self):
         """get status of build
 
         :return: tuple with build status
         """
-        log = self.read_log()
-        try:
-            err = self.read_err()
-            try:
-                return build_status_from_logs(log, err)
-            finally:
-                err.close()
-        finally:
-            log.close()
+        return self.analyse().status
 
     def err_count(self):
         """get status of build"""
+        analysis = self.cached_analysis()
+        if analysis is not None:
+            return analysis.err_lines
         file = self.read_err()
-        return len(file.readlines())
+        try:
+            return len(file.readlines())
+        finally:
+            file.close()
 
 
 class UploadBuildResultStore(object):
@@ -418,37 +645,159 @@ class UploadBuildResultStore(object):
         :param path: Build result base directory
         """
         self.path = path
+        self._index = None
+        self._hosts = None
+        self._index_mtime = None
 
-    def get_all_builds(self):
+    def _get_index(self):
+        """Return the index of uploaded build logs.
+
+        The index is built in a single pass over the upload directory and
+        is only rebuilt when the directory has changed.
+
+        :return: Dictionary mapping (tree, host, compiler) to the stat
+            result of the build log
+        """
+        mtime = os.stat(self.path).st_mtime
+        if self._index is not None and mtime == self._index_mtime:
+            return self._index
+        index = {}
+        hosts = set()
         for name in os.listdir(self.path):
+            parts = name.split(".")
+            if len(parts) > 2:
+                hosts.add(parts[2])
             try:
-                (build, tree, host, compiler, extension) = name.split(".")
+                (build, tree, host, compiler, extension) = parts
             except ValueError:
                 continue
             if build != "build" or extension != "log":
                 continue
-            yield self.get_build(tree, host, compiler)
+            try:
+                index[(tree, host, compiler)] = os.stat(os.path.join(self.path, name))
+            except OSError:
+                # Removed since the directory was listed
+                continue
+        self._index = index
+        self._hosts = hosts
+        if time.time() - mtime < 2:
+            # The directory may still change without its mtime changing
+            # (timestamps have limited resolution), so don't trust the
+            # index next time.
+            self._index_mtime = None
+        else:
+            self._index_mtime = mtime
+        return index
+
+    def get_all_builds(self):
+        index = self._get_index()
+        keys = sorted(index, key=lambda key: (index[key].st_mtime, key))
+        for (tree, host, compiler) in keys:
+            yield Build(self.build_fname(tree, host, compiler), tree, host, compiler)
 
     def build_fname(self, tree, host, compiler):
         return os.path.join(self.path, "build.%s.%s.%s" % (tree, host, compiler))
 
     def has_host(self, host):
-        for name in os.listdir(self.path):
-            try:
-                if name.split(".")[2] == host:
-                    return True
-            except IndexError:
-                pass
-        return False
+        self._get_index()
+        return host in self._hosts
 
     def get_build(self, tree, host, compiler):
-        basename = self.build_fname(tree, host, compiler)
-        logf = "%s.log" % basename
-        if not os.path.exists(logf):
+        if (tree, host, compiler) not in self._get_index():
             raise NoSuchBuildError(tree, host, compiler)
+        basename = self.build_fname(tree, host, compiler)
         return Build(basename, tree, host, compiler)
 
 
+class LogFragmentCache(object):
+    """On-disk cache of rendered fragments of build logs.
+
+    Entries are keyed by log checksum and written when a build is imported,
+    so that viewing a build doesn't require reprocessing its logs.
+    """
+
+    def __init__(self, path):
+        """Open the cache.
+
+        :param path: Cache directory
+        """
+        self.path = path
+
+    def _fname(self, checksum, name):
+        return os.path.join(self.path, "%s.%s" % (checksum, name))
+
+    def get(self, checksum, name):
+        """Retrieve a fragment.
+
+        :return: Fragment contents, or None if the fragment isn't cached
+        """
+        try:
+            f = open(self._fname(checksum, name), 'r')
+        except IOError:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def open(self, checksum, name):
+        """Open a fragment.
+
+        :return: File object, or None if the fragment isn't cached
+        """
+        try:
+            return open(self._fname(checksum, name), 'r')
+        except IOError:
+            return None
+
+    def put(self, checksum, name, contents):
+        self.put_chunks(checksum, name, [contents])
+
+    def put_chunks(self, checksum, name, chunks):
+        """Store a fragment, written in chunks.
+
+        :param chunks: Iterable over the contents of the fragment
+        """
+        self.publish(checksum, name, self.stage(checksum, name, chunks))
+
+    def stage(self, checksum, name, chunks):
+        """Write a fragment to a temporary file, without storing it yet.
+
+        :param chunks: Iterable over the contents of the fragment
+        :return: Path of the temporary file, to pass to `publish`
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.path,
+            prefix="%s.%s." % (checksum, name), suffix=".new")
+        f = os.fdopen(fd, 'w')
+        try:
+            try:
+                for chunk in chunks:
+                    f.write(chunk)
+            finally:
+                f.close()
+        except:
+            os.remove(tmp_path)
+            raise
+        return tmp_path
+
+    def publish(self, checksum, name, tmp_path):
+        """Store a fragment previously written by `stage`."""
+        os.rename(tmp_path, self._fname(checksum, name))
+
+    def checksums(self):
+        """Return the set of checksums with cached fragments."""
+        if not os.path.isdir(self.path):
+            return set()
+        return set([name.split(".", 1)[0] for name in os.listdir(self.path)])
+
+    def remove(self, checksum):
+        for name in os.listdir(self.path):
+            if name.split(".", 1)[0] == checksum:
+                os.remove(os.path.join(self.path, name))
+
+
 class StormBuild(Build):
     __storm_table__ = "build"
 
@@ -460,6 +809,11 @@ class StormBuild(Build):
     checksum = RawStr()
     upload_time = Int(name="age")
     status_str = RawStr(name="status")
+    failed = Bool()
+    panic = Bool()
+    timeout = Bool()
+    disk_full = Bool()
+    worst_stage = Int()
     basename = RawStr()
     host_id = Int()
     tree_id = Int()
@@ -468,21 +822,131 @@ class StormBuild(Build):
     def status(self):
         return BuildStatus.__deserialize__(self.status_str)
 
+    def set_status(self, status):
+        self.status_str = status.__serialize__()
+        (self.failed, self.panic, self.timeout, self.disk_full,
+         self.worst_stage) = status.summary_columns()
+
     def revision_details(self):
         return self.revision
 
     def log_checksum(self):
         return self.checksum
 
+    def cached_analysis(self):
+        analysis = super(StormBuild, self).cached_analysis()
+        if analysis is None and self.checksum is not None:
+            stored = Store.of(self).get(StormBuildAnalysis, self.checksum)
+            if stored is not None:
+                analysis = stored.to_analysis(self)
+                self._analysis = analysis
+        return analysis
+
     def remove(self):
         super(StormBuild, self).remove()
-        Store.of(self).remove(self)
+        store = Store.of(self)
+        store.find(StormBuildAnalysis,
+            StormBuildAnalysis.checksum == self.checksum).remove()
+        store.execute("DELETE FROM test_result WHERE build = ?", (self.id, ),
+            noresult=True)
+        latest = store.get(StormLatestBuild, (self.tree, self.host, self.compiler))
+        if latest is not None and latest.build_id == self.id:
+            previous = store.find(StormBuild,
+                StormBuild.tree == self.tree,
+                StormBuild.host == self.host,
+                StormBuild.compiler == self.compiler,
+                StormBuild.id != self.id).order_by(
+                    Desc(StormBuild.upload_time), Desc(StormBuild.id)).first()
+            if previous is None:
+                store.remove(latest)
+            else:
+                latest.build_id = previous.id
+                latest.upload_time = previous.upload_time
+            store.flush()
+        store.remove(self)
+        bump_data_generation(store)
 
     def remove_logs(self):
         super(StormBuild, self).remove_logs()
         self.basename = None
 
 
+class StormBuildAnalysis(object):
+    """Data derived from the logs of a build, stored at import time.
+
+    Together with the columns in `StormBuild` this allows recreating
+    the `LogAnalysis` for a build without reading its logs.
+    """
+    __storm_table__ = "build_analysis"
+
+    checksum = RawStr(primary=True)
+    err_lines = Int()
+    phases_str = RawStr(name="phases")
+    uname = RawStr()
+    cflags = RawStr()
+    config = RawStr()
+
+    @classmethod
+    def from_analysis(cls, analysis):
+        ret = cls()
+        ret.checksum = analysis.checksum
+        ret.err_lines = analysis.err_lines
+        ret.phases_str = "".join(["%s %d %d\n" % phase for phase in analysis.phases])
+        ret.uname = analysis.uname
+        ret.cflags = analysis.cflags
+        ret.config = analysis.config
+        return ret
+
+    def to_analysis(self, build):
+        ret = LogAnalysis()
+        ret.checksum = self.checksum
+        ret.revision = build.revision
+        ret.status = build.status()
+        ret.err_lines = self.err_lines
+        for l in self.phases_str.splitlines():
+            (name, start, end) = l.rsplit(" ", 2)
+            ret.phases.append(LogPhase(name, int(start), int(end)))
+        ret.uname = self.uname
+        ret.cflags = self.cflags
+        ret.config = self.config
+        return ret
+
+
+class StormLatestBuild(object):
+    """The most recent build for a tree, host and compiler.
+
+    This is kept up to date by `BuildResultStore.upload_build` and
+    `StormBuild.remove`, so that the current state of the build farm
+    can be retrieved without going through all old builds.
+    """
+    __storm_table__ = "latest_build"
+    __storm_primary__ = ("tree", "host", "compiler")
+
+    tree = RawStr()
+    host = RawStr()
+    compiler = RawStr()
+    build_id = Int(name="build")
+    upload_time = Int(name="age")
+
+    def __init__(self, build):
+        self.tree = build.tree
+        self.host = build.host
+        self.compiler = build.compiler
+        self.build_id = build.id
+        self.upload_time = build.upload_time
+
+
+def bump_data_generation(store):
+    """Mark the data in a store as changed, so that pages rendered from it
+    are no longer served from the page cache.
+
+    This should be called in the same transaction as the change.
+    """
+    store.execute(
+        "UPDATE data_generation SET generation = generation + 1 WHERE id = 1",
+        noresult=True)
+
+
 class BuildResultStore(object):
     """The build farm build result database."""
 
@@ -502,16 +966,15 @@ class BuildResultStore(object):
             return False
 
     def get_build(self, tree, host, compiler, revision=None, checksum=None):
-        from buildfarm.sqldb import Cast
         expr = [
-            Cast(StormBuild.tree, "TEXT") == Cast(tree, "TEXT"),
-            Cast(StormBuild.host, "TEXT") == Cast(host, "TEXT"),
-            Cast(StormBuild.compiler, "TEXT") == Cast(compiler, "TEXT"),
+            StormBuild.tree == tree,
+            StormBuild.host == host,
+            StormBuild.compiler == compiler,
             ]
         if revision is not None:
-            expr.append(Cast(StormBuild.revision, "TEXT") == Cast(revision, "TEXT"))
+            expr.append(StormBuild.revision == revision)
         if checksum is not None:
-            expr.append(Cast(StormBuild.checksum, "TEXT") == Cast(checksum, "TEXT"))
+            expr.append(StormBuild.checksum == checksum)
         result = self.store.find(StormBuild, *expr).order_by(Desc(StormBuild.upload_time))
         ret = result.first()
         if ret is None:
@@ -519,23 +982,72 @@ class BuildResultStore(object):
         return ret
 
     def build_fname(self, tree, host, compiler, rev):
-        """get the name of the build file"""
-        return os.path.join(self.path, "build.%s.%s.%s-%s" % (tree, host, compiler, rev))
+        """get the name of the build file
+
+        Build files are sharded into a directory per tree and host, so
+        that the files for a single build can be found without scanning
+        all old builds.
+        """
+        return os.path.join(self.path, tree, host,
+            "build.%s.%s.%s-%s" % (tree, host, compiler, rev))
 
     def get_all_builds(self):
-        for l in os.listdir(self.path):
-            m = re.match("^build\.([0-9A-Za-z]+)\.([0-9A-Za-z]+)\.([0-9A-Za-z]+)-([0-9A-Fa-f]+).log$", l)
-            if not m:
+        for (dirpath, dirnames, filenames) in os.walk(self.path):
+            for l in filenames:
+                m = re.match("^build\.([0-9A-Za-z]+)\.([0-9A-Za-z]+)\.([0-9A-Za-z]+)-([0-9A-Fa-f]+).log$", l)
+                if not m:
+                    continue
+                tree = m.group(1)
+                host = m.group(2)
+                compiler = m.group(3)
+                rev = m.group(4)
+                stat = os.stat(os.path.join(dirpath, l))
+                # skip the current build
+                if stat.st_nlink == 2:
+                    continue
+                yield self.get_build(tree, host, compiler, rev)
+
+    def shard_old_builds(self):
+        """Move build files from the flat layout into per-tree/host
+        directories, as used by `build_fname`.
+
+        :return: Number of files moved
+        """
+        files = collections.defaultdict(list)
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if not os.path.isfile(path):
+                continue
+            # Strip the extension (.log, .err, optionally compressed)
+            basename = name
+            if basename.endswith(".bz2"):
+                basename = basename[:-len(".bz2")]
+            basename = basename.rsplit(".", 1)[0]
+            # Compilers can contain dots (e.g. gcc-4.1), so only the tree
+            # and host are split off on dots.
+            parts = basename.split(".", 3)
+            if len(parts) != 4 or parts[0] != "build" or "-" not in parts[3]:
                 continue
-            tree = m.group(1)
-            host = m.group(2)
-            compiler = m.group(3)
-            rev = m.group(4)
-            stat = os.stat(os.path.join(self.path, l))
-            # skip the current build
-            if stat.st_nlink == 2:
+            files[basename].append(name)
+        moved = 0
+        for (basename, names) in files.iteritems():
+            (tree, host, rest) = basename.split(".", 3)[1:]
+            (compiler, rev) = rest.rsplit("-", 1)
+            new_basename = self.build_fname(tree, host, compiler, rev)
+            # Only move files that belong to a build, and update the build
+            # before moving them so that it never points at missing files.
+            result = self.store.find(StormBuild,
+                StormBuild.basename == os.path.join(self.path, basename))
+            if result.is_empty():
                 continue
-            yield self.get_build(tree, host, compiler, rev)
+            result.set(basename=new_basename)
+            if not os.path.isdir(os.path.dirname(new_basename)):
+                os.makedirs(os.path.dirname(new_basename))
+            for name in names:
+                os.rename(os.path.join(self.path, name),
+                    os.path.join(os.path.dirname(new_basename), name))
+                moved += 1
+        return moved
 
     def get_old_builds(self, tree, host, compiler):
         result = self.store.find(StormBuild,
@@ -545,9 +1057,10 @@ class BuildResultStore(object):
         return result.order_by(Desc(StormBuild.upload_time))
 
     def upload_build(self, build):
-        from buildfarm.sqldb import Cast, StormHost
+        from buildfarm.sqldb import StormHost
+        analysis = build.analyse()
         try:
-            existing_build = self.get_by_checksum(build.log_checksum())
+            existing_build = self.get_by_checksum(analysis.checksum)
         except NoSuchBuildError:
             pass
         else:
@@ -556,46 +1069,93 @@ class BuildResultStore(object):
             assert build.host == existing_build.host
             assert build.compiler == existing_build.compiler
             return existing_build
-        rev = build.revision_details()
+        rev = analysis.revision
+        if rev is None:
+            raise MissingRevisionInfo(build)
 
         new_basename = self.build_fname(build.tree, build.host, build.compiler, rev)
-        for name in os.listdir(self.path):
-            p = os.path.join(self.path, name)
-            if p.startswith(new_basename+"."):
-                os.remove(p)
+        shard = os.path.dirname(new_basename)
+        if not os.path.isdir(shard):
+            os.makedirs(shard)
+        for ext in (".log", ".err", ".log.bz2", ".err.bz2"):
+            if os.path.exists(new_basename+ext):
+                os.remove(new_basename+ext)
         os.link(build.basename+".log", new_basename+".log")
         if os.path.exists(build.basename+".err"):
             os.link(build.basename+".err", new_basename+".err")
         new_build = StormBuild(new_basename, build.tree, build.host, build.compiler, rev)
-        new_build.checksum = build.log_checksum()
+        new_build.checksum = analysis.checksum
         new_build.upload_time = build.upload_time
-        new_build.status_str = build.status().__serialize__()
+        new_build.set_status(analysis.status)
         new_build.basename = new_basename
-        host = self.store.find(StormHost,
-            Cast(StormHost.name, "TEXT") == Cast(build.host, "TEXT")).one()
+        new_build._analysis = analysis
+        host = self.store.find(StormHost, StormHost.name == build.host).one()
         assert host is not None, "Unable to find host %r" % build.host
         new_build.host_id = host.id
         self.store.add(new_build)
+        if self.store.get(StormBuildAnalysis, analysis.checksum) is None:
+            self.store.add(StormBuildAnalysis.from_analysis(analysis))
+        self.store.flush()
+        latest = self.store.get(StormLatestBuild,
+            (new_build.tree, new_build.host, new_build.compiler))
+        if latest is None:
+            self.store.add(StormLatestBuild(new_build))
+        elif latest.upload_time <= new_build.upload_time:
+            latest.build_id = new_build.id
+            latest.upload_time = new_build.upload_time
+        try:
+            subunit = build.read_subunit()
+        except NoTestOutput:
+            pass
+        else:
+            self.add_test_results(new_build, parse_test_results(subunit))
         return new_build
 
+    def get_test_results(self, build):
+        """Retrieve the stored test results for a build.
+
+        :param build: A `StormBuild`
+        :return: Dictionary mapping test names to results
+        """
+        return dict([(str(name), result) for (name, result) in self.store.execute(
+            "SELECT test.name, test_result.result FROM test_result "
+            "INNER JOIN test ON test.id = test_result.test "
+            "WHERE test_result.build = ?", (build.id, ))])
+
+    def add_test_results(self, build, results):
+        """Store the test results for a build.
+
+        :param build: A `StormBuild`
+        :param results: Iterable over (test name, result) tuples
+        """
+        from buildfarm.sqldb import executemany
+        results = [(buffer(name), result) for (name, result) in results]
+        if not results:
+            return
+        self.store.flush()
+        executemany(self.store, "INSERT OR IGNORE INTO test (name) VALUES (?)",
+            [(name, ) for (name, result) in results])
+        executemany(self.store,
+            "INSERT OR REPLACE INTO test_result (build, test, result) "
+            "SELECT ?, id, ? FROM test WHERE name = ?",
+            [(build.id, result, name) for (name, result) in results])
+
     def get_by_checksum(self, checksum):
-        from buildfarm.sqldb import Cast
         result = self.store.find(StormBuild,
-            Cast(StormBuild.checksum, "TEXT") == Cast(checksum, "TEXT")).order_by(Desc(StormBuild.upload_time))
+            StormBuild.checksum == checksum).order_by(Desc(StormBuild.upload_time))
         ret = result.first()
         if ret is None:
             raise NoSuchBuildError(None, None, None, None)
         return ret
 
     def get_previous_build(self, tree, host, compiler, revision):
-        from buildfarm.sqldb import Cast
         cur_build = self.get_build(tree, host, compiler, revision)
 
         result = self.store.find(StormBuild,
-            Cast(StormBuild.tree, "TEXT") == Cast(tree, "TEXT"),
-            Cast(StormBuild.host, "TEXT") == Cast(host, "TEXT"),
-            Cast(StormBuild.compiler, "TEXT") == Cast(compiler, "TEXT"),
-            Cast(StormBuild.revision, "TEXT") != Cast(revision, "TEXT"),
+            StormBuild.tree == tree,
+            StormBuild.host == host,
+            StormBuild.compiler == compiler,
+            StormBuild.revision != revision,
             StormBuild.id < cur_build.id)
         result = result.order_by(Desc(StormBuild.id))
         prev_build = result.first()
@@ -603,6 +1163,21 @@ class BuildResultStore(object):
             raise NoSuchBuildError(tree, host, compiler, revision)
         return prev_build
 
+    def get_build_history(self, tree, host, compiler, before=None):
+        """Retrieve the builds of a tree on a host with a compiler, most
+        recently imported first.
+
+        :param before: Only include builds imported before this build
+        """
+        expr = [
+            StormBuild.tree == tree,
+            StormBuild.host == host,
+            StormBuild.compiler == compiler,
+            ]
+        if before is not None:
+            expr.append(StormBuild.id < before.id)
+        return self.store.find(StormBuild, *expr).order_by(Desc(StormBuild.id))
+
     def get_latest_build(self, tree, host, compiler):
         result = self.store.find(StormBuild,
             StormBuild.tree == tree,
@@ -615,6 +1190,50 @@ class BuildResultStore(object):
         return build
 
 
+def previous_build(history, build):
+    """Find the build before a build, skipping other builds of its revision.
+
+    :param history: Iterator over the earlier builds, most recent first (as
+        returned by `BuildResultStore.get_build_history`)
+    """
+    for candidate in history:
+        if candidate.revision != build.revision:
+            return candidate
+    raise NoSuchBuildError(build.tree, build.host, build.compiler,
+        build.revision)
+
+
+class TestResultsDiff(object):
+    """The differences in test results between two builds."""
+
+    def __init__(self, old_results, new_results):
+        """Compare two sets of test results.
+
+        :param old_results: Dictionary mapping test names to results (as in
+            `TEST_RESULTS`) for the old build
+        :param new_results: Dictionary with the results for the new build
+        """
+        self.newly_failing = []
+        self.newly_passing = []
+        self.newly_skipped = []
+        for name, new_result in sorted(new_results.iteritems()):
+            old_result = old_results.get(name)
+            if new_result in TEST_FAILURES:
+                if old_result not in TEST_FAILURES:
+                    self.newly_failing.append(name)
+            elif old_result is None:
+                continue
+            elif new_result == TEST_SUCCESS and old_result != TEST_SUCCESS:
+                self.newly_passing.append(name)
+            elif new_result == TEST_SKIP and old_result != TEST_SKIP:
+                self.newly_skipped.append(name)
+        self.removed = sorted(set(old_results) - set(new_results))
+
+    def __nonzero__(self):
+        return bool(self.newly_failing or self.newly_passing or
+                    self.newly_skipped or self.removed)
+
+
 class BuildDiff(object):
     """Represents the difference between two builds."""
 
@@ -632,7 +1251,11 @@ class BuildDiff(object):
         """Is there a regression in new build since old build?"""
         return self.new_status.regressed_since(self.old_status)
 
-    def revisions(self):
-        """Returns the revisions introduced since old in new."""
+    def revisions(self, limit=100):
+        """Returns the revisions introduced since old in new.
+
+        :param limit: Maximum number of revisions to return
+        """
         branch = self.tree.get_branch()
-        return branch.log(from_rev=self.new.revision, exclude_revs=set([self.old.revision]))
+        return branch.log(from_rev=self.new.revision,
+            exclude_revs=set([self.old.revision]), limit=limit)
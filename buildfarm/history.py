@@ -20,10 +20,26 @@
 #   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 from cStringIO import StringIO
+import os
+import re
+import tempfile
+import threading
 
 from dulwich.objects import Tree
 from dulwich.patch import write_tree_diff
 from dulwich.repo import Repo
+from storm.database import create_database
+from storm.store import Store
+
+re_author = re.compile("^(.*) <(.*)>$")
+
+
+def split_author(author):
+    """Split an author or committer into name and email address."""
+    m = re_author.match(author)
+    if m is None:
+        return (author, author)
+    return (m.group(1), m.group(2))
 
 
 class Branch(object):
@@ -49,12 +65,406 @@ class Revision(object):
         self.message = message
 
 
+class GitCommitIndex(object):
+    """Persistent index of the commits on a git branch.
+
+    The index is a SQLite database that is brought up to date by walking
+    from the branch head back to commits that are already indexed. Commits
+    are listed by date; commits with the same date are listed after their
+    descendants.
+    """
+
+    SCHEMA_VERSION = 1
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS head (
+    branch TEXT NOT NULL,
+    id TEXT
+);""",
+        """CREATE TABLE IF NOT EXISTS revision (
+    id TEXT PRIMARY KEY,
+    parents TEXT NOT NULL,
+    commit_time INTEGER NOT NULL,
+    generation INTEGER NOT NULL,
+    author TEXT NOT NULL,
+    author_email TEXT NOT NULL,
+    committer TEXT NOT NULL,
+    message TEXT NOT NULL
+);""",
+        "CREATE INDEX IF NOT EXISTS revision_date ON revision (commit_time, generation);",
+        "CREATE INDEX IF NOT EXISTS revision_author ON revision (author_email, commit_time, generation);",
+        ]
+
+    def __init__(self, path, timeout=5):
+        """Open a commit index, creating it if necessary.
+
+        :param path: Path to the SQLite database
+        :param timeout: Timeout for database locks, in seconds
+        """
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.store = Store(create_database(
+            "sqlite:%s?timeout=%f&journal_mode=WAL&synchronous=NORMAL" % (
+                path, timeout)))
+        version = self.store.execute("PRAGMA user_version;").get_one()[0]
+        if version != self.SCHEMA_VERSION:
+            for statement in self.SCHEMA:
+                self.store.execute(statement, noresult=True)
+            self.store.execute("PRAGMA user_version = %d;" % self.SCHEMA_VERSION,
+                noresult=True)
+        self.store.commit()
+
+    def _head(self, branch):
+        row = self.store.execute("SELECT branch, id FROM head").get_one()
+        if row is None or row[0] != branch:
+            return None
+        return row[1]
+
+    def _generation(self, sha):
+        row = self.store.execute(
+            "SELECT generation FROM revision WHERE id = ?", (sha,)).get_one()
+        if row is None:
+            return None
+        return row[0]
+
+    def _add_commits(self, repo, head, indexed_head):
+        """Add the commits reachable from head that are not indexed yet.
+
+        Parents are added before their children, so that generation numbers
+        can be assigned.
+
+        :return: Whether indexed_head was reached
+        """
+        reached = False
+        generations = {}
+        pending = {}
+        stack = [head]
+        while stack:
+            sha = stack[-1]
+            if sha in generations:
+                stack.pop()
+                continue
+            commit = pending.get(sha)
+            if commit is None:
+                generation = self._generation(sha)
+                if generation is not None:
+                    generations[sha] = generation
+                    reached = reached or (sha == indexed_head)
+                    stack.pop()
+                    continue
+                commit = repo[sha]
+                pending[sha] = commit = (commit.parents, commit.commit_time,
+                    commit.author, commit.committer, commit.message)
+                missing = [p for p in commit[0] if p not in generations]
+                if missing:
+                    stack.extend(missing)
+                    continue
+            stack.pop()
+            del pending[sha]
+            (parents, commit_time, author, committer, message) = commit
+            generations[sha] = 1 + max([generations[p] for p in parents] or [0])
+            self.store.execute("INSERT INTO revision (id, parents, "
+                "commit_time, generation, author, author_email, committer, "
+                "message) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (sha,
+                " ".join(parents), commit_time, generations[sha], author,
+                split_author(author)[1], committer, message), noresult=True)
+        return reached
+
+    def update(self, repo, branch):
+        """Bring the index up to date with a branch.
+
+        :param repo: Repository the branch is in
+        :param branch: Name of the branch
+        :return: Whether the index changed
+        """
+        try:
+            head = repo.refs["refs/heads/%s" % branch]
+        except KeyError:
+            head = None
+        if self._head(branch) == head:
+            self.store.rollback()
+            return False
+        # Take the write lock before looking at the index again, so that
+        # concurrent updates wait for each other.
+        self.store.execute("UPDATE head SET id = id WHERE 0", noresult=True)
+        indexed_head = self._head(branch)
+        if indexed_head == head:
+            self.store.rollback()
+            return False
+        if (indexed_head is None or head is None or
+            not self._add_commits(repo, head, indexed_head)):
+            # The index is new, or the branch was rewritten
+            self.store.execute("DELETE FROM revision", noresult=True)
+            if head is not None:
+                self._add_commits(repo, head, None)
+        self.store.execute("DELETE FROM head", noresult=True)
+        self.store.execute("INSERT INTO head (branch, id) VALUES (?, ?)",
+            (branch, head), noresult=True)
+        self.store.commit()
+        return True
+
+    def log(self, limit=None, offset=0, author=None):
+        """List the indexed commits, most recent first.
+
+        :param limit: Maximum number of commits to list
+        :param offset: Number of commits to skip
+        :param author: Only list commits by the author with this email address
+        """
+        if author is None:
+            where = ""
+            args = ()
+        else:
+            where = "WHERE author_email = ? "
+            args = (author,)
+        if limit is None:
+            limit = -1
+        rows = self.store.execute("SELECT id, commit_time, committer, author, "
+            "message FROM revision %sORDER BY commit_time DESC, "
+            "generation DESC LIMIT ? OFFSET ?" % where,
+            args + (limit, offset)).get_all()
+        self.store.rollback()
+        return [Revision(*row) for row in rows]
+
+    def authors(self, limit=None):
+        """List the authors of the most recent commits.
+
+        :param limit: Number of commits to look at
+        """
+        if limit is None:
+            limit = -1
+        rows = self.store.execute("SELECT DISTINCT author FROM (SELECT author "
+            "FROM revision ORDER BY commit_time DESC, generation DESC "
+            "LIMIT ?)", (limit,)).get_all()
+        self.store.rollback()
+        return [row[0] for row in rows]
+
+
+class LocalPool(object):
+    """Pool of open objects, keyed by path.
+
+    dulwich repositories and Storm stores can't be used by several threads
+    at once, so every thread (and every forked process) gets its own
+    objects.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _objects(self):
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.pid = os.getpid()
+            self._local.objects = {}
+        return self._local.objects
+
+
+class RepositoryPool(LocalPool):
+    """Pool of open repositories.
+
+    Reusing repositories keeps their pack indexes loaded. A repository is
+    reopened when its refs change.
+    """
+
+    def _refs_stamp(self, controldir):
+        try:
+            stamp = [os.stat(os.path.join(controldir, "packed-refs")).st_mtime]
+        except OSError:
+            stamp = [None]
+        # Refs are updated by renaming a new file into the directory of the
+        # ref, which changes the modification time of that directory.
+        for (dirpath, dirnames, filenames) in os.walk(
+                os.path.join(controldir, "refs", "heads")):
+            try:
+                stamp.append((dirpath, os.stat(dirpath).st_mtime))
+            except OSError:
+                pass
+        return tuple(stamp)
+
+    def get(self, path):
+        """Retrieve the repository at a path, opening it if necessary.
+
+        :param path: Path to the repository
+        :return: A `Repo`
+        """
+        repos = self._objects()
+        path = os.path.abspath(path)
+        try:
+            (repo, stamp) = repos[path]
+        except KeyError:
+            pass
+        else:
+            if self._refs_stamp(repo.controldir()) == stamp:
+                return repo
+        repo = Repo(path)
+        repos[path] = (repo, self._refs_stamp(repo.controldir()))
+        return repo
+
+
+repositories = RepositoryPool()
+
+
+class CommitIndexPool(LocalPool):
+    """Pool of open commit indexes.
+
+    Reusing a commit index saves opening (and checking the schema of) its
+    database on every use.
+    """
+
+    def get(self, path):
+        """Retrieve the commit index at a path, opening it if necessary.
+
+        :param path: Path to the SQLite database
+        :return: A `GitCommitIndex`
+        """
+        indexes = self._objects()
+        path = os.path.abspath(path)
+        try:
+            return indexes[path]
+        except KeyError:
+            index = indexes[path] = GitCommitIndex(path)
+            return index
+
+
+commit_indexes = CommitIndexPool()
+
+
+class CommitCache(object):
+    """On-disk cache of data derived from commits.
+
+    Commits never change, so entries are keyed by commit id and never go out
+    of date. When the cache grows beyond max_size bytes, the least recently
+    used entries are removed.
+
+    Rather than looking at all entries on every put, each process keeps a
+    running estimate of the size of the cache, which it only checks against
+    the directory when the estimate exceeds max_size.
+    """
+
+    # Estimated size of each cache directory, shared by all CommitCache
+    # objects in the process.
+    _sizes = {}
+
+    def __init__(self, path, max_size=100 * 1024 * 1024):
+        """Open the cache.
+
+        :param path: Cache directory
+        :param max_size: Maximum total size of the entries, in bytes
+        """
+        self.path = path
+        self.max_size = max_size
+
+    def _fname(self, revision, name):
+        return os.path.join(self.path, "%s.%s" % (revision, name))
+
+    def get(self, revision, name):
+        """Retrieve an entry.
+
+        :return: Entry contents, or None if the entry isn't cached
+        """
+        fname = self._fname(revision, name)
+        try:
+            f = open(fname, 'rb')
+        except IOError:
+            return None
+        try:
+            contents = f.read()
+        finally:
+            f.close()
+        try:
+            # The modification time records when the entry was last used.
+            os.utime(fname, None)
+        except OSError:
+            pass
+        return contents
+
+    def put(self, revision, name, contents):
+        """Store an entry, removing old entries if the cache is full."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.path,
+            prefix="%s.%s." % (revision, name), suffix=".new")
+        f = os.fdopen(fd, 'wb')
+        try:
+            try:
+                f.write(contents)
+            finally:
+                f.close()
+        except:
+            os.remove(tmp_path)
+            raise
+        os.rename(tmp_path, self._fname(revision, name))
+        size = self._sizes.get(self.path)
+        if size is None or size + len(contents) > self.max_size:
+            self.expire()
+        else:
+            self._sizes[self.path] = size + len(contents)
+
+    def expire(self):
+        """Remove the least recently used entries until the cache is no
+        larger than max_size."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+            total += st.st_size
+        entries.sort()
+        for (mtime, name, size) in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+        self._sizes[self.path] = total
+
+
+def serialize_changes(changes):
+    """Serialize the result of `Branch.changes_summary`."""
+    ret = []
+    for (kind, paths) in zip("AMD", changes):
+        for path in sorted(paths):
+            ret.append("%s%s\0" % (kind, path))
+    return "".join(ret)
+
+
+def deserialize_changes(text):
+    """Deserialize the result of `Branch.changes_summary`."""
+    changes = {"A": set(), "M": set(), "D": set()}
+    for entry in text.split("\0")[:-1]:
+        changes[entry[0]].add(entry[1:])
+    return (changes["A"], changes["M"], changes["D"])
+
+
 class GitBranch(Branch):
 
-    def __init__(self, path, branch="master"):
-        self.repo = Repo(path)
+    def __init__(self, path, branch="master", index_path=None,
+                 cache_path=None, repo=None, index=None):
+        """Open a git branch.
+
+        :param path: Path to the repository
+        :param branch: Name of the branch
+        :param index_path: Path to a commit index for the branch, if any
+        :param cache_path: Directory for a `CommitCache`, if any
+        :param repo: Already opened repository at path, if any
+        :param index: Already opened commit index for the branch, if any
+        """
+        if repo is None:
+            repo = Repo(path)
+        self.repo = repo
         self.store = self.repo.object_store
         self.branch = branch
+        if index is None and index_path is not None:
+            index = GitCommitIndex(index_path)
+        self.index = index
+        if cache_path is not None:
+            self.cache = CommitCache(cache_path)
+        else:
+            self.cache = None
 
     def _changes_for(self, commit):
         if len(commit.parents) == 0:
@@ -68,34 +478,67 @@ class GitBranch(Branch):
             committer=commit.committer, author=commit.author,
             message=commit.message)
 
-    def log(self, from_rev=None, exclude_revs=None, limit=None):
-        if exclude_revs is None:
-            exclude_revs = set()
+    def log(self, from_rev=None, exclude_revs=None, limit=None, offset=0,
+            author=None):
+        """List the commits on the branch, most recent first.
+
+        :param from_rev: Commit to start at, instead of the branch head
+        :param exclude_revs: Commits to leave out, along with their ancestors;
+            nothing is listed if any of them is not in the repository
+        :param limit: Maximum number of commits to list
+        :param offset: Number of commits to skip
+        :param author: Only list commits by the author with this email address
+        """
+        if from_rev is None and not exclude_revs and self.index is not None:
+            self.index.update(self.repo, self.branch)
+            for rev in self.index.log(limit, offset, author):
+                yield rev
+            return
         if from_rev is None:
             try:
-                commit = self.repo["refs/heads/%s" % self.branch]
+                from_rev = self.repo.refs["refs/heads/%s" % self.branch]
             except KeyError:
                 return
-            from_rev = commit.id
-        done = set()
-        pending_commits = [from_rev]
-        while pending_commits != []:
-             commit_id = pending_commits.pop(0)
-             commit = self.repo[commit_id]
-             yield self._revision_from_commit(commit)
-             done.add(commit.id)
-             if len(done) >= limit:
-                 return
-             exclude_revs.add(commit.id)
-             # FIXME: Add sorted by commit_time
-             for p in commit.parents:
-                 if p in exclude_revs:
-                     continue
-                 pending_commits.append(p)
-                 exclude_revs.add(p)
+        exclude = list(exclude_revs or [])
+        for rev in exclude:
+            if rev not in self.store:
+                # Without it there is no telling which commits are new.
+                return
+        if limit is not None:
+            limit += offset
+        count = 0
+        for entry in self.repo.get_walker(include=[from_rev], exclude=exclude):
+            if author is not None and split_author(entry.commit.author)[1] != author:
+                continue
+            count += 1
+            if count > offset:
+                yield self._revision_from_commit(entry.commit)
+            if count == limit:
+                return
+
+    def authors(self, limit=None):
+        """List the authors of the most recent commits on the branch.
+
+        :param limit: Number of commits to look at
+        """
+        if self.index is not None:
+            self.index.update(self.repo, self.branch)
+            return self.index.authors(limit)
+        authors = set()
+        for rev in self.log(limit=limit):
+            authors.add(rev.author)
+        return list(authors)
+
+    def get_revision(self, revision):
+        """Retrieve the details of a commit."""
+        return self._revision_from_commit(self.repo[revision])
 
     def changes_summary(self, revision):
         commit = self.repo[revision]
+        if self.cache is not None:
+            cached = self.cache.get(commit.id, "changes")
+            if cached is not None:
+                return deserialize_changes(cached)
         added = set()
         modified = set()
         removed = set()
@@ -106,14 +549,23 @@ class GitBranch(Branch):
                 removed.add(oldpath)
             else:
                 modified.add(newpath)
+        if self.cache is not None:
+            self.cache.put(commit.id, "changes",
+                serialize_changes((added, modified, removed)))
         return (added, modified, removed)
 
     def diff(self, revision):
         commit = self.repo[revision]
+        if self.cache is not None:
+            cached = self.cache.get(commit.id, "diff")
+            if cached is not None:
+                return (self._revision_from_commit(commit), cached)
         f = StringIO()
         if len(commit.parents) == 0:
             parent_tree = Tree().id
         else:
             parent_tree = self.store[commit.parents[0]].tree
         write_tree_diff(f, self.store, parent_tree, commit.tree)
+        if self.cache is not None:
+            self.cache.put(commit.id, "diff", f.getvalue())
         return (self._revision_from_commit(commit), f.getvalue())
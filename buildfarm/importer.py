@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# Processing of newly uploaded builds
+#
+# Copyright (C) Jelmer Vernooij <jelmer@samba.org>   2010
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""Preparation of uploaded builds for import.
+
+The CPU-bound work for a new build (checksumming and parsing its logs,
+rendering the HTML for the log view) doesn't touch the database, so it
+can be done in worker processes while a single writer imports the
+results.
+"""
+
+import functools
+import itertools
+import multiprocessing
+import os
+import time
+
+
+def prepare_build(build, fragments=None):
+    """Analyse the logs of an uploaded build.
+
+    :param build: A `Build` in the upload directory
+    :param fragments: `LogFragmentCache` to stage the rendered HTML
+        fragments for the logs in, or None to not render them
+    :return: Tuple with the build (with its analysis filled in) and a
+        dictionary mapping fragment names to the temporary files they were
+        staged in, or None if no fragments were rendered
+    """
+    analysis = build.analyse()
+    if fragments is None or analysis.revision is None:
+        return (build, None)
+    from buildfarm.web import render_build_html
+    checksum = build.log_checksum()
+    staged = {}
+    for name, html in render_build_html(build).iteritems():
+        staged[name] = fragments.stage(checksum, name, [html])
+    return (build, staged)
+
+
+def prepare_builds(builds, jobs=1, fragments=None):
+    """Prepare a set of uploaded builds for import.
+
+    :param builds: Iterable over builds in the upload directory
+    :param jobs: Number of worker processes to use; 1 to do all work in
+        the current process
+    :param fragments: `LogFragmentCache` to stage the rendered HTML
+        fragments for the logs in, or None to not render them
+    :return: Iterator over (build, fragments) tuples, see `prepare_build`.
+        Results are returned in the same order as builds.
+    """
+    fn = functools.partial(prepare_build, fragments=fragments)
+    if jobs <= 1:
+        for result in itertools.imap(fn, builds):
+            yield result
+        return
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(fn, builds):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def discard_fragments(fragments):
+    """Remove the staged fragments of a build that is not imported.
+
+    :param fragments: Fragments as returned by `prepare_build`
+    """
+    if fragments is None:
+        return
+    for path in fragments.itervalues():
+        os.remove(path)
+
+
+class ImportBatch(object):
+    """A group of imported builds that is committed in a single transaction.
+
+    The uploaded logs of the builds in a batch are only removed (and their
+    HTML fragments only cached and mail about them only sent) once the
+    batch has been committed, so an interrupted import can simply be rerun.
+    """
+
+    def __init__(self, buildfarm, max_builds=1, max_time=None):
+        """Create a new batch.
+
+        :param buildfarm: `BuildFarm` to commit to
+        :param max_builds: Maximum number of builds per transaction
+        :param max_time: Maximum number of seconds a transaction stays open
+        """
+        self.buildfarm = buildfarm
+        self.max_builds = max_builds
+        self.max_time = max_time
+        self.pending = []
+        self.started = None
+        self.created = time.time()
+        self.builds = 0
+        self.commits = 0
+        self.commit_time = 0.0
+
+    def add(self, upload_build, build, fragments=None, notify=None):
+        """Add an imported build to the batch, committing if it is full.
+
+        :param upload_build: The build in the upload directory
+        :param build: The build as imported into the database
+        :param fragments: HTML fragments for the build staged by
+            `prepare_build`, if any
+        :param notify: Function to call once the build has been committed,
+            e.g. to send mail about it
+        """
+        if not self.pending:
+            self.started = time.time()
+        self.pending.append((upload_build, build, fragments, notify))
+        if self.is_full():
+            self.commit()
+
+    def is_full(self):
+        if len(self.pending) >= self.max_builds:
+            return True
+        if (self.max_time is not None and
+            time.time() - self.started >= self.max_time):
+            return True
+        return False
+
+    def commit(self):
+        """Commit the pending builds and clean up their uploaded logs."""
+        if not self.pending:
+            return
+        from buildfarm.web import cache_build_html
+        start = time.time()
+        try:
+            self.buildfarm.bump_data_generation()
+            self.buildfarm.commit()
+        except:
+            # The staged fragments are rendered again by the next commit.
+            pending = []
+            for (upload_build, build, fragments, notify) in self.pending:
+                discard_fragments(fragments)
+                pending.append((upload_build, build, None, notify))
+            self.pending = pending
+            raise
+        self.commit_time += time.time() - start
+        self.commits += 1
+        pending = self.pending
+        self.pending = []
+        for (upload_build, build, fragments, notify) in pending:
+            upload_build.remove()
+            if fragments is None:
+                cache_build_html(self.buildfarm, build)
+            else:
+                checksum = build.log_checksum()
+                for name, path in fragments.iteritems():
+                    self.buildfarm.fragments.publish(checksum, name, path)
+        self.builds += len(pending)
+        for (upload_build, build, fragments, notify) in pending:
+            if notify is not None:
+                notify()
+
+    def stats(self):
+        """Describe the commits done so far."""
+        elapsed = max(time.time() - self.created, 0.001)
+        return "%d builds in %d transactions: %.1f commits/s, %.3fs in commit" % (
+            self.builds, self.commits, self.commits / elapsed, self.commit_time)
@@ -21,9 +21,12 @@ from buildfarm.tree import (
     Tree,
     )
 from buildfarm.build import (
+    BuildStatus,
     StormBuild,
+    StormLatestBuild,
     Test,
     TestResult,
+    bump_data_generation,
     )
 from buildfarm.hostdb import (
     Host,
@@ -38,27 +41,10 @@ try:
 except ImportError:
     import sqlite3
 from storm.database import create_database
-from storm.expr import EXPR, FuncExpr, compile
 from storm.locals import Bool, Desc, Int, RawStr, Reference, Unicode
 from storm.store import Store
 
 
-class Cast(FuncExpr):
-    __slots__ = ("column", "type")
-    name = "CAST"
-
-    def __init__(self, column, type):
-        self.column = column
-        self.type = type
-
-@compile.when(Cast)
-def compile_count(compile, cast, state):
-    state.push("context", EXPR)
-    column = compile(cast.column, state)
-    state.pop()
-    return "CAST(%s AS %s)" % (column, cast.type)
-
-
 class StormHost(Host):
     __storm_table__ = "host"
 
@@ -89,6 +75,14 @@ class StormHost(Host):
 
     owner = property(_get_owner, _set_owner)
 
+    def update_platform(self, new_platform):
+        super(StormHost, self).update_platform(new_platform)
+        bump_data_generation(Store.of(self))
+
+    def update_owner(self, new_owner, new_owner_email):
+        super(StormHost, self).update_owner(new_owner, new_owner_email)
+        bump_data_generation(Store.of(self))
+
 
 class StormHostDatabase(HostDatabase):
 
@@ -108,19 +102,20 @@ class StormHostDatabase(HostDatabase):
             self.store.flush()
         except sqlite3.IntegrityError:
             raise HostAlreadyExists(name)
+        bump_data_generation(self.store)
         return newhost
 
     def deletehost(self, name):
         """Remove a host."""
         self.store.remove(self[name])
+        bump_data_generation(self.store)
 
     def hosts(self):
         """Retrieve an iterable over all hosts."""
         return self.store.find(StormHost).order_by(StormHost.name)
 
     def __getitem__(self, name):
-        result = self.store.find(StormHost,
-            Cast(StormHost.name, "TEXT") == Cast(name, "TEXT"))
+        result = self.store.find(StormHost, StormHost.name == name)
         ret = result.one()
         if ret is None:
             raise NoSuchHost(name)
@@ -130,16 +125,6 @@ class StormHostDatabase(HostDatabase):
         self.store.commit()
 
 
-def distinct_builds(builds):
-    done = set()
-    for build in builds:
-        key = (build.tree, build.compiler, build.host)
-        if key in done:
-            continue
-        done.add(key)
-        yield build
-
-
 class StormTree(Tree):
     __storm_table__ = "tree"
 
@@ -161,16 +146,38 @@ class StormTest(Test):
 
 class StormTestResult(TestResult):
     __storm_table__ = "test_result"
+    __storm_primary__ = ("build_id", "test_id")
 
-    id = Int(primary=True)
     build_id = Int(name="build")
     build = Reference(build_id, StormBuild)
 
     test_id = Int(name="test")
     test = Reference(test_id, StormTest)
 
+    result = Int()
+
+
+def executemany(store, statement, params):
+    """Execute a statement once for each set of parameters.
+
+    This bypasses Storm, which would otherwise execute (and trace) the
+    statements one at a time.
+    """
+    store.flush()
+    # Let Storm connect and begin a transaction, if it hasn't already.
+    store.execute("SELECT 1", noresult=True)
+    cursor = store._connection.build_raw_cursor()
+    try:
+        cursor.executemany(statement, params)
+    finally:
+        cursor.close()
+
 
 def setup_schema(db):
+    """Create the database schema and apply any pending upgrades.
+
+    :return: List of names of the upgrades that were applied
+    """
     db.execute("PRAGMA foreign_keys = 1;", noresult=True)
     db.execute("""
 CREATE TABLE IF NOT EXISTS host (
@@ -207,6 +214,27 @@ CREATE TABLE IF NOT EXISTS build (
 );""", noresult=True)
     db.execute("CREATE UNIQUE INDEX IF NOT EXISTS unique_checksum ON build (checksum);", noresult=True)
     db.execute("""
+CREATE TABLE IF NOT EXISTS latest_build (
+    tree blob not null,
+    host blob not null,
+    compiler blob not null,
+    build integer not null,
+    age int,
+    PRIMARY KEY (tree, host, compiler),
+    FOREIGN KEY (build) REFERENCES build (id)
+);""", noresult=True)
+    db.execute("CREATE INDEX IF NOT EXISTS latest_build_host ON latest_build (host);",
+        noresult=True)
+    db.execute("""
+CREATE TABLE IF NOT EXISTS build_analysis (
+    checksum blob primary key,
+    err_lines int,
+    phases blob,
+    uname blob,
+    cflags blob,
+    config blob
+);""", noresult=True)
+    db.execute("""
 CREATE TABLE IF NOT EXISTS tree (
     id integer primary key autoincrement,
     name blob not null,
@@ -241,6 +269,145 @@ CREATE TABLE IF NOT EXISTS test (
         result int
         );""", noresult=True)
     db.execute("""CREATE UNIQUE INDEX IF NOT EXISTS build_test_result ON test_result(build, test);""", noresult=True)
+    db.execute("CREATE INDEX IF NOT EXISTS build_tree_revision ON build (tree, revision);",
+        noresult=True)
+    return upgrade_schema(db)
+
+
+# Columns that are mapped as RawStr and thus compared as blobs.
+BLOB_COLUMNS = {
+    "host": ["name"],
+    "build": ["tree", "revision", "host", "compiler", "checksum", "status",
+              "basename"],
+    "build_analysis": ["checksum"],
+    "tree": ["name"],
+    "compiler": ["name"],
+    }
+
+
+def normalize_column_types(db):
+    """Convert text values in blob columns to blobs.
+
+    Older versions of the buildfarm stored some of these values as text.
+    SQLite never considers a text value equal to a blob, so lookups
+    could only find them by casting both sides, which prevents the use
+    of indexes.
+    """
+    for (table, columns) in BLOB_COLUMNS.iteritems():
+        for column in columns:
+            db.execute("UPDATE %s SET %s = CAST(%s AS BLOB) WHERE typeof(%s) = 'text'" % (
+                table, column, column, column), noresult=True)
+
+
+def add_build_indexes(db):
+    """Add indexes for the queries that look up builds by tree, host and
+    compiler and order them by age."""
+    db.execute("CREATE INDEX IF NOT EXISTS build_tree_host_compiler_age "
+               "ON build (tree, host, compiler, age);", noresult=True)
+    db.execute("CREATE INDEX IF NOT EXISTS build_host_age ON build (host, age);",
+        noresult=True)
+
+
+def populate_latest_build(db):
+    """Fill the latest_build table from the existing builds."""
+    # SQLite takes the bare id column from the row with the maximum age.
+    db.execute("""
+INSERT OR REPLACE INTO latest_build (tree, host, compiler, build, age)
+SELECT tree, host, compiler, id, MAX(age) FROM build GROUP BY tree, host, compiler
+""", noresult=True)
+
+
+def add_status_columns(db):
+    """Add columns to build that summarize its status, so that failed
+    builds can be found and counted without decoding the status."""
+    existing = set([row[1] for row in db.execute("PRAGMA table_info(build);")])
+    for (column, type) in [("failed", "int"), ("panic", "int"),
+                           ("timeout", "int"), ("disk_full", "int"),
+                           ("worst_stage", "int")]:
+        if column in existing:
+            continue
+        db.execute("ALTER TABLE build ADD COLUMN %s %s;" % (column, type),
+            noresult=True)
+    rows = list(db.execute("SELECT id, status FROM build WHERE status IS NOT NULL"))
+    for (id, status_str) in rows:
+        status = BuildStatus.__deserialize__(str(status_str))
+        db.execute("UPDATE build SET failed = ?, panic = ?, timeout = ?, "
+            "disk_full = ?, worst_stage = ? WHERE id = ?",
+            status.summary_columns() + (id, ), noresult=True)
+    db.execute("CREATE INDEX IF NOT EXISTS build_tree_failed_age "
+               "ON build (tree, failed, age);", noresult=True)
+
+
+def add_test_result_indexes(db):
+    """Add indexes for looking up the results of a test and the builds of a
+    tree in a time window."""
+    db.execute("CREATE INDEX IF NOT EXISTS test_result_test_build "
+               "ON test_result (test, build);", noresult=True)
+    db.execute("CREATE INDEX IF NOT EXISTS build_tree_age ON build (tree, age);",
+        noresult=True)
+
+
+def add_data_generation(db):
+    """Add a counter that is incremented whenever builds are imported, so
+    that rendered pages can be cached until the data changes."""
+    db.execute("CREATE TABLE IF NOT EXISTS data_generation ("
+               "id integer primary key, generation int not null);",
+               noresult=True)
+    db.execute("INSERT OR IGNORE INTO data_generation (id, generation) "
+               "VALUES (1, 0);", noresult=True)
+
+
+# Schema upgrades, in order. The schema version stored in the database
+# is the number of upgrades that have been applied.
+SCHEMA_UPGRADES = [
+    normalize_column_types,
+    add_build_indexes,
+    populate_latest_build,
+    add_status_columns,
+    add_test_result_indexes,
+    add_data_generation,
+    ]
+
+
+class SchemaOutOfDate(Exception):
+    """The database schema needs to be upgraded."""
+
+    def __init__(self, version, expected):
+        super(SchemaOutOfDate, self).__init__(
+            "Database schema version is %d, expected %d; run "
+            "./admin.py migrate to upgrade it" % (version, expected))
+        self.version = version
+        self.expected = expected
+
+
+def schema_version(db):
+    (version, ) = db.execute("PRAGMA user_version;").get_one()
+    return version
+
+
+def check_schema(db):
+    """Check that the database schema is up to date, without changing it.
+
+    :raise SchemaOutOfDate: if there are schema upgrades to apply
+    """
+    version = schema_version(db)
+    if version != len(SCHEMA_UPGRADES):
+        raise SchemaOutOfDate(version, len(SCHEMA_UPGRADES))
+
+
+def upgrade_schema(db):
+    """Apply any schema upgrades that have not been applied yet.
+
+    :return: List of names of the upgrades that were applied
+    """
+    applied = []
+    version = schema_version(db)
+    for upgrade in SCHEMA_UPGRADES[version:]:
+        upgrade(db)
+        version += 1
+        db.execute("PRAGMA user_version = %d;" % version, noresult=True)
+        applied.append(upgrade.__name__)
+    return applied
 
 
 def memory_store():
@@ -112,6 +112,7 @@ def test_suite():
         'test_buildfarm',
         'test_history',
         'test_hostdb',
+        'test_importer',
         'test_sqldb',
         'test_util',
         'test_mail',
@@ -16,6 +16,7 @@
 #   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 from cStringIO import StringIO
+import hashlib
 import os
 import testtools
 
@@ -25,8 +26,12 @@ from buildfarm.build import (
     NoSuchBuildError,
     NoTestOutput,
     UploadBuildResultStore,
+    analyse_logs,
     build_status_from_logs,
     extract_test_output,
+    TestResultsDiff,
+    parse_test_results,
+    previous_build,
     )
 
 from buildfarm import BuildFarm
@@ -56,6 +61,32 @@ BUILD COMMIT REVISION: myotherrev
         self.assertRaises(NoSuchBuildError, self.x.get_previous_build, "tdb", "charis", "cc", "myrev")
         self.assertEquals("myrev", self.x.get_previous_build("tdb", "charis", "cc", "myotherrev").revision)
 
+    def test_get_build_history(self):
+        builds = []
+        for rev in ["myrev", "myotherrev", "mythirdrev"]:
+            path = self.create_mock_logfile("tdb", "charis", "cc", contents="""
+BUILD COMMIT REVISION: %s
+""" % rev)
+            builds.append(self.x.upload_build(Build(path[:-4], "tdb", "charis", "cc")))
+        self.assertEquals(["mythirdrev", "myotherrev", "myrev"],
+            [b.revision for b in self.x.get_build_history("tdb", "charis", "cc")])
+        self.assertEquals(["myrev"], [b.revision for b in
+            self.x.get_build_history("tdb", "charis", "cc", before=builds[1])])
+        self.assertEquals([], list(self.x.get_build_history("tdb", "charis", "gcc")))
+
+    def test_previous_build(self):
+        builds = []
+        for rev in ["myrev", "myotherrev", "myotherrev"]:
+            path = self.create_mock_logfile("tdb", "charis", "cc", contents="""
+BUILD COMMIT REVISION: %s
+%d
+""" % (rev, len(builds)))
+            builds.append(self.x.upload_build(Build(path[:-4], "tdb", "charis", "cc")))
+        history = iter(self.x.get_build_history("tdb", "charis", "cc",
+            before=builds[2]))
+        self.assertEquals(builds[0], previous_build(history, builds[2]))
+        self.assertRaises(NoSuchBuildError, previous_build, history, builds[0])
+
     def test_get_latest_revision(self):
         path = self.create_mock_logfile("tdb", "charis", "cc", "22", contents="""
 BUILD COMMIT REVISION: myrev
@@ -66,7 +97,41 @@ BUILD COMMIT REVISION: myrev
     def test_build_fname(self):
         self.assertEquals(
             self.x.build_fname("mytree", "myhost", "cc", 123),
-            "%s/data/oldrevs/build.mytree.myhost.cc-123" % self.path)
+            "%s/data/oldrevs/mytree/myhost/build.mytree.myhost.cc-123" % self.path)
+
+    def test_shard_old_builds(self):
+        self.upload_mock_logfile(self.x, "tdb", "charis", "cc",
+                "BUILD COMMIT REVISION: 12\n")
+        build = self.x.get_build("tdb", "charis", "cc", "12")
+        # Move the build back to the old, flat layout
+        flat_basename = os.path.join(self.x.path, os.path.basename(build.basename))
+        os.rename(build.basename + ".log", flat_basename + ".log")
+        build.basename = flat_basename
+        self.assertEquals(1, self.x.shard_old_builds())
+        build = self.x.get_build("tdb", "charis", "cc", "12")
+        self.assertEquals(self.x.build_fname("tdb", "charis", "cc", "12"),
+            build.basename)
+        self.assertTrue(os.path.exists(build.basename + ".log"))
+        self.assertFalse(os.path.exists(flat_basename + ".log"))
+        self.assertEquals(0, self.x.shard_old_builds())
+
+    def test_shard_old_builds_dotted_compiler(self):
+        self.upload_mock_logfile(self.x, "tdb", "charis", "gcc-4.1",
+                "BUILD COMMIT REVISION: 12\n")
+        build = self.x.get_build("tdb", "charis", "gcc-4.1", "12")
+        # Move the build back to the old, flat layout
+        flat_basename = os.path.join(self.x.path, os.path.basename(build.basename))
+        os.rename(build.basename + ".log", flat_basename + ".log")
+        build.basename = flat_basename
+        # Files that don't belong to a build are left alone
+        orphan = os.path.join(self.x.path, "build.tdb.charis.gcc-4.1-13.log")
+        open(orphan, 'w').close()
+        self.assertEquals(1, self.x.shard_old_builds())
+        build = self.x.get_build("tdb", "charis", "gcc-4.1", "12")
+        self.assertEquals(self.x.build_fname("tdb", "charis", "gcc-4.1", "12"),
+            build.basename)
+        self.assertTrue(os.path.exists(build.basename + ".log"))
+        self.assertTrue(os.path.exists(orphan))
 
     def test_build_remove(self):
         path = self.upload_mock_logfile(self.x, "tdb", "charis", "cc", 
@@ -154,12 +219,56 @@ BUILD COMMIT REVISION: myrev
         uploaded_build = self.x.get_build("tdb", "charis", "cc", "myrev")
         self.assertEquals(uploaded_build.log_checksum(), build.log_checksum())
 
+    def test_upload_build_replaces_old_files(self):
+        path = self.create_mock_logfile("tdb", "charis", "cc", contents="""
+BUILD COMMIT REVISION: myrev
+""")
+        build = Build(path[:-4], "tdb", "charis", "cc")
+        new_basename = self.x.build_fname("tdb", "charis", "cc", "myrev")
+        os.makedirs(os.path.dirname(new_basename))
+        for ext in (".log", ".err.bz2"):
+            open(new_basename+ext, "w").close()
+        self.x.upload_build(build)
+        self.assertEquals(build.log_checksum(),
+            self.x.get_build("tdb", "charis", "cc", "myrev").log_checksum())
+        self.assertFalse(os.path.exists(new_basename+".err.bz2"))
+
     def test_upload_build_no_rev(self):
         path = self.create_mock_logfile("tdb", "charis", "cc", contents="""
 """)
         build = Build(path[:-4], "tdb", "charis", "cc")
         self.assertRaises(Exception, self.x.upload_build, build)
 
+    def test_read_subunit(self):
+        path = self.create_mock_logfile("tdb", "charis", "cc", contents="""
+BUILD COMMIT REVISION: myrev
+Running action test
+test: foo
+success: foo
+ACTION PASSED: test
+""")
+        build = Build(path[:-4], "tdb", "charis", "cc")
+        self.assertEquals("test: foo\nsuccess: foo\n", build.read_subunit().read())
+        uploaded_build = self.x.upload_build(build)
+        self.assertEquals("test: foo\nsuccess: foo\n", build.read_subunit().read())
+        self.assertEquals("test: foo\nsuccess: foo\n",
+            uploaded_build.read_subunit().read())
+
+    def test_upload_test_results(self):
+        path = self.create_mock_logfile("tdb", "charis", "cc", contents="""
+BUILD COMMIT REVISION: myrev
+Running action test
+test: foo
+success: foo
+test: bar
+error: bar [
+oops
+]
+ACTION FAILED: test
+""")
+        build = self.x.upload_build(Build(path[:-4], "tdb", "charis", "cc"))
+        self.assertEquals({"bar": 2, "foo": 0}, self.x.get_test_results(build))
+
     def test_get_previous_build(self):
         self.assertRaises(NoSuchBuildError, self.x.get_previous_build, "tdb", "charis", "cc", "12")
 
@@ -174,20 +283,20 @@ BUILD COMMIT REVISION: myrev
         path = self.create_mock_logfile("tdb", "charis", "cc",
             contents="""
 BUILD COMMIT REVISION: 12
-""")
+""", mtime=100)
         build = Build(path[:-4], "tdb", "charis", "cc")
         b1 = self.x.upload_build(build)
         path = self.create_mock_logfile("tdb", "charis", "cc",
             contents="""
 BUILD COMMIT REVISION: 15
-""")
+""", mtime=200)
         build = Build(path[:-4], "tdb", "charis", "cc")
         b2 = self.x.upload_build(build)
         path = self.create_mock_logfile("tdb", "charis", "cc",
             contents="""
 BUILD COMMIT REVISION: 15
 """)
-        self.assertEquals([b1, b2],
+        self.assertEquals([b2, b1],
             list(self.x.get_old_builds("tdb", "charis", "cc")))
 
 
@@ -331,6 +440,37 @@ class BuildStatusTest(testtools.TestCase):
         a = BuildStatus([("CONFIGURE", 3), ("BUILD", 2)], set(["panic"]))
         self.assertEquals("panic", str(a))
 
+    def assertSerializes(self, status):
+        text = status.__serialize__()
+        other = BuildStatus.__deserialize__(text)
+        self.assertEquals(status.stages, other.stages)
+        self.assertEquals(status.other_failures, other.other_failures)
+
+    def test_serialize(self):
+        self.assertEquals("1\nS 3 CONFIGURE\nS -1 BUILD\nF disk full\nF panic",
+            BuildStatus([("CONFIGURE", 3), ("BUILD", -1)],
+                set(["panic", "disk full"])).__serialize__())
+
+    def test_serialize_roundtrip(self):
+        self.assertSerializes(BuildStatus())
+        self.assertSerializes(BuildStatus([("CONFIGURE", 0), ("CC CHECKER", 2)]))
+        self.assertSerializes(BuildStatus([("TEST", -2)], set(["super error"])))
+
+    def test_deserialize_repr(self):
+        status = BuildStatus([("CONFIGURE", 3), ("BUILD", 2)], set(["panic"]))
+        other = BuildStatus.__deserialize__(repr(status))
+        self.assertEquals(status.stages, other.stages)
+        self.assertEquals(status.other_failures, other.other_failures)
+        other = BuildStatus.__deserialize__(repr(BuildStatus()))
+        self.assertEquals([], other.stages)
+        self.assertEquals(set(), other.other_failures)
+
+    def test_deserialize_invalid(self):
+        self.assertRaises(ValueError, BuildStatus.__deserialize__,
+            "__import__('os').getcwd()")
+        self.assertRaises(ValueError, BuildStatus.__deserialize__,
+            "1\nX foo")
+
 
 class BuildStatusRegressedSinceTests(testtools.TestCase):
 
@@ -408,6 +548,27 @@ class UploadBuildResultStoreTestBase(object):
         self.assertEquals("charis", new_builds[0].host)
         self.assertEquals("cc", new_builds[0].compiler)
 
+    def test_get_all_builds_refresh(self):
+        self.create_mock_logfile("tdb", "charis", "cc", mtime=100)
+        self.assertEquals(1, len(list(self.x.get_all_builds())))
+        self.create_mock_logfile("talloc", "charis", "cc", mtime=50)
+        self.assertEquals(["talloc", "tdb"],
+            [build.tree for build in self.x.get_all_builds()])
+
+    def test_has_host(self):
+        self.assertFalse(self.x.has_host("charis"))
+        self.create_mock_logfile("tdb", "charis", "cc")
+        self.assertTrue(self.x.has_host("charis"))
+        self.assertFalse(self.x.has_host("myhost"))
+
+    def test_get_build(self):
+        self.assertRaises(NoSuchBuildError, self.x.get_build, "tdb", "charis", "cc")
+        self.create_mock_logfile("tdb", "charis", "cc")
+        build = self.x.get_build("tdb", "charis", "cc")
+        self.assertEquals(self.x.build_fname("tdb", "charis", "cc"), build.basename)
+        build.remove()
+        self.assertRaises(NoSuchBuildError, self.x.get_build, "tdb", "charis", "cc")
+
 
 class UploadBuildResultStoreTests(UploadBuildResultStoreTestBase,BuildFarmTestCase):
 
@@ -437,3 +598,96 @@ FOO
 ACTION PASSED: test
 
 """))
+
+
+class ParseTestResultsTests(testtools.TestCase):
+
+    def parse(self, text):
+        return list(parse_test_results(StringIO(text)))
+
+    def test_empty(self):
+        self.assertEquals([], self.parse(""))
+
+    def test_results(self):
+        self.assertEquals([("foo", 0), ("bar baz", 1), ("la", 3), ("x", 4)],
+            self.parse("""testsuite: samba4.foo
+test: foo
+success: foo
+time: 2010-10-10 10:10:10Z
+test: bar baz
+failure: bar baz [
+success: not a result
+]
+testsuite-failure: samba4.foo
+skip: la [ multipart
+Content-Type: text/plain
+]
+xfail: x
+"""))
+
+
+class TestResultsDiffTests(testtools.TestCase):
+
+    def test_no_changes(self):
+        diff = TestResultsDiff({"foo": 0, "bar": 1}, {"foo": 0, "bar": 1})
+        self.assertFalse(diff)
+
+    def test_changes(self):
+        diff = TestResultsDiff(
+            {"a": 0, "b": 1, "c": 0, "d": 0, "e": 2, "f": 4},
+            {"a": 1, "b": 0, "c": 3, "d": 0, "e": 1, "g": 2, "h": 0})
+        self.assertTrue(diff)
+        self.assertEquals(["a", "g"], diff.newly_failing)
+        self.assertEquals(["b"], diff.newly_passing)
+        self.assertEquals(["c"], diff.newly_skipped)
+        self.assertEquals(["f"], diff.removed)
+
+
+class LogAnalysisTests(testtools.TestCase):
+
+    log = """BUILD COMMIT REVISION: 42
+Running action configure
+checking for gcc... yes
+ACTION PASSED: configure
+CONFIGURE STATUS: 0
+Running action test
+testsuite: foo
+testsuite-success: foo
+ACTION PASSED: test
+"""
+
+    def analyse(self, log, err=""):
+        return analyse_logs(StringIO(log), StringIO(err))
+
+    def test_empty(self):
+        analysis = self.analyse("")
+        self.assertIs(None, analysis.revision)
+        self.assertEquals([], analysis.phases)
+        self.assertIs(None, analysis.test_output)
+        self.assertEquals(hashlib.sha1("").hexdigest(), analysis.checksum)
+
+    def test_revision(self):
+        self.assertEquals("42", self.analyse(self.log).revision)
+
+    def test_checksum(self):
+        self.assertEquals(hashlib.sha1(self.log).hexdigest(),
+            self.analyse(self.log).checksum)
+
+    def test_status(self):
+        analysis = self.analyse(self.log, "No space left on device\n")
+        self.assertEquals([("CONFIGURE", 0), ("TEST", 0)],
+            analysis.status.stages)
+        self.assertEquals(set(["disk full"]), analysis.status.other_failures)
+
+    def test_err_lines(self):
+        self.assertEquals(2, self.analyse("", "foo\nbar").err_lines)
+
+    def test_phases(self):
+        analysis = self.analyse(self.log)
+        self.assertEquals(["configure", "test"],
+            [phase.name for phase in analysis.phases])
+        test_output = analysis.test_output
+        self.assertEquals("testsuite: foo\ntestsuite-success: foo\n",
+            self.log[test_output.start:test_output.end])
+        self.assertEquals("".join(extract_test_output(StringIO(self.log))),
+            self.log[test_output.start:test_output.end])
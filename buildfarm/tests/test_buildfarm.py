@@ -20,13 +20,36 @@ from buildfarm import (
     read_trees_from_conf,
     )
 from buildfarm.build import NoSuchBuildError
+from buildfarm.sqldb import (
+    SCHEMA_UPGRADES,
+    SchemaOutOfDate,
+    schema_version,
+    )
 from buildfarm.tests import BuildFarmTestCase
 
 import os
+from storm.exceptions import OperationalError
+from storm.tracer import install_tracer, remove_tracer
 from testtools import TestCase
 import tempfile
 
 
+class StatementTracer(object):
+    """Storm tracer that records all executed statements."""
+
+    def __init__(self):
+        self.statements = []
+
+    def connection_raw_execute(self, connection, raw_cursor, statement, params):
+        self.statements.append(statement.lstrip())
+
+    def connection_raw_execute_success(self, *args):
+        pass
+
+    def connection_raw_execute_error(self, *args):
+        pass
+
+
 class ReadTreesFromConfTests(TestCase):
 
     def create_file(self, contents):
@@ -84,6 +107,75 @@ class BuildFarmTests(BuildFarmTestCase):
         self.buildfarm.commit()
         self.x = BuildFarm(self.path)
 
+    def test_reload_config(self):
+        self.assertFalse(self.x.reload_config())
+        self.assertEquals(set(["cc"]), self.x.compilers)
+        self.write_compilers(["cc", "gcc"])
+        self.assertTrue(self.x.reload_config())
+        self.assertEquals(set(["cc", "gcc"]), self.x.compilers)
+        self.assertFalse(self.x.reload_config())
+
+    def test_no_upgrade_out_of_date(self):
+        self.x.store.execute("PRAGMA user_version = 0", noresult=True)
+        self.x.commit()
+        e = self.assertRaises(SchemaOutOfDate, BuildFarm, self.path,
+            upgrade=False)
+        self.assertEquals(0, e.version)
+
+    def assertNoDDL(self, upgrade):
+        tracer = StatementTracer()
+        install_tracer(tracer)
+        self.addCleanup(remove_tracer, tracer)
+        buildfarm = BuildFarm(self.path, upgrade=upgrade)
+        buildfarm.get_summary_counts(0)
+        buildfarm.rollback()
+        self.assertEquals([], [s for s in tracer.statements
+            if s.split(None, 1)[0].upper() in ("CREATE", "ALTER", "DROP")])
+        self.assertEquals([], buildfarm.applied_upgrades)
+
+    def test_no_upgrade_no_ddl(self):
+        self.assertNoDDL(upgrade=False)
+
+    def test_up_to_date_no_ddl(self):
+        self.assertNoDDL(upgrade=True)
+
+    def test_applied_upgrades(self):
+        self.x.store.execute("PRAGMA user_version = %d" % (
+            len(SCHEMA_UPGRADES) - 1), noresult=True)
+        self.x.commit()
+        buildfarm = BuildFarm(self.path)
+        self.assertEquals([SCHEMA_UPGRADES[-1].__name__],
+            buildfarm.applied_upgrades)
+        self.assertEquals(len(SCHEMA_UPGRADES), schema_version(buildfarm.store))
+
+    def test_upgrade_committed(self):
+        self.x.store.execute("PRAGMA user_version = %d" % (
+            len(SCHEMA_UPGRADES) - 1), noresult=True)
+        self.x.commit()
+        BuildFarm(self.path).rollback()
+        buildfarm = BuildFarm(self.path, upgrade=False)
+        self.assertEquals([], buildfarm.applied_upgrades)
+
+    def test_journal_mode(self):
+        self.assertEquals(("wal", ),
+            self.x.store.execute("PRAGMA journal_mode").get_one())
+
+    def test_readonly(self):
+        buildfarm = BuildFarm(self.path, readonly=True)
+        self.assertFalse(buildfarm.upgrade)
+        self.assertRaises(OperationalError, buildfarm.hostdb.createhost,
+            "newhost")
+
+    def test_readonly_while_writing(self):
+        self.upload_mock_logfile(self.x.builds, "trivial", "charis", "cc",
+            stdout_contents="BUILD COMMIT REVISION: 12\n")
+        # The write transaction is still open.
+        buildfarm = BuildFarm(self.path, readonly=True, timeout=0)
+        self.assertEquals([], list(buildfarm.get_last_builds()))
+        self.x.commit()
+        buildfarm.rollback()
+        self.assertEquals(1, len(list(buildfarm.get_last_builds())))
+
     def test_get_new_builds_empty(self):
         self.assertEquals([], list(self.x.get_new_builds()))
 
@@ -153,9 +245,113 @@ class BuildFarmTests(BuildFarmTestCase):
         builds = list(self.x.get_summary_builds(min_age=5000))
         self.assertEquals(0, len(builds))
 
+    def test_get_summary_counts(self):
+        self.upload_mock_logfile(self.x.builds, "other", "myhost", "cc",
+            "BUILD COMMIT REVISION: 12\nNo space left on device\n", mtime=1200)
+        self.upload_mock_logfile(self.x.builds, "trivial", "myhost", "cc",
+            "BUILD COMMIT REVISION: 13\nMaximum time expired in timelimit\n", mtime=1300)
+        self.upload_mock_logfile(self.x.builds, "trivial", "myhost", "cc",
+            "BUILD COMMIT REVISION: 42\nPANIC:\n", mtime=4200)
+        self.upload_mock_logfile(self.x.builds, "trivial", "charis", "cc",
+            "BUILD COMMIT REVISION: 42\nCONFIGURE STATUS: 0\n", mtime=4200)
+        self.assertEquals([("other", 1, 1, 0), ("trivial", 2, 1, 1)],
+            sorted(self.x.get_summary_counts()))
+        self.assertEquals([("trivial", 2, 1, 1)],
+            list(self.x.get_summary_counts(min_age=4000)))
+
+    def test_failed_tree_builds(self):
+        self.upload_mock_logfile(self.x.builds, "trivial", "myhost", "cc",
+            "BUILD COMMIT REVISION: 12\nCONFIGURE STATUS: 1\n", mtime=1200)
+        self.upload_mock_logfile(self.x.builds, "trivial", "myhost", "cc",
+            "BUILD COMMIT REVISION: 13\nCONFIGURE STATUS: 0\n", mtime=1300)
+        self.upload_mock_logfile(self.x.builds, "trivial", "charis", "cc",
+            "BUILD COMMIT REVISION: 42\nPANIC:\n", mtime=4200)
+        self.assertEquals(["42", "12"],
+            [build.revision for build in self.x.failed_tree_builds("trivial")])
+
+    def test_status_columns(self):
+        self.upload_mock_logfile(self.x.builds, "trivial", "myhost", "cc",
+            "BUILD COMMIT REVISION: 12\nCONFIGURE STATUS: 0\nBUILD STATUS: 2\nPANIC:\n")
+        build = self.x.builds.get_build("trivial", "myhost", "cc", "12")
+        self.assertEquals((True, True, False, False, 1),
+            (build.failed, build.panic, build.timeout, build.disk_full,
+             build.worst_stage))
+
+    def upload_test_results(self, tree, host, revision, results, mtime=None):
+        lines = ["BUILD COMMIT REVISION: %s\n" % revision,
+                 "Running action test\n"]
+        for (name, outcome) in results:
+            lines.append("test: %s\n%s: %s\n" % (name, outcome, name))
+        lines.append("ACTION PASSED: test\n")
+        self.upload_mock_logfile(self.x.builds, tree, host, "cc",
+            "".join(lines), mtime=mtime)
+
+    def test_get_test_results(self):
+        self.upload_test_results("tdb", "myhost", "12",
+            [("foo", "success"), ("bar", "failure")], mtime=1200)
+        self.upload_test_results("tdb", "charis", "12",
+            [("foo", "failure")], mtime=1300)
+        self.upload_test_results("tdb", "myhost", "13",
+            [("foo", "skip")], mtime=1400)
+        self.assertEquals([("myhost", 3), ("charis", 1), ("myhost", 0)],
+            [(build.host, result) for (build, result) in
+                self.x.get_test_results("foo")])
+        self.assertEquals([("myhost", 3)],
+            [(build.host, result) for (build, result) in
+                self.x.get_test_results("foo", limit=1)])
+        self.assertEquals([], self.x.get_test_results("unknown"))
+        self.x.builds.get_build("tdb", "myhost", "cc", "13").remove()
+        self.assertEquals([("charis", 1), ("myhost", 0)],
+            [(build.host, result) for (build, result) in
+                self.x.get_test_results("foo")])
+
+    def test_get_flaky_tests(self):
+        self.upload_test_results("tdb", "myhost", "12",
+            [("foo", "success"), ("bar", "failure"), ("baz", "success")], mtime=1200)
+        self.upload_test_results("tdb", "charis", "12",
+            [("foo", "failure"), ("bar", "failure"), ("baz", "success")], mtime=1300)
+        self.upload_test_results("tdb", "myhost", "13",
+            [("foo", "success"), ("bar", "success")], mtime=1400)
+        self.upload_test_results("tdb", "charis", "13",
+            [("foo", "error"), ("bar", "success")], mtime=1500)
+        self.assertEquals([("foo", 2)], list(self.x.get_flaky_tests("tdb")))
+        self.assertEquals([("foo", 1)],
+            list(self.x.get_flaky_tests("tdb", min_age=1350)))
+        self.assertEquals([], list(self.x.get_flaky_tests("talloc")))
+
     def test_get_host_builds_empty(self):
         self.assertEquals([], list(self.x.get_host_builds("myhost")))
 
+    def test_get_host_builds(self):
+        self.upload_mock_logfile(self.x.builds, "tdb", "myhost", "cc",
+            "BUILD COMMIT REVISION: 12\n", mtime=1200)
+        self.upload_mock_logfile(self.x.builds, "tdb", "myhost", "cc",
+            "BUILD COMMIT REVISION: 42\n", mtime=4200)
+        self.upload_mock_logfile(self.x.builds, "tdb", "charis", "cc",
+            "BUILD COMMIT REVISION: 13\n", mtime=1300)
+        self.assertEquals(["42"],
+            [build.revision for build in self.x.get_host_builds("myhost")])
+
+    def test_latest_build_older_upload(self):
+        self.upload_mock_logfile(self.x.builds, "tdb", "myhost", "cc",
+            "BUILD COMMIT REVISION: 42\n", mtime=4200)
+        self.upload_mock_logfile(self.x.builds, "tdb", "myhost", "cc",
+            "BUILD COMMIT REVISION: 12\n", mtime=1200)
+        self.assertEquals(["42"],
+            [build.revision for build in self.x.get_last_builds()])
+
+    def test_latest_build_remove(self):
+        self.upload_mock_logfile(self.x.builds, "tdb", "myhost", "cc",
+            "BUILD COMMIT REVISION: 12\n", mtime=1200)
+        self.upload_mock_logfile(self.x.builds, "tdb", "myhost", "cc",
+            "BUILD COMMIT REVISION: 42\n", mtime=4200)
+        self.x.builds.get_build("tdb", "myhost", "cc", "42").remove()
+        self.assertEquals(["12"],
+            [build.revision for build in self.x.get_last_builds()])
+        self.x.builds.get_build("tdb", "myhost", "cc", "12").remove()
+        self.assertEquals([], list(self.x.get_last_builds()))
+        self.assertEquals([], list(self.x.get_summary_builds()))
+
     def test_lcov_status_none(self):
         self.assertRaises(NoSuchBuildError, self.x.lcov_status, "trivial")
 
@@ -185,3 +381,28 @@ class BuildFarmTests(BuildFarmTestCase):
         self.assertEquals("cc", build.compiler)
         self.assertIs(None, build.revision)
 
+
+    def test_cached_analysis(self):
+        self.upload_mock_logfile(self.x.builds, "tdb", "charis", "cc",
+            stdout_contents="Linux charis\nBUILD COMMIT REVISION: 12\nCFLAGS=-O2\n",
+            stderr_contents="error1\nerror2\n")
+        self.x.commit()
+        build = BuildFarm(self.path).get_build("tdb", "charis", "cc", "12")
+        os.remove(build.basename + ".err")
+        analysis = build.cached_analysis()
+        self.assertEquals("Linux charis", analysis.uname)
+        self.assertEquals("-O2", analysis.cflags)
+        self.assertEquals(2, build.err_count())
+
+    def test_prune_analysis_cache(self):
+        self.upload_mock_logfile(self.x.builds, "tdb", "charis", "cc",
+            stdout_contents="BUILD COMMIT REVISION: 12\n")
+        build = self.x.get_build("tdb", "charis", "cc", "12")
+        self.x.fragments.put(build.log_checksum(), "log.html", "<pre></pre>")
+        self.assertEquals(0, self.x.prune_analysis_cache())
+        build.remove_logs()
+        self.assertEquals(1, self.x.prune_analysis_cache())
+        self.assertIs(None, self.x.fragments.get(build.log_checksum(), "log.html"))
+        self.x.commit()
+        build = BuildFarm(self.path).get_build("tdb", "charis", "cc", "12")
+        self.assertIs(None, build.cached_analysis())
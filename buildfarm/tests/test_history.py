@@ -15,34 +15,288 @@
 #   along with this program; if not, write to the Free Software
 #   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
-from buildfarm.history import GitBranch
+from buildfarm.history import (
+    CommitCache,
+    CommitIndexPool,
+    GitBranch,
+    GitCommitIndex,
+    RepositoryPool,
+    deserialize_changes,
+    serialize_changes,
+    split_author,
+    )
 
 from dulwich.repo import Repo
 
+import os
 import tempfile
+import threading
 from testtools import TestCase
 
 
+class SplitAuthorTests(TestCase):
+
+    def test_email(self):
+        self.assertEquals(("Jelmer Vernooij", "jelmer@samba.org"),
+            split_author("Jelmer Vernooij <jelmer@samba.org>"))
+
+    def test_no_email(self):
+        self.assertEquals(("Jelmer Vernooij", "Jelmer Vernooij"),
+            split_author("Jelmer Vernooij"))
+
+
+class RepositoryPoolTests(TestCase):
+
+    def setUp(self):
+        super(RepositoryPoolTests, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.repo = Repo.init(self.path)
+        self.pool = RepositoryPool()
+
+    def test_reuse(self):
+        repo = self.pool.get(self.path)
+        self.assertEquals(self.path, repo.path)
+        self.assertIs(repo, self.pool.get(self.path))
+
+    def test_refs_changed(self):
+        repo = self.pool.get(self.path)
+        self.repo.do_commit("message", committer="Jelmer Vernooij")
+        os.utime(os.path.join(self.repo.controldir(), "refs", "heads"),
+            (1, 1))
+        self.assertIsNot(repo, self.pool.get(self.path))
+
+    def test_nested_refs_changed(self):
+        revid = self.repo.do_commit("message", committer="Jelmer Vernooij")
+        self.repo.refs["refs/heads/foo/bar"] = revid
+        repo = self.pool.get(self.path)
+        self.repo.refs["refs/heads/foo/bar"] = self.repo.do_commit(
+            "message", committer="Jelmer Vernooij", ref="refs/heads/foo/bar")
+        os.utime(os.path.join(self.repo.controldir(), "refs", "heads", "foo"),
+            (1, 1))
+        self.assertIsNot(repo, self.pool.get(self.path))
+
+    def test_per_thread(self):
+        repos = []
+        t = threading.Thread(target=lambda: repos.append(self.pool.get(self.path)))
+        t.start()
+        t.join()
+        self.assertIsNot(repos[0], self.pool.get(self.path))
+
+
+class CommitIndexPoolTests(TestCase):
+
+    def setUp(self):
+        super(CommitIndexPoolTests, self).setUp()
+        self.path = os.path.join(tempfile.mkdtemp(), "tdb.sqlite")
+        self.pool = CommitIndexPool()
+
+    def test_reuse(self):
+        index = self.pool.get(self.path)
+        self.assertIsInstance(index, GitCommitIndex)
+        self.assertIs(index, self.pool.get(self.path))
+
+    def test_per_thread(self):
+        indexes = []
+        t = threading.Thread(target=lambda: indexes.append(self.pool.get(self.path)))
+        t.start()
+        t.join()
+        self.assertIsNot(indexes[0], self.pool.get(self.path))
+
+
+class CommitCacheTests(TestCase):
+
+    def setUp(self):
+        super(CommitCacheTests, self).setUp()
+        self.path = os.path.join(tempfile.mkdtemp(), "commits")
+        self.cache = CommitCache(self.path, max_size=10)
+
+    def test_get_missing(self):
+        self.assertEquals(None, self.cache.get("a" * 40, "diff"))
+
+    def test_put(self):
+        self.cache.put("a" * 40, "diff", "12345")
+        self.assertEquals("12345", self.cache.get("a" * 40, "diff"))
+        self.assertEquals(None, self.cache.get("a" * 40, "changes"))
+
+    def test_expire_least_recently_used(self):
+        self.cache.put("a" * 40, "diff", "1234")
+        self.cache.put("b" * 40, "diff", "1234")
+        os.utime(os.path.join(self.path, "a" * 40 + ".diff"), (1, 1))
+        os.utime(os.path.join(self.path, "b" * 40 + ".diff"), (2, 2))
+        self.cache.get("a" * 40, "diff")
+        self.cache.put("c" * 40, "diff", "1234")
+        self.assertEquals("1234", self.cache.get("a" * 40, "diff"))
+        self.assertEquals(None, self.cache.get("b" * 40, "diff"))
+        self.assertEquals("1234", self.cache.get("c" * 40, "diff"))
+
+    def test_expire_only_when_full(self):
+        expired = []
+        expire = self.cache.expire
+        def counting_expire():
+            expired.append(True)
+            expire()
+        self.cache.expire = counting_expire
+        self.cache.put("a" * 40, "diff", "1234")
+        self.cache.put("b" * 40, "diff", "1234")
+        self.assertEquals(1, len(expired))
+        self.cache.put("c" * 40, "diff", "1234")
+        self.assertEquals(2, len(expired))
+        self.assertEquals(2, len(os.listdir(self.path)))
+
+    def test_serialize_changes(self):
+        changes = (set(["a", "b c"]), set(["d/e"]), set())
+        self.assertEquals(changes,
+            deserialize_changes(serialize_changes(changes)))
+
+
 class GitBranchTests(TestCase):
 
     def setUp(self):
         super(GitBranchTests, self).setUp()
         self.repo = Repo.init(tempfile.mkdtemp())
 
+    def make_branch(self):
+        return GitBranch(self.repo.path, "master")
+
+    def commit(self, message, timestamp, author="Jelmer <jelmer@samba.org>",
+               **kwargs):
+        return self.repo.do_commit(message, committer=author, author=author,
+            commit_timestamp=timestamp, author_timestamp=timestamp, **kwargs)
+
     def test_log_empty(self):
-        branch = GitBranch(self.repo.path, "master")
+        branch = self.make_branch()
         self.assertEquals([], list(branch.log()))
 
     def test_log_commits(self):
-        branch = GitBranch(self.repo.path, "master")
+        branch = self.make_branch()
         self.repo.do_commit("message", committer="Jelmer Vernooij")
         log = list(branch.log())
         self.assertEquals(1, len(log))
         self.assertEquals("message", log[0].message)
 
     def test_empty_diff(self):
-        branch = GitBranch(self.repo.path, "master")
+        branch = self.make_branch()
         revid = self.repo.do_commit("message", committer="Jelmer Vernooij")
         entry, diff = list(branch.diff(revid))
         self.assertEquals("message", entry.message)
         self.assertEquals("", diff)
+
+    def test_log_no_limit(self):
+        branch = self.make_branch()
+        for i in range(3):
+            self.commit("message %d" % i, 1000 + i)
+        self.assertEquals(["message 2", "message 1", "message 0"],
+            [rev.message for rev in branch.log()])
+
+    def test_log_date_order(self):
+        branch = self.make_branch()
+        base = self.commit("base", 1000)
+        left = self.commit("left", 1002)
+        self.repo.refs["refs/heads/master"] = base
+        right = self.commit("right", 1001)
+        self.commit("merge", 1003, merge_heads=[left])
+        self.assertEquals(["merge", "left", "right", "base"],
+            [rev.message for rev in branch.log()])
+
+    def test_log_exclude_ancestors(self):
+        branch = self.make_branch()
+        self.commit("first", 1000)
+        second = self.commit("second", 1001)
+        third = self.commit("third", 1002)
+        self.commit("fourth", 1003)
+        self.assertEquals(["third"], [rev.message for rev in
+            branch.log(from_rev=third, exclude_revs=set([second]))])
+
+    def test_log_exclude_missing(self):
+        branch = self.make_branch()
+        self.commit("first", 1000)
+        second = self.commit("second", 1001)
+        self.assertEquals([], list(branch.log(from_rev=second,
+            exclude_revs=set(["a" * 40]))))
+
+    def test_log_author_offset_limit(self):
+        branch = self.make_branch()
+        for i in range(6):
+            self.commit("message %d" % i, 1000 + i,
+                author=["A <a@example.com>", "B <b@example.com>"][i % 2])
+        self.assertEquals(["message 2"], [rev.message for rev in
+            branch.log(limit=1, offset=1, author="a@example.com")])
+        self.assertEquals(set(["A <a@example.com>", "B <b@example.com>"]),
+            set(branch.authors()))
+
+
+class IndexedGitBranchTests(GitBranchTests):
+
+    def setUp(self):
+        super(IndexedGitBranchTests, self).setUp()
+        self.index_path = os.path.join(tempfile.mkdtemp(), "history",
+            "tree.sqlite")
+
+    def make_branch(self):
+        return GitBranch(self.repo.path, "master", self.index_path)
+
+    def test_authors_recent(self):
+        branch = self.make_branch()
+        self.commit("old", 1000, author="A <a@example.com>")
+        self.commit("new", 1001, author="B <b@example.com>")
+        self.assertEquals(["B <b@example.com>"], branch.authors(limit=1))
+
+    def test_update_incremental(self):
+        index = GitCommitIndex(self.index_path)
+        self.commit("first", 1000)
+        self.assertTrue(index.update(self.repo, "master"))
+        self.assertFalse(index.update(self.repo, "master"))
+        self.commit("second", 1001)
+        self.commit("third", 1002)
+        self.assertTrue(index.update(self.repo, "master"))
+        self.assertEquals(["third", "second", "first"],
+            [rev.message for rev in index.log()])
+        # The index is persistent.
+        index = GitCommitIndex(self.index_path)
+        self.assertEquals(3, len(index.log()))
+
+    def test_update_rewritten(self):
+        index = GitCommitIndex(self.index_path)
+        first = self.commit("first", 1000)
+        self.commit("second", 1001)
+        index.update(self.repo, "master")
+        self.repo.refs["refs/heads/master"] = first
+        self.commit("replacement", 1002)
+        index.update(self.repo, "master")
+        self.assertEquals(["replacement", "first"],
+            [rev.message for rev in index.log()])
+
+    def test_log_indexed(self):
+        branch = self.make_branch()
+        for i in range(6):
+            self.commit("message %d" % i, 1000 + i,
+                author=["A <a@example.com>", "B <b@example.com>"][i % 2])
+        self.assertEquals(["message 3", "message 1"], [rev.message for rev in
+            branch.log(offset=1, author="b@example.com")])
+
+
+class CachedGitBranchTests(TestCase):
+
+    def setUp(self):
+        super(CachedGitBranchTests, self).setUp()
+        self.repo = Repo.init(tempfile.mkdtemp())
+        self.cache_path = os.path.join(tempfile.mkdtemp(), "commits")
+        self.revid = self.repo.do_commit("message",
+            committer="Jelmer Vernooij")
+
+    def test_changes_summary(self):
+        branch = GitBranch(self.repo.path, "master", cache_path=self.cache_path)
+        changes = branch.changes_summary(self.revid)
+        self.assertEquals(serialize_changes(changes),
+            branch.cache.get(self.revid, "changes"))
+        branch.cache.put(self.revid, "changes", "Afoo\0")
+        self.assertEquals((set(["foo"]), set(), set()),
+            branch.changes_summary(self.revid))
+
+    def test_diff(self):
+        branch = GitBranch(self.repo.path, "master", cache_path=self.cache_path)
+        self.assertEquals("", branch.diff(self.revid)[1])
+        branch.cache.put(self.revid, "diff", "cached")
+        (entry, diff) = branch.diff(self.revid)
+        self.assertEquals("message", entry.message)
+        self.assertEquals("cached", diff)
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# Copyright (C) Jelmer Vernooij <jelmer@samba.org> 2010
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+from buildfarm import BuildFarm
+from buildfarm.importer import (
+    ImportBatch,
+    prepare_build,
+    prepare_builds,
+    )
+from buildfarm.tests import BuildFarmTestCase
+
+import os
+
+
+class PrepareBuildsTests(BuildFarmTestCase):
+
+    def setUp(self):
+        super(PrepareBuildsTests, self).setUp()
+        self.buildfarm = BuildFarm(self.path)
+        self.write_compilers(["cc", "gcc"])
+        self.write_hosts({"charis": "Some machine"})
+        self.write_trees({"tdb": {"scm": "git", "repo": "tdb.git", "branch": "master"},
+                          "talloc": {"scm": "git", "repo": "talloc.git", "branch": "master"}})
+        self.buildfarm.commit()
+        self.create_mock_logfile("tdb", "charis", "cc",
+            contents="BUILD COMMIT REVISION: 12\nCONFIGURE STATUS: 0\n")
+        self.create_mock_logfile("talloc", "charis", "gcc",
+            contents="BUILD COMMIT REVISION: 13\nPANIC: oops\n")
+        self.create_mock_logfile("talloc", "charis", "cc",
+            contents="no revision here\n")
+        self.x = BuildFarm(self.path)
+
+    def summarize(self, results):
+        return sorted([
+            (build.tree, build.compiler, build.analyse().revision,
+             str(build.analyse().status), fragments is not None)
+            for (build, fragments) in results])
+
+    def read_staged(self, fragments):
+        if fragments is None:
+            return None
+        return dict((name, open(path).read())
+            for (name, path) in fragments.iteritems())
+
+    def test_serial(self):
+        results = list(prepare_builds(self.x.get_new_builds(),
+            fragments=self.x.fragments))
+        self.assertEquals([
+            ("talloc", "cc", None, "", False),
+            ("talloc", "gcc", "13", "panic", True),
+            ("tdb", "cc", "12", "0", True)],
+            self.summarize(results))
+
+    def test_no_render(self):
+        results = list(prepare_builds(self.x.get_new_builds()))
+        self.assertEquals([None, None, None],
+            [fragments for (build, fragments) in results])
+
+    def test_parallel_matches_serial(self):
+        builds = list(self.x.get_new_builds())
+        serial = list(prepare_builds(builds, jobs=1,
+            fragments=self.x.fragments))
+        parallel = list(prepare_builds(builds, jobs=2,
+            fragments=self.x.fragments))
+        self.assertEquals(
+            [build.basename for (build, fragments) in serial],
+            [build.basename for (build, fragments) in parallel])
+        self.assertEquals(self.summarize(serial), self.summarize(parallel))
+        self.assertEquals(
+            [build.log_checksum() for (build, fragments) in serial],
+            [build.log_checksum() for (build, fragments) in parallel])
+        self.assertEquals(
+            map(self.read_staged, [fragments for (build, fragments) in serial]),
+            map(self.read_staged, [fragments for (build, fragments) in parallel]))
+
+    def test_staged_not_stored(self):
+        for (build, fragments) in prepare_builds(self.x.get_new_builds(),
+                fragments=self.x.fragments):
+            if fragments is not None:
+                self.assertIs(None,
+                    self.x.fragments.get(build.log_checksum(), "log.html"))
+
+
+class ImportBatchTests(BuildFarmTestCase):
+
+    def setUp(self):
+        super(ImportBatchTests, self).setUp()
+        self.buildfarm = BuildFarm(self.path)
+        self.write_compilers(["cc"])
+        self.write_hosts({"charis": "Some machine"})
+        self.write_trees({"tdb": {"scm": "git", "repo": "tdb.git", "branch": "master"},
+                          "talloc": {"scm": "git", "repo": "talloc.git", "branch": "master"}})
+        self.buildfarm.commit()
+        self.x = BuildFarm(self.path)
+
+    def import_build(self, batch, tree, revision, notify=None):
+        path = self.create_mock_logfile(tree, "charis", "cc",
+            contents="BUILD COMMIT REVISION: %s\n" % revision)
+        upload_build = self.x.get_build(tree, "charis", "cc")
+        batch.add(upload_build, self.x.builds.upload_build(upload_build),
+            notify=notify)
+        return path
+
+    def test_commit_when_full(self):
+        batch = ImportBatch(self.x, max_builds=2)
+        path1 = self.import_build(batch, "tdb", "12")
+        self.assertTrue(os.path.exists(path1))
+        self.assertEquals(0, batch.commits)
+        path2 = self.import_build(batch, "talloc", "13")
+        self.assertFalse(os.path.exists(path1))
+        self.assertFalse(os.path.exists(path2))
+        self.assertEquals(1, batch.commits)
+        self.assertEquals(2, batch.builds)
+        self.assertEquals("12",
+            BuildFarm(self.path).get_build("tdb", "charis", "cc", "12").revision)
+
+    def test_commit_when_expired(self):
+        batch = ImportBatch(self.x, max_builds=10, max_time=0)
+        path = self.import_build(batch, "tdb", "12")
+        self.assertFalse(os.path.exists(path))
+        self.assertEquals(1, batch.commits)
+
+    def test_uncommitted_kept(self):
+        batch = ImportBatch(self.x, max_builds=10)
+        path = self.import_build(batch, "tdb", "12")
+        self.assertTrue(os.path.exists(path))
+        self.assertEquals([], list(BuildFarm(self.path).get_last_builds()))
+        batch.commit()
+        self.assertFalse(os.path.exists(path))
+        self.assertEquals(1, len(list(BuildFarm(self.path).get_last_builds())))
+
+    def test_commit_bumps_data_generation(self):
+        generation = BuildFarm(self.path).data_generation()
+        batch = ImportBatch(self.x, max_builds=10)
+        self.import_build(batch, "tdb", "12")
+        self.assertEquals(generation, BuildFarm(self.path).data_generation())
+        batch.commit()
+        self.assertEquals(generation + 1, BuildFarm(self.path).data_generation())
+
+    def test_notify_after_commit(self):
+        notified = []
+        batch = ImportBatch(self.x, max_builds=2)
+        self.import_build(batch, "tdb", "12", lambda: notified.append("12"))
+        self.assertEquals([], notified)
+        self.import_build(batch, "talloc", "13", lambda: notified.append("13"))
+        self.assertEquals(["12", "13"], notified)
+
+    def test_no_notify_on_failed_commit(self):
+        notified = []
+        batch = ImportBatch(self.x, max_builds=10)
+        self.import_build(batch, "tdb", "12", lambda: notified.append("12"))
+        def commit():
+            raise RuntimeError("database is locked")
+        self.patch(self.x, "commit", commit)
+        self.assertRaises(RuntimeError, batch.commit)
+        self.assertEquals([], notified)
+
+    def stage_build(self, tree, revision):
+        self.create_mock_logfile(tree, "charis", "cc",
+            contents="BUILD COMMIT REVISION: %s\n" % revision)
+        return prepare_build(self.x.get_build(tree, "charis", "cc"),
+            self.x.fragments)
+
+    def test_fragments_stored_after_commit(self):
+        batch = ImportBatch(self.x, max_builds=10)
+        (upload_build, fragments) = self.stage_build("tdb", "12")
+        checksum = upload_build.log_checksum()
+        batch.add(upload_build, self.x.builds.upload_build(upload_build),
+            fragments)
+        self.assertIs(None, self.x.fragments.get(checksum, "log.html"))
+        batch.commit()
+        self.assertIsNot(None, self.x.fragments.get(checksum, "log.html"))
+        self.assertFalse(filter(os.path.exists, fragments.values()))
+
+    def test_fragments_removed_on_failed_commit(self):
+        batch = ImportBatch(self.x, max_builds=10)
+        (upload_build, fragments) = self.stage_build("tdb", "12")
+        batch.add(upload_build, self.x.builds.upload_build(upload_build),
+            fragments)
+        def commit():
+            raise RuntimeError("database is locked")
+        self.patch(self.x, "commit", commit)
+        self.assertRaises(RuntimeError, batch.commit)
+        self.assertFalse(filter(os.path.exists, fragments.values()))
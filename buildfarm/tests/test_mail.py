@@ -51,4 +51,17 @@ class BrokenBuildCheckTests(BuildFarmTestCase):
         self.assertEquals(60, result[1].upload_time)
         self.assertEquals(None, result[2])
 
-
+    def test_broken_build_check_run_of_failures(self):
+        uploaded = []
+        # Every revision fails more tests than the one before it.
+        for (rev, failures, mtime) in [
+                ("8", 0, 10), ("9", 1, 20), ("9", 1, 30), ("10", 2, 40),
+                ("11", 3, 50)]:
+            path = self.create_mock_logfile("tdb", "somehost", "cc",
+                contents="BUILD COMMIT REVISION: %s\nCONFIGURE STATUS: 0\n"
+                    "TEST STATUS: %d\nBuild time: %d\n" % (rev, failures, mtime),
+                mtime=mtime)
+            uploaded.append(self.x.upload_build(
+                Build(path[:-4], "tdb", "somehost", "cc")))
+        result = broken_build_check(self.x, uploaded[-1], "11")
+        self.assertEquals([30, 10, 50], [b.upload_time for b in result])
@@ -18,14 +18,23 @@
 from buildfarm import BuildFarm
 from buildfarm.build import (
     Build,
+    BuildResultStore,
     NoSuchBuildError,
     )
 from buildfarm.tests import BuildFarmTestCase
 from buildfarm.tests.test_hostdb import HostDatabaseTests
 from buildfarm.sqldb import (
+    SCHEMA_UPGRADES,
     StormHostDatabase,
+    add_status_columns,
+    populate_latest_build,
+    schema_version,
+    setup_schema,
+    upgrade_schema,
     )
 
+from storm.tracer import install_tracer, remove_tracer
+import re
 import testtools
 
 
@@ -37,3 +46,170 @@ class StormHostDatabaseTests(testtools.TestCase, HostDatabaseTests):
 
 
 
+
+
+class QueryPlanTracer(object):
+    """Storm tracer that records the query plan of every SELECT."""
+
+    def __init__(self):
+        self.plans = []
+
+    def connection_raw_execute(self, connection, raw_cursor, statement, params):
+        if not statement.lstrip().startswith("SELECT"):
+            return
+        cursor = raw_cursor.connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + statement,
+            tuple(connection.to_database(params)))
+        self.plans.append((statement,
+            "\n".join([row[-1] for row in cursor.fetchall()])))
+
+    def connection_raw_execute_success(self, *args):
+        pass
+
+    def connection_raw_execute_error(self, *args):
+        pass
+
+
+class QueryPlanTests(BuildFarmTestCase):
+
+    def setUp(self):
+        super(QueryPlanTests, self).setUp()
+        self.buildfarm = BuildFarm(self.path)
+        self.write_compilers(["cc"])
+        self.write_hosts({"charis": "Some machine"})
+        self.buildfarm.commit()
+        path = self.create_mock_logfile("tdb", "charis", "cc", contents="""
+BUILD COMMIT REVISION: 12
+""")
+        self.buildfarm.builds.upload_build(Build(path[:-4], "tdb", "charis", "cc"))
+        self.tracer = QueryPlanTracer()
+        install_tracer(self.tracer)
+        self.addCleanup(remove_tracer, self.tracer)
+
+    def assertIndexSeeks(self):
+        self.assertNotEquals([], self.tracer.plans)
+        for (statement, plan) in self.tracer.plans:
+            self.assertNotIn("CAST", statement)
+            # Scanning a subquery result is fine, scanning a table is not.
+            self.assertEquals(None,
+                re.search(r"SCAN (TABLE )?(build|host|latest_build|test|test_result)\b", plan),
+                plan)
+        self.tracer.plans = []
+
+    def test_get_build(self):
+        self.buildfarm.builds.get_build("tdb", "charis", "cc", "12")
+        self.assertIndexSeeks()
+
+    def test_get_by_checksum(self):
+        checksum = self.buildfarm.builds.get_build("tdb", "charis", "cc").checksum
+        self.tracer.plans = []
+        self.buildfarm.builds.get_by_checksum(checksum)
+        self.assertIndexSeeks()
+
+    def test_get_previous_build(self):
+        self.assertRaises(NoSuchBuildError,
+            self.buildfarm.builds.get_previous_build, "tdb", "charis", "cc", "12")
+        self.assertIndexSeeks()
+
+    def test_get_build_history(self):
+        build = self.buildfarm.builds.get_build("tdb", "charis", "cc")
+        self.tracer.plans = []
+        list(self.buildfarm.builds.get_build_history("tdb", "charis", "cc",
+            before=build))
+        self.assertIndexSeeks()
+
+    def test_get_host(self):
+        self.buildfarm.hostdb["charis"]
+        self.assertIndexSeeks()
+
+    def test_get_tree_builds(self):
+        list(self.buildfarm.get_tree_builds("tdb"))
+        self.assertIndexSeeks()
+
+    def test_get_revision_builds(self):
+        list(self.buildfarm.get_revision_builds("tdb", "12"))
+        self.assertIndexSeeks()
+
+    def test_get_old_builds(self):
+        list(self.buildfarm.builds.get_old_builds("tdb", "charis", "cc"))
+        self.assertIndexSeeks()
+
+    def test_get_latest_build(self):
+        self.buildfarm.builds.get_latest_build("tdb", "charis", "cc")
+        self.assertIndexSeeks()
+
+    def test_get_host_builds(self):
+        list(self.buildfarm.get_host_builds("charis"))
+        self.assertIndexSeeks()
+
+    def test_get_test_results(self):
+        self.buildfarm.get_test_results("foo")
+        self.assertIndexSeeks()
+
+    def test_get_flaky_tests(self):
+        list(self.buildfarm.get_flaky_tests("tdb", 100))
+        self.assertIndexSeeks()
+
+
+class SchemaUpgradeTests(BuildFarmTestCase):
+
+    def test_new_database(self):
+        store = BuildFarm(self.path)._get_store()
+        self.assertEquals(len(SCHEMA_UPGRADES), schema_version(store))
+        self.assertEquals([], upgrade_schema(store))
+
+    def test_upgrade(self):
+        store = BuildFarm(self.path)._get_store()
+        store.execute("DROP INDEX build_host_age")
+        store.execute("PRAGMA user_version = 1")
+        self.assertEquals([u.__name__ for u in SCHEMA_UPGRADES[1:]],
+            upgrade_schema(store))
+        self.assertEquals(len(SCHEMA_UPGRADES), schema_version(store))
+        self.assertEquals(1, store.execute("SELECT COUNT(*) FROM sqlite_master "
+            "WHERE type = 'index' AND name = 'build_host_age'").get_one()[0])
+
+    def test_populate_latest_build(self):
+        self.buildfarm = BuildFarm(self.path)
+        self.write_compilers(["cc"])
+        self.write_hosts({"charis": "Some machine"})
+        for (rev, mtime) in [("12", 1200), ("42", 4200), ("13", 1300)]:
+            self.upload_mock_logfile(self.buildfarm.builds, "tdb", "charis", "cc",
+                "BUILD COMMIT REVISION: %s\n" % rev, mtime=mtime)
+        store = self.buildfarm._get_store()
+        store.execute("DELETE FROM latest_build")
+        store.execute("PRAGMA user_version = %d" %
+            SCHEMA_UPGRADES.index(populate_latest_build))
+        upgrade_schema(store)
+        self.assertEquals(["42"],
+            [build.revision for build in self.buildfarm.get_last_builds()])
+
+    def test_add_status_columns(self):
+        self.buildfarm = BuildFarm(self.path)
+        self.write_compilers(["cc"])
+        self.write_hosts({"charis": "Some machine"})
+        self.upload_mock_logfile(self.buildfarm.builds, "tdb", "charis", "cc",
+            "BUILD COMMIT REVISION: 12\nBUILD STATUS: 2\n")
+        store = self.buildfarm._get_store()
+        store.execute("UPDATE build SET failed = NULL, worst_stage = NULL")
+        store.execute("PRAGMA user_version = %d" %
+            SCHEMA_UPGRADES.index(add_status_columns))
+        upgrade_schema(store)
+        self.assertEquals([(1, 0, 0)], list(store.execute(
+            "SELECT failed, panic, worst_stage FROM build")))
+
+
+class NormalizeColumnTypesTests(BuildFarmTestCase):
+
+    def test_text_values(self):
+        store = BuildFarm(self.path)._get_store()
+        store.execute("INSERT INTO host (name) VALUES ('charis')")
+        store.execute("INSERT INTO build (tree, host, compiler, revision, checksum) "
+                      "VALUES ('tdb', 'charis', 'cc', '12', 'abcdef')")
+        store.execute("PRAGMA user_version = 0")
+        setup_schema(store)
+        self.assertEquals([("blob", "blob", "blob", "blob", "blob")],
+            list(store.execute("SELECT typeof(tree), typeof(host), "
+                "typeof(compiler), typeof(revision), typeof(checksum) FROM build")))
+        builds = BuildResultStore(self.path, store)
+        self.assertEquals("12", builds.get_by_checksum("abcdef").revision)
+        self.assertEquals("charis", StormHostDatabase(store)["charis"].name)
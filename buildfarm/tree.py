@@ -19,7 +19,11 @@
 #   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 
-from buildfarm.history import GitBranch
+from buildfarm.history import (
+    GitBranch,
+    commit_indexes,
+    repositories,
+    )
 import os
 
 GIT_ROOT = "/data/git"
@@ -28,7 +32,10 @@ GIT_ROOT = "/data/git"
 class Tree(object):
     """A tree to build."""
 
-    def __init__(self, name, scm, repo, branch, subdir="", srcdir=""):
+    history_dir = None
+
+    def __init__(self, name, scm, repo, branch, subdir="", srcdir="",
+                 history_dir=None):
         self.name = name
         self.repo = repo
         self.scm = scm
@@ -36,10 +43,21 @@ class Tree(object):
         self.subdir = subdir
         self.srcdir = srcdir
         self.scm = scm
+        self.history_dir = history_dir
 
     def get_branch(self):
         if self.scm == "git":
-            return GitBranch(os.path.join(GIT_ROOT, self.repo), self.branch)
+            if self.history_dir is not None:
+                index = commit_indexes.get(os.path.join(self.history_dir,
+                    "%s.sqlite" % self.name))
+                # Commits are shared between trees, so they share the cache.
+                cache_path = os.path.join(self.history_dir, "commits")
+            else:
+                index = None
+                cache_path = None
+            path = os.path.join(GIT_ROOT, self.repo)
+            return GitBranch(path, self.branch, index=index,
+                cache_path=cache_path, repo=repositories.get(path))
         else:
             raise NotImplementedError(self.scm)
 
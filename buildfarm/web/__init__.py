@@ -43,23 +43,192 @@ from buildfarm.build import (
     LogFileMissing,
     NoSuchBuildError,
     NoTestOutput,
+    TestResultsDiff,
     )
+from buildfarm.history import split_author
 
 import cgi
+from cStringIO import StringIO
+from email.utils import formatdate, mktime_tz, parsedate_tz
+import hashlib
+import json
 from pygments import highlight
 from pygments.lexers.text import DiffLexer
 from pygments.formatters import HtmlFormatter
 import re
+import struct
+import tempfile
 import time
+import zlib
 
 import wsgiref.util
 webdir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "web"))
 
 GITWEB_BASE = "//gitweb.samba.org"
 HISTORY_HORIZON = 1000
+# Size of the chunks in which logs are sent
+CHUNK_SIZE = 64 * 1024
+
+def iter_file(f, chunk_size=CHUNK_SIZE, escape=False):
+    """Iterate over the contents of a file in chunks, closing it afterwards.
+
+    :param escape: Whether to HTML-escape the contents
+    """
+    try:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            if escape:
+                data = cgi.escape(data)
+            yield data
+    finally:
+        f.close()
+
+
+def file_range(f, start, length):
+    """Iterate over a range of a file in chunks, closing it afterwards."""
+    try:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def gzip_chunks(chunks, level=6):
+    """Compress a sequence of chunks in gzip format."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def gzip_size(f):
+    """Return the uncompressed size of a gzip file, as stored in its
+    trailer."""
+    f.seek(-4, 2)
+    (size, ) = struct.unpack("<I", f.read(4))
+    f.seek(0)
+    return size
+
+
+def gunzip_range(f, start, length):
+    """Iterate over a range of the uncompressed contents of a gzip file,
+    closing it afterwards."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    position = 0
+    end = start + length
+    try:
+        while position < end:
+            compressed = f.read(CHUNK_SIZE)
+            if compressed:
+                data = decompressor.decompress(compressed)
+            else:
+                data = decompressor.flush()
+            data_end = position + len(data)
+            if data_end > start:
+                data = data[max(start - position, 0):end - position]
+                if data:
+                    yield data
+            position = data_end
+            if not compressed:
+                break
+    finally:
+        f.close()
+
+
+def parse_range(header, size):
+    """Parse the value of a Range header.
+
+    Only single byte ranges are supported.
+
+    :param size: Size of the resource
+    :return: Tuple with the start and length of the range, or None if the
+        header isn't a supported range and should be ignored
+    :raise ValueError: if the range can't be satisfied
+    """
+    m = re.match(r"^bytes=(\d*)-(\d*)$", header.strip())
+    if m is None or (m.group(1) == "" and m.group(2) == ""):
+        return None
+    if m.group(1) == "":
+        # The last N bytes
+        length = min(int(m.group(2)), size)
+        if length == 0:
+            raise ValueError(header)
+        return (size - length, length)
+    start = int(m.group(1))
+    if start >= size:
+        raise ValueError(header)
+    if m.group(2) == "":
+        end = size - 1
+    else:
+        end = min(int(m.group(2)), size - 1)
+        if end < start:
+            return None
+    return (start, end - start + 1)
+
+
+def accepts_gzip(environ):
+    """Check whether the client accepts gzip-encoded responses."""
+    for coding in environ.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        params = coding.split(";")
+        if params[0].strip().lower() not in ("gzip", "x-gzip"):
+            continue
+        for param in params[1:]:
+            param = param.strip()
+            if param.startswith("q="):
+                try:
+                    return float(param[2:]) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def find_log_config(f):
+    """Find the host details in a build log.
+
+    :param f: Build log, as a file-like object
+    :return: Tuple with the uname, CFLAGS and configure options, each of
+        which is None if not found
+    """
+    uname = None
+    cflags = None
+    config = None
+    for (i, line) in enumerate(f):
+        line = line.rstrip("\n")
+        if i == 0:
+            uname = line
+        if cflags is None:
+            m = re.search("CFLAGS=(.*)", line)
+            if m:
+                cflags = m.group(1)
+        if config is None:
+            m = re.search("configure options: (.*)", line)
+            if m:
+                config = m.group(1)
+        if cflags is not None and config is not None:
+            break
+    return (uname, cflags, config)
+
+
+def file_response(environ, f):
+    """Return a WSGI response body that sends the contents of a file.
+
+    Regular files are passed to the server's wsgi.file_wrapper, if it has
+    one; compressed files are decompressed a chunk at a time.
+    """
+    if isinstance(f, file) and 'wsgi.file_wrapper' in environ:
+        return environ['wsgi.file_wrapper'](f, CHUNK_SIZE)
+    return iter_file(f)
 
-# this is automatically filled in
-deadhosts = []
 
 def select(name, values, default=None):
     yield "<select name='%s'>" % name
@@ -178,157 +347,420 @@ def subunit_to_buildfarm_result(subunit_result):
         return "unknown"
 
 
+def render_test_results_diff(diff):
+    """Describe the differences in test results between two builds as text.
+
+    :param diff: A `TestResultsDiff`
+    """
+    if not diff:
+        yield "No changes in test results.\n"
+        return
+    for (title, names) in [
+            ("Newly failing tests", diff.newly_failing),
+            ("Newly passing tests", diff.newly_passing),
+            ("Newly skipped tests", diff.newly_skipped),
+            ("Tests no longer run", diff.removed)]:
+        if not names:
+            continue
+        yield "%s (%d):\n" % (title, len(names))
+        for name in names:
+            yield "  %s\n" % name
+        yield "\n"
+
+
 def format_subunit_reason(reason):
     reason = re.sub("^\[\n+(.*?)\n+\]$", "\\1", reason)
     return "<div class=\"reason\">%s</div>" % reason
 
 
+def keyword_pattern(words):
+    """Build a regular expression that matches any of a set of words.
+
+    The words are merged into a trie, so the expression only has to
+    follow one branch for every character it looks at.
+    """
+    if "" in words:
+        return ""
+    children = {}
+    for word in words:
+        children.setdefault(word[0], []).append(word[1:])
+    branches = [re.escape(c) + keyword_pattern(rest)
+                for (c, rest) in sorted(children.items())]
+    if len(branches) == 1:
+        return branches[0]
+    return "(?:%s)" % "|".join(branches)
+
+
 class FailedBuildSearch(object):
+    """Highlight the lines of a log that mention errors or warnings.
 
-    def highlight_errors(self, m):
+    A line is classified by the first group of keywords it contains.  Lines
+    containing any keyword at all are found by a single scan over the
+    lowercased log, so only those lines are looked at separately.
+    """
 
-        if m.group(9) or m.group(12):
-            return "<br><font color='red'><b>" + m.group() + "</b></font><br>"
-        elif m.group(15):
-            return "<font color='blue'><b>" + m.group() + "</b></font>"
-        else:
-            return m.group()
+    # lines with html in them are left alone
+    html = "<.?div"
+
+    # (keywords, keywords at the start of a line, format) in order of
+    # precedence; lines that mention success are left alone.
+    keywords = [
+        (["error_", "failed_", " pass", "success", "copyright"], ["pass"], None),
+        ([" error"], ["error"], "<br><font color='red'><b>%s</b></font><br>"),
+        ([" fail"], ["fail"], "<br><font color='red'><b>%s</b></font><br>"),
+        (["warning", " skip", " unknown", " no ", " not ", "severe", " fault",
+          " invalid", " incorrect", "unable ", "cannot ", "conflict",
+          " corrupt", " missing", "abort", "denied", " terminate", "overflow",
+          " wrong ", "forbidden", "disabled", "disconnect", "unavailable",
+          "undefined", " unresolved", "problem", "exception"], ["none", "skip"],
+         "<font color='blue'><b>%s</b></font>"),
+        ]
+
+    def __init__(self):
+        self.categories = [(re.compile(self.html), None)]
+        words = []
+        first_words = []
+        for (inline, first, format) in self.keywords:
+            self.categories.append((re.compile("|".join(
+                [re.escape(w) for w in inline] +
+                ["^" + re.escape(w) for w in first])), format))
+            words.extend(inline)
+            first_words.extend(first)
+        self.any_keyword = re.compile("%s|^%s|%s" % (self.html,
+            keyword_pattern(first_words), keyword_pattern(words)), re.M)
+
+    def highlight_line(self, line, lowered):
+        for (pattern, format) in self.categories:
+            if pattern.search(lowered):
+                if format is None:
+                    return line
+                return format % line
+        return line
 
     def find_errors(self, highlightedlog):
+        lowered = highlightedlog.lower()
+        ret = []
+        pos = 0
+        m = self.any_keyword.search(lowered)
+        while m is not None:
+            start = lowered.rfind("\n", pos, m.start()) + 1
+            end = lowered.find("\n", m.end())
+            if end == -1:
+                end = len(lowered)
+            ret.append(highlightedlog[pos:start])
+            ret.append(self.highlight_line(highlightedlog[start:end],
+                                           lowered[start:end]))
+            pos = end
+            m = self.any_keyword.search(lowered, end)
+        ret.append(highlightedlog[pos:])
+        return "".join(ret)
 
-        highlightedlog = re.sub("""(^.*<.?div.*$)|((^.*error_.*$)|(^.*failed_.*$)|(^pass.*$)|(^.* pass.*$)|(^.*success.*$)|(^.*copyright.*$))|((^.* error.*$)|(^error.*$))|((^.* fail.*$)|(^fail.*$))|((^.*warning.*$)|(^none.*$)|(^.* skip.*$)|(^skip.*$)|(^.* unknown.*$)|(^.* no .*$)|(^.* not .*$)|(^.*severe.*$)|(^.* fault.*$)|(^.* invalid.*$)|(^.* incorrect.*$)|(^.*unable .*$)|(^.*cannot .*$)|(^.*conflict.*$)|(^.* corrupt.*$)|(^.* missing.*$)|(^.*abort.*$)|(^.*denied.*$)|(^.* terminate.*$)|(^.*overflow.*$)|(^.* wrong .*$)|(^.*forbidden.*$)|(^.*disabled.*$)|(^.*disconnect.*$)|(^.*unavailable.*$)|(^.*undefined.*$)|(^.* unresolved.*$)|(^.*problem.*$)|(^.*exception.*$))""", self.highlight_errors, highlightedlog, 0, re.M|re.I)
 
-        return highlightedlog
+class LogPrettyPrinter(object):
+    """Turn a CGI-escaped build log into collapsible HTML.
 
+    The log is read line by line in a single pass.  Actions are split off
+    first; the lines of every action, and the lines outside of any action,
+    then run through a chain of small state machines that split off the
+    output before the first testsuite, skipped testsuites and testsuites.
+    Lines are only held back while a section is waiting for its end marker.
+    """
 
-class LogPrettyPrinter(object):
+    action_start = re.compile("Running action\s+([\w\-]+)$")
+    action_end = re.compile("ACTION (PASSED|FAILED): ([\w\-]+)$")
+    pretest_end = re.compile("(?:skip-)?testsuite: ")
+    skip_testsuite = re.compile("skip-testsuite: ([\w\-=,_:\ /.&; \(\)]+)")
+    testsuite_start = re.compile("testsuite: (.+)$")
+    testsuite_end = re.compile("testsuite-(\w+): ")
+    failed_status = re.compile("(failed)|(error)|(warning)|(mistake)", re.I)
 
     def __init__(self):
-        """using a list with five fields the frst one for the original log file, the second one for the passed collapsible html,
-           the third list for storing failed collapsible html the fourth and fifth are for temporarily storing the passed
-           and failed collapsible html when the substitution was taking place. various patterns are compiled and sent to organise
-           results from where the respective functions are called the collapsible parts are classified and finally the results
-           are organised
-        """
         self.indice = 0
-        self.collapsiblelog = ['', '', '']
-        self.templogstore = ['','']
+        self.test_links = []
 
+    def _split_actions(self, lines):
+        """Split the actions off the lines of a log.
 
-    def organise_results(self, pattern, function):
-        for i in range(3):
-            self.collapsiblelog[i] = pattern.sub(function, self.collapsiblelog[i])
+        An action runs from its "Running action" line up to the first
+        "ACTION PASSED" or "ACTION FAILED" line; an action that is never
+        finished stays part of the log.
 
-        self.collapsiblelog[2] += self.templogstore[1]
-        self.templogstore[1] = ''
-        self.collapsiblelog[1] += self.templogstore[0]
-        self.templogstore[0] = ''
+        :return: Tuple with the remaining lines and a list of
+            (name, status, lines) tuples for the actions
+        """
+        rest = []
+        actions = []
+        start = None
+        for line in lines:
+            if start is None:
+                m = self.action_start.search(line)
+                if m is None:
+                    rest.append(line)
+                else:
+                    start = (line, m.start(), m.group(1))
+                    body = [line[m.start():]]
+                continue
+            body.append(line)
+            m = self.action_end.match(line)
+            if m is not None:
+                rest.append(start[0][:start[1]])
+                actions.append((start[2], m.group(1), body))
+                start = None
+        if start is not None:
+            rest.append(start[0])
+            rest.extend(body[1:])
+        return (rest, actions)
+
+    def _scan_pretests(self, lines, pretests):
+        """Split off the output of a test action before its first testsuite.
+
+        The "testsuite: " marker that ends the pretest output is removed
+        along with it.
+        """
+        start = None
+        for line in lines:
+            offset = 0
+            if start is not None:
+                m = self.pretest_end.match(line)
+                if m is None:
+                    body.append(line)
+                    continue
+                pretests.append((body, m.group()))
+                line = start[0][:start[1]] + line[m.end():]
+                offset = start[1]
+                start = None
+            i = line.find("Running action test", offset)
+            if i == -1:
+                yield line
+            else:
+                start = (line, i)
+                body = []
+        if start is not None:
+            yield start[0]
+            for line in body:
+                yield line
+
+    def _scan_skipped(self, lines, skipped):
+        """Remove skip-testsuite markers, collecting the skipped testsuites."""
+        def skip(m):
+            skipped.append(m.group(1))
+            return ''
+        for line in lines:
+            if "skip-testsuite: " in line:
+                line = self.skip_testsuite.sub(skip, line)
+            yield line
+
+    def _scan_testsuites(self, lines, testsuites, anchored=True):
+        """Split off testsuites, including the reason of failed testsuites.
+
+        A testsuite leaves an empty line behind.  Lines read while looking
+        for the end of a reason that turns out not to have one are scanned
+        again.
+
+        :param anchored: Whether the first line starts a line in the log
+        """
+        lines = iter(lines)
+        pending = []
+        start = None
+        result = None
+        closed = True
+        while True:
+            if pending:
+                line = pending.pop()
+            else:
+                line = next(lines, None)
+                if line is None:
+                    if result is not None:
+                        # There is no end to the reason
+                        testsuites.append(start[1:] + (body, result, None))
+                        yield ''
+                        pending = reason[::-1]
+                        start = result = None
+                        closed = False
+                        continue
+                    if start is not None:
+                        yield start[0]
+                        for line in body:
+                            yield line
+                    return
+            if result is not None:
+                if line == "]":
+                    testsuites.append(start[1:] + (body, result,
+                        "[\n%s]" % "".join([l + "\n" for l in reason])))
+                    yield ''
+                    start = result = None
+                else:
+                    reason.append(line)
+            elif start is not None:
+                m = self.testsuite_end.match(line)
+                if m is None:
+                    body.append(line)
+                elif closed and len(line) > m.end() and line.endswith("["):
+                    result = m.group(1)
+                    reason = []
+                else:
+                    testsuites.append(start[1:] + (body, m.group(1), None))
+                    yield ''
+                    start = None
+            else:
+                m = anchored and self.testsuite_start.match(line)
+                if m:
+                    start = (line, m.group(1))
+                    body = []
+                else:
+                    yield line
+            anchored = True
 
-    def classify_collapsible_html(self, collapsiblehtml, status):
-        match = re.match("(failed)|(error)|(warning)|(mistake)",status, re.I)
-        if match:
-            self.templogstore[1] += collapsiblehtml
-        else:
-            self.templogstore[0] += collapsiblehtml
-        return ''
- 
-    def _pretty_print(self, m):
-        output = m.group(1)
-        actionName = m.group(2)
-        status = m.group(3)
-        # handle pretty-printing of static-analysis tools
-        if actionName == 'cc_checker':
-             output = print_log_cc_checker(output)
+    def _scan(self, lines, anchored=True):
+        """Scan the lines of an action, or those outside of the actions.
 
-        self.indice += 1
-        return  self.classify_collapsible_html("".join(make_collapsible_html('action', actionName, output, self.indice, status)), m.group(3))
+        :return: Tuple with the remaining lines, a list of (body, marker)
+            tuples for pretest output, a list of skipped testsuite names and
+            a list of (name, body, result, reason) tuples for testsuites.
+        """
+        pretests = []
+        skipped = []
+        testsuites = []
+        lines = list(self._scan_testsuites(
+            self._scan_skipped(self._scan_pretests(lines, pretests), skipped),
+            testsuites, anchored))
+        return (lines, pretests, skipped, testsuites)
 
-    # log is already CGI-escaped, so handle '>' in test name by handling &gt
-    def _format_stage(self, m):
-        self.indice += 1
-        return  self.classify_collapsible_html("".join(make_collapsible_html('test', m.group(1), m.group(2), self.indice, m.group(3))), m.group(3))
+    def pretty_print(self, log):
+        """Pretty-print a log.
 
-    def _format_skip_testsuite(self, m):
-        self.indice += 1
-        collapsiblehtml = "".join(make_collapsible_html('test', m.group(1), '', self.indice, 'skipped'))
-        self.templogstore[0] += collapsiblehtml
-        return ''
+        Sections are looked for within each action, so a testsuite that is
+        never finished no longer swallows the actions that follow it.
 
-    def _format_pretestsuite(self, m):
-        self.indice += 1
-        self.templogstore[0] += "".join(make_collapsible_html('pretest', 'Pretest infos', m.group(1) + "\n" + m.group(2) + "\n" + m.group(3) , self.indice, 'ok'))
-        #since status is ok
-        return ''
-
-    def _format_testsuite(self, m):
-        testName = m.group(1)
-        content = m.group(2)
-        status = subunit_to_buildfarm_result(m.group(3))
-        if m.group(4):
-            errorReason = format_subunit_reason(m.group(4))
-        else:
-            errorReason = ""
+        :param log: CGI-escaped contents of the build log
+        :return: List with the HTML for the passed and the failed parts
+        """
+        (lines, actions) = self._split_actions(log.split("\n"))
+        (lines, pretests, skipped, testsuites) = self._scan(lines)
+        passed = []
+        failed = []
+        failed_parts = []
+        passed_parts = [(pretests, skipped, testsuites)]
+        for (actionName, status, body) in actions:
+            # handle pretty-printing of static-analysis tools
+            if actionName == 'cc_checker':
+                body = print_log_cc_checker("\n".join(body)).split("\n")
+            self.indice += 1
+            (body, pretests, skipped, testsuites) = self._scan(body, False)
+            html = make_collapsible_html('action', actionName, "\n".join(body),
+                self.indice, status, strip=False)
+            if status == "FAILED":
+                failed.extend(html)
+                failed_parts.append((pretests, skipped, testsuites))
+            else:
+                passed.extend(html)
+                passed_parts.append((pretests, skipped, testsuites))
+        parts = passed_parts + failed_parts
+
+        pretest_skipped = []
+        for (pretests, skipped, testsuites) in parts:
+            for (body, marker) in pretests:
+                self.indice += 1
+                body = "".join([l + "\n" for l in
+                    self._scan_skipped(body, pretest_skipped)])
+                passed.extend(make_collapsible_html('pretest', 'Pretest infos',
+                    "Running action test\n%s\n%s" % (body, marker),
+                    self.indice, 'ok'))
+
+        skipped = [part[1] for part in passed_parts]
+        skipped.append(pretest_skipped)
+        skipped.extend([part[1] for part in failed_parts])
+        for names in skipped:
+            for name in names:
+                self.indice += 1
+                passed.extend(make_collapsible_html('test', name, '',
+                    self.indice, 'skipped'))
+
+        tests = []
+        for (pretests, skipped, testsuites) in parts:
+            for (testName, body, result, reason) in testsuites:
+                status = subunit_to_buildfarm_result(result)
+                if reason is not None:
+                    errorReason = format_subunit_reason(reason)
+                else:
+                    errorReason = ""
+                self.indice += 1
+                backlink = ""
+                if result in ("error", "failure"):
+                    self.test_links.append([testName, 'lnk-test-%d' % self.indice])
+                    backlink = "<br><p><a href='#shortcut2errors'>back to error list</a>"
+                html = make_collapsible_html('test', testName,
+                    "".join([l + "\n" for l in body]) + errorReason + backlink,
+                    self.indice, status)
+                if self.failed_status.match(status):
+                    tests.extend(html)
+                else:
+                    passed.extend(html)
+        failed.extend(tests)
+
+        buf = "".join(["\n<A href='#%s'>%s</A>" % (tst[1], tst[0])
+            for tst in self.test_links])
+        if buf:
+            failed.insert(0, "".join(make_collapsible_html('action',
+                'Shortcut to failed tests', "<a name='shortcut2errors'></a>%s" % buf,
+                self.indice, "failed")) + "\n")
         self.indice += 1
-        backlink = ""
-        if m.group(3) in ("error", "failure"):
-            self.test_links.append([testName, 'lnk-test-%d' %self.indice])
-            backlink = "<br><p><a href='#shortcut2errors'>back to error list</a>"
-        return  self.classify_collapsible_html("".join(make_collapsible_html('test', testName, content+errorReason+backlink, self.indice, status)), status)
+        passed.extend(make_collapsible_html('action', "Other Details",
+            "\n%s" % "\n".join(lines), self.indice, "passed"))
+        return ["".join(passed), "".join(failed)]
 
-    def _format_test(self, m):
-        self.indice += 1
-        return  self.classify_collapsible_html("".join(make_collapsible_html('test', m.group(1), m.group(2)+format_subunit_reason(m.group(4)), self.indice, subunit_to_buildfarm_result(m.group(3)))), subunit_to_buildfarm_result(m.group(3)))
 
-    def pretty_print(self, log):
-        # do some pretty printing for the actions
-        self.collapsiblelog[0] = log
-        pattern = re.compile("(Running action\s+([\w\-]+)$(?:\s^.*$)*?\sACTION\ (PASSED|FAILED):\ ([\w\-]+)$)", re.M)
-        self.organise_results(pattern, self._pretty_print)
-        buf = ""
-
-        pattern = re.compile("""
-                     --==--==--==--==--==--==--==--==--==--==--.*?
-                     Running\ test\ ([\w\-=,_:\ /.&;]+).*?
-                     --==--==--==--==--==--==--==--==--==--==--
-                         (.*?)
-                     ==========================================.*?
-                     TEST\ (FAILED|PASSED|SKIPPED):.*?
-                     ==========================================\s+
-                  """)
-        self.organise_results(pattern, self._format_stage)
-
-        pattern = re.compile("(Running action test).*$\s((?:^.*$\s)*?)^((?:skip-)?testsuite: )", re.M)
-        self.organise_results(pattern, self._format_pretestsuite)
-
-        pattern = re.compile("skip-testsuite: ([\w\-=,_:\ /.&; \(\)]+).*?")
-        self.organise_results(pattern, self._format_skip_testsuite)
+def print_log_pretty(log):
+    return LogPrettyPrinter().pretty_print(log)
 
-        self.test_links = []
-        pattern = re.compile("^testsuite: (.+)$\s((?:^.*$\s)*?)testsuite-(\w+): .*?(?:(\[$\s(?:^.*$\s)*?^\]$)|$)", re.M)
-        self.organise_results(pattern, self._format_testsuite)
-
-        pattern = re.compile("""
-                     ^test: ([\w\-=,_:\ /.&; \(\)]+).*?
-                     (.*?)
-                     (success|xfail|failure|skip|uxsuccess): [\w\-=,_:\ /.&; \(\)]+( \[.*?\])?.*?
-                  """)
-        self.organise_results(pattern, self._format_test)
-
-        for tst in self.test_links:
-            buf = "%s\n<A href='#%s'>%s</A>" % (buf, tst[1], tst[0])
-
-        if not buf == "":
-            divhtml = "".join(make_collapsible_html('action', 'Shortcut to failed tests', "<a name='shortcut2errors'></a>%s" % buf, self.indice, "failed")) + "\n"
-            self.collapsiblelog[2] = divhtml + self.collapsiblelog[2]
-        self.indice += 1
-        self.collapsiblelog[1] +=  "".join(make_collapsible_html('action', "Other Details", "\n%s" % self.collapsiblelog[0] , self.indice, "passed"))
 
-        log = [self.collapsiblelog[1], self.collapsiblelog[2]]
-        return log
+def render_log_html(log):
+    """Render the enhanced view of a build log.
+
+    :param log: CGI-escaped contents of the build log
+    :return: Tuple with the HTML for the build log and for its failed parts
+    """
+    collapsiblelog = print_log_pretty(log)
+    if collapsiblelog[1] != '':
+        failed = FailedBuildSearch().find_errors(collapsiblelog[1])
+    else:
+        failed = ''
+    return (collapsiblelog[0], failed)
+
 
+def render_build_html(build):
+    """Render the cacheable HTML fragments for the logs of a build.
 
-def print_log_pretty(log):
-    return LogPrettyPrinter().pretty_print(log)
+    :return: Dictionary mapping fragment names to HTML
+    """
+    f = build.read_log()
+    try:
+        log = f.read()
+    finally:
+        f.close()
+    f = build.read_err()
+    try:
+        err = f.read()
+    finally:
+        f.close()
+    (log_html, failed_html) = render_log_html(cgi.escape(log))
+    return {
+        "log.html": log_html,
+        "failed.html": failed_html,
+        "err.html": cgi.escape(err),
+        }
+
+
+def cache_build_html(buildfarm, build, fragments=None):
+    """Store the rendered logs of a build in the fragment cache.
+
+    :param fragments: Fragments previously returned by `render_build_html`
+    """
+    if fragments is None:
+        fragments = render_build_html(build)
+    checksum = build.log_checksum()
+    for name, html in fragments.iteritems():
+        buildfarm.fragments.put(checksum, name, html)
 
 
 def print_log_cc_checker(input):
@@ -388,16 +820,18 @@ def print_log_cc_checker(input):
     return output
 
 
-def make_collapsible_html(type, title, output, id, status=""):
+def make_collapsible_html(type, title, output, id, status="", strip=True):
     """generate html for a collapsible section of log as it is already in pre
 
     :param type: the logical type of it. e.g. "test" or "action"
     :param title: the title to be displayed
+    :param strip: whether to trim leading and trailing whitespace of output
     """
     icon = '/icon_unhide_16.png'
 
     # trim leading and trailing whitespace
-    output = output.strip()
+    if strip:
+        output = output.strip()
 
     # note that we may be inside a <pre>, so we don't put any extra whitespace
     # in this html
@@ -489,6 +923,21 @@ class ViewBuildPage(BuildFarmPage):
 
         yield "<p><a href='%s/limit/-1'>Show all previous build list</a>\n" % (build_uri(myself, build))
 
+    def _render_plain_log(self, f, title, id, missing):
+        chunks = iter_file(f, escape=True)
+        first = next(chunks, "")
+        if first == "":
+            yield '<h2>%s</h2>' % missing
+            yield "<br>"
+            return
+        yield '<h2>%s:</h2>\n' % title
+        yield '<div id="%s"><pre>' % id
+        yield first
+        for chunk in chunks:
+            yield chunk
+        yield ' \n </pre></div>'
+        yield "<br>"
+
     def render(self, myself, build, plain_logs=False, limit=10):
         """view one build in detail"""
 
@@ -496,34 +945,69 @@ class ViewBuildPage(BuildFarmPage):
         cflags = None
         config = None
 
-        try:
-            f = build.read_log()
+        # The plain view streams the logs, the enhanced view uses the HTML
+        # cached at import time. Only if that is missing does the whole log
+        # have to be read.
+        log = None
+        err = None
+        log_html = None
+        failed_html = None
+        if not plain_logs:
+            checksum = build.log_checksum()
+            failed_html = self.buildfarm.fragments.get(checksum, "failed.html")
+            err = self.buildfarm.fragments.get(checksum, "err.html")
+            f = self.buildfarm.fragments.open(checksum, "log.html")
+            if f is not None and failed_html is not None:
+                if os.fstat(f.fileno()).st_size == 0:
+                    f.close()
+                    log_html = []
+                else:
+                    log_html = iter_file(f)
+            else:
+                if f is not None:
+                    f.close()
+                try:
+                    f = build.read_log()
+                    try:
+                        log = f.read()
+                    finally:
+                        f.close()
+                except LogFileMissing:
+                    log = ""
+                (log_html, failed_html) = render_log_html(cgi.escape(log))
+                if log_html == '':
+                    log_html = []
+                else:
+                    log_html = [log_html]
+            if err is None:
+                f = build.read_err()
+                try:
+                    err = cgi.escape(f.read())
+                finally:
+                    f.close()
+
+        analysis = build.cached_analysis()
+        if analysis is not None:
+            (uname, cflags, config) = (analysis.uname, analysis.cflags,
+                analysis.config)
+        elif log is not None:
+            (uname, cflags, config) = find_log_config(StringIO(log))
+        else:
             try:
-                log = f.read()
-            finally:
-                f.close()
-        except LogFileMissing:
-            log = None
-        f = build.read_err()
-        try:
-            err = f.read()
-        finally:
-            f.close()
-
-        if log:
-            log = cgi.escape(log)
-
-            m = re.search("(.*)", log)
-            if m:
-                uname = m.group(1)
-            m = re.search("CFLAGS=(.*)", log)
-            if m:
-                cflags = m.group(1)
-            m = re.search("configure options: (.*)", log)
-            if m:
-                config = m.group(1)
-
-        err = cgi.escape(err)
+                f = build.read_log()
+            except LogFileMissing:
+                pass
+            else:
+                try:
+                    (uname, cflags, config) = find_log_config(f)
+                finally:
+                    f.close()
+        if uname is not None:
+            uname = cgi.escape(uname)
+        if cflags is not None:
+            cflags = cgi.escape(cflags)
+        if config is not None:
+            config = cgi.escape(config)
         yield '<h2>Host information:</h2>'
 
         host_web_file = "../web/%s.html" % build.host
@@ -578,12 +1062,9 @@ class ViewBuildPage(BuildFarmPage):
             # These can be pretty wide -- perhaps we need to
             # allow them to wrap in some way?
 
-            if log is not None:
-                collapsiblelog = print_log_pretty(log)
-
-            if collapsiblelog[1] != '':
+            if failed_html != '':
                     yield "<h2>Failed part:</h2>"
-                    yield FailedBuildSearch().find_errors(collapsiblelog[1])
+                    yield failed_html
 
             if err == "":
                 yield "<h2>No error log available</h2>\n"
@@ -593,12 +1074,13 @@ class ViewBuildPage(BuildFarmPage):
                 yield "".join(make_collapsible_html('action', "Error Output", "\n%s\n" % err, "stderr-0", "errorlog"))
                 yield "<br>"
 
-            if collapsiblelog[0] == '':
+            if not log_html:
                 yield "<h2>No build log available</h2>"
                 yield "<br>"
             else:
                 yield "<h2>Build log:</h2>\n"
-                yield collapsiblelog[0]
+                for chunk in log_html:
+                    yield chunk
 
             yield "<p><small>Some of the above icons derived from the <a href='https://www.gnome.org'>Gnome Project</a>'s stock icons.</small></p>"
             yield "</div>"
@@ -607,20 +1089,16 @@ class ViewBuildPage(BuildFarmPage):
             yield "<p>Switch to the <a href='%s?function=View+Build;host=%s;tree=%s;"\
                   "compiler=%s%s' title='Switch to colourful, javascript-enabled, styled"\
                   " view'>Enhanced View</a></p>" % (myself, build.host, build.tree, build.compiler, rev_var)
-            if err == "":
-                yield "<h2>No error log available</h2>"
-                yield "<br>"
-            else:
-                yield '<h2>Error log:</h2>\n'
-                yield '<div id="errorLog"><pre>%s \n </pre></div>' % err
-                yield "<br>"
-            if log == "":
-                yield '<h2>No build log available</h2>'
-                yield "<br>"
-            else:
-                yield '<h2>Build log:</h2>\n'
-                yield '<div id="buildLog"><pre>%s \n </pre></div>' % log
-                yield "<br>"
+            for chunk in self._render_plain_log(build.read_err(),
+                    "Error log", "errorLog", "No error log available"):
+                yield chunk
+            try:
+                f = build.read_log()
+            except LogFileMissing:
+                f = StringIO()
+            for chunk in self._render_plain_log(f,
+                    "Build log", "buildLog", "No build log available"):
+                yield chunk
 
         yield '</div>'
 
@@ -723,6 +1201,7 @@ class ViewHostPage(BuildFarmPage):
     def render_html(self, myself, *requested_hosts):
         yield "<div class='build-section' id='build-summary'>"
         yield '<h2>Host summary:</h2>'
+        deadhosts = []
         for hostname in requested_hosts:
             try:
                 host = self.buildfarm.hostdb[hostname]
@@ -797,19 +1276,13 @@ class ViewSummaryPage(BuildFarmPage):
         panic_count = defaultdict(lambda: 0)
         host_count = defaultdict(lambda: 0)
 
-        # set up a variable to store the broken builds table's code, so we can
-        # output when we want
-        broken_table = ""
-
-        builds = self.buildfarm.get_summary_builds(min_age=time.time() - BuildFarm.DEADAGE)
+        counts = self.buildfarm.get_summary_counts(
+            min_age=time.time() - self.buildfarm.DEADAGE)
 
-        for tree, status in builds:
-            host_count[tree]+=1
-
-            if status.failed:
-                broken_count[tree]+=1
-                if "panic" in status.other_failures:
-                    panic_count[tree]+=1
+        for (tree, total, broken, panic) in counts:
+            host_count[tree] = total
+            broken_count[tree] = broken
+            panic_count[tree] = panic
         return (host_count, broken_count, panic_count)
 
     def render_text(self, myself):
@@ -957,6 +1430,21 @@ class HistoryPage(BuildFarmPage):
 
 class DiffPage(HistoryPage):
 
+    def diff_html(self, branch, revision):
+        """Return the diff for a revision, highlighted as HTML.
+
+        The highlighted diff is kept in the commit cache of the branch.
+        """
+        if branch.cache is not None:
+            html = branch.cache.get(revision, "diff.html")
+            if html is not None:
+                return html
+        (entry, diff) = branch.diff(revision)
+        html = highlight(diff, DiffLexer(), HtmlFormatter()).encode("utf-8")
+        if branch.cache is not None:
+            branch.cache.put(revision, "diff.html", html)
+        return html
+
     def render(self, myself, tree, revision):
         try:
             t = self.buildfarm.trees[tree]
@@ -964,16 +1452,15 @@ class DiffPage(HistoryPage):
             yield "Unknown tree %s" % tree
             return
         branch = t.get_branch()
-        (entry, diff) = branch.diff(revision)
+        entry = branch.get_revision(revision)
         # get information about the current diff
         title = "GIT Diff in %s:%s for revision %s" % (
             tree, t.branch, revision)
         yield "<h2>%s</h2>" % title
         changes = branch.changes_summary(revision)
         yield "".join(self.history_row_html(myself, entry, t, changes))
-        diff = highlight(diff, DiffLexer(), HtmlFormatter())
         yield "<h2>Diff Result:</h2>"
-        yield "<pre>%s</pre>" % diff.encode("utf-8")
+        yield "<pre>%s</pre>" % self.diff_html(branch, entry.revision)
 
 
 class RecentCheckinsPage(HistoryPage):
@@ -982,16 +1469,17 @@ class RecentCheckinsPage(HistoryPage):
 
     def render(self, myself, tree, gitstart, author=None):
         t = self.buildfarm.trees[tree]
-        interesting = list()
         authors = {"ALL": "ALL"}
         branch = t.get_branch()
-        re_author = re.compile("^(.*) <(.*)>$")
 
-        for entry in branch.log(limit=HISTORY_HORIZON):
-            m = re_author.match(entry.author)
-            authors[m.group(2)] = m.group(1)
-            if author in (None, "ALL", m.group(2)):
-                interesting.append(entry)
+        for name in branch.authors(limit=HISTORY_HORIZON):
+            (name, email) = split_author(name)
+            authors[email] = name
+
+        # Fetch one more entry than is shown, to find out whether there is
+        # a next page.
+        interesting = list(branch.log(limit=self.limit + 1, offset=gitstart,
+            author=(author if author != "ALL" else None)))
 
         yield "<h2>Recent checkins for %s (%s branch %s)</h2>\n" % (
             tree, t.scm, t.branch)
@@ -1009,7 +1497,7 @@ class RecentCheckinsPage(HistoryPage):
 
         gitstop = gitstart + self.limit
 
-        for entry in interesting[gitstart:gitstop]:
+        for entry in interesting[:self.limit]:
             changes = branch.changes_summary(entry.revision)
             yield "".join(self.history_row_html(myself, entry, t, changes))
         yield "\n"
@@ -1018,7 +1506,7 @@ class RecentCheckinsPage(HistoryPage):
         yield "<div class='newform'>\n"
         if gitstart != 0:
             yield "<button name='gitstart' type='submit' value=" + str(gitstart - self.limit) + " style='position:absolute;left:0px;'>Previous</button>"
-        if len(interesting) > gitstop:
+        if len(interesting) > self.limit:
             yield "<button name='gitstart' type='submit' value=" + str(gitstop) + " style='position:absolute;right:0px;'>Next</button>"
         yield "<input type='hidden' name='function', value='Recent Checkins'/>"
         yield "<input type='hidden' name='gitcount' value='%s'/>" % gitstop
@@ -1038,7 +1526,7 @@ class FailedBuildsPage(BuildFarmPage):
             host = self.buildfarm.hostdb[build.host]
             return host.platform.encode("utf-8")
 
-        builds = self.buildfarm.latest_tree_builds(tree)
+        builds = self.buildfarm.failed_tree_builds(tree)
         yield "<div id='recent-builds' class='build-section'>"
         yield "<h2>Failed Builds of %s</h2>" % (tree)
         yield "<table class='newtable'>"
@@ -1054,38 +1542,130 @@ class FailedBuildsPage(BuildFarmPage):
         yield "</tr></thead>"
         yield "<tbody>"
 
-        index = 0
-        for build in builds[:100]:
-            show = False
-            for s in build.status().stages:
-                if s.result != 0:
-                    show = True
-                    break
-            if (show == True or "panic" in build.status().other_failures or "disk full" in build.status().other_failures or
-               "timeout" in build.status().other_failures or "inconsistent test result" in build.status().other_failures):
-                index = index + 1
-                try:
-                    build_platform_name = build_platform(build)
-                    yield "<tr>"
-                    yield "<td>%s</td>" % util.dhm_time(build.age)
-                    yield "<td>%s</td>" % revision_link(myself, build.revision, build.tree)
-                    yield "<td>%s</td>" % build.tree
-                    yield "<td>%s</td>" % build_platform_name
-                    yield "<td>%s</td>" % host_link(myself, build.host)
-                    yield "<td>%s</td>" % build.compiler
-                    yield "<td>%s</td>" % build_link(myself, build)
-                    yield "</tr>"
-                except hostdb.NoSuchHost:
-                    pass
-                if index == 15:
-                    break
+        for build in builds[:15]:
+            try:
+                build_platform_name = build_platform(build)
+                yield "<tr>"
+                yield "<td>%s</td>" % util.dhm_time(build.age)
+                yield "<td>%s</td>" % revision_link(myself, build.revision, build.tree)
+                yield "<td>%s</td>" % build.tree
+                yield "<td>%s</td>" % build_platform_name
+                yield "<td>%s</td>" % host_link(myself, build.host)
+                yield "<td>%s</td>" % build.compiler
+                yield "<td>%s</td>" % build_link(myself, build)
+                yield "</tr>"
+            except hostdb.NoSuchHost:
+                pass
         yield "</tbody></table>"
         yield "</div>"
 
+class CachedPage(object):
+    """A rendered page."""
+
+    def __init__(self, headers, contents, created):
+        self.headers = headers
+        self.contents = contents
+        self.created = created
+        self.etag = '"%s"' % hashlib.sha1(contents).hexdigest()
+
+    def not_modified(self, environ):
+        """Check whether the client's copy of this page is still current.
+
+        :param environ: WSGI environment of a conditional GET request
+        """
+        etags = environ.get("HTTP_IF_NONE_MATCH")
+        if etags is not None:
+            etags = [etag.strip() for etag in etags.split(",")]
+            return self.etag in etags or "*" in etags
+        since = environ.get("HTTP_IF_MODIFIED_SINCE")
+        if since is not None:
+            since = parsedate_tz(since)
+            if since is not None:
+                return mktime_tz(since) >= self.created
+        return False
+
+
+class PageCache(object):
+    """On-disk cache of rendered pages.
+
+    Entries are only used while the generation of the data (and the
+    configuration) they were rendered for is current. Since pages show the age of builds, they also expire after
+    max_age seconds.
+    """
+
+    def __init__(self, path, max_age=300):
+        """Open the cache.
+
+        :param path: Cache directory
+        :param max_age: Maximum age of entries, in seconds
+        """
+        self.path = path
+        self.max_age = max_age
+
+    def _fname(self, key):
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def get(self, key, generation):
+        """Retrieve a page.
+
+        :param key: Key of the page, e.g. its URL
+        :param generation: Current generation of the data
+        :return: A `CachedPage`, or None if the page isn't cached or is out
+            of date
+        """
+        try:
+            f = open(self._fname(key), 'rb')
+        except IOError:
+            return None
+        try:
+            (entry_generation, created, headers) = json.loads(f.readline())
+            if (entry_generation != generation or
+                time.time() - created >= self.max_age):
+                return None
+            headers = [(str(name), str(value)) for (name, value) in headers]
+            return CachedPage(headers, f.read(), created)
+        finally:
+            f.close()
+
+    def put(self, key, generation, headers, contents):
+        """Store a page.
+
+        :return: The stored `CachedPage`
+        """
+        page = CachedPage(headers, contents, int(time.time()))
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.path, suffix=".new")
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write("%s\n" % json.dumps([generation, page.created, headers]))
+            f.write(contents)
+        finally:
+            f.close()
+        os.rename(tmp_path, self._fname(key))
+        return page
+
+
+# Raw logs of a build: method that opens the log, content type and extension
+RAW_LOGS = {
+    "+stdout": ("read_log", "text/plain", "log"),
+    "+stderr": ("read_err", "text/plain", "err"),
+    "+subunit": ("read_subunit", "text/x-subunit", "subunit"),
+    }
+
+# Pages that only depend on the request and the data in the database.
+CACHEABLE_FUNCTIONS = set(["Summary", "Text_Summary", "View_Host", "Recent_Builds"])
+# Query parameters that cacheable pages can have.
+CACHEABLE_PARAMS = set(["function", "tree", "host", "compiler", "sortby"])
+SORT_KEYS = set(["revision", "age", "host", "platform", "compiler", "status"])
+
+
 class BuildFarmApp(object):
 
     def __init__(self, buildfarm):
         self.buildfarm = buildfarm
+        self.page_cache = PageCache(
+            os.path.join(buildfarm.path, "cache", "pages"))
 
     def main_menu(self, tree, host, compiler, function):
         """main page"""
@@ -1144,7 +1724,8 @@ class BuildFarmApp(object):
         yield util.SambaWebFileLoad(os.path.join(webdir, "samba-web"), "menu_hack_samba_closed.html")
         yield util.SambaWebFileLoad(os.path.join(webdir, "samba-web"), "menu_contact_samba_closed.html")
         yield util.FileLoad(os.path.join(webdir, "bannernav2.html"))
-        yield "".join(lines)
+        for line in lines:
+            yield line
         #for sitmap uncomment after adding a menu_sitemap_samba_closed.html containing the sitemap part of index.html in main samba directory
         yield "<div class='noPrint' id='newsitemap'>"
         yield util.SambaWebFileLoad(os.path.join(webdir, "samba-web"), "menu_sitemap_samba_closed.html")
@@ -1152,7 +1733,223 @@ class BuildFarmApp(object):
         yield util.SambaWebFileLoad(os.path.join(webdir, "samba-web"), "footer.html")
         yield util.FileLoad(os.path.join(webdir, "closingtags.html"))
 
+    def _is_valid_param(self, name, value):
+        if name == "function":
+            return value in CACHEABLE_FUNCTIONS
+        elif name == "tree":
+            return value in self.buildfarm.trees
+        elif name == "host":
+            try:
+                self.buildfarm.hostdb[value]
+            except hostdb.NoSuchHost:
+                return False
+            return True
+        elif name == "compiler":
+            return value in self.buildfarm.compilers
+        elif name == "sortby":
+            return value in SORT_KEYS
+        return False
+
+    def _cache_key(self, environ):
+        """Determine the page cache key for a request.
+
+        The key is built from the known parameters of the request, and
+        requests with unknown or invalid parameters aren't cached, so that
+        arbitrary query strings can't fill up the cache.
+
+        :return: Cache key, or None if the response shouldn't be cached
+        """
+        if environ.get("REQUEST_METHOD", "GET") not in ("GET", "HEAD"):
+            return None
+        query = cgi.parse_qs(environ.get("QUERY_STRING", ""),
+            keep_blank_values=True)
+        params = []
+        for (name, values) in sorted(query.iteritems()):
+            # Parameters are normalized like get_param does.
+            value = values[0].replace(" ", "_")
+            if len(values) != 1 or not self._is_valid_param(name, value):
+                return None
+            params.append("%s=%s" % (name, value))
+        path = environ.get("PATH_INFO", "").strip("/").split("/")
+        if "function" in query:
+            # The path is ignored when a function is requested.
+            if path != [""]:
+                return None
+        elif path[0] == "tree":
+            if (len(path) not in (2, 3) or
+                not self._is_valid_param("tree", path[1]) or
+                path[2:] not in ([], [""], ["+recent"], ["+recent-ids"])):
+                return None
+        elif path[0] == "host":
+            if len(path) != 2 or not self._is_valid_param("host", path[1]):
+                return None
+        elif path != [""]:
+            return None
+        return "%s%s?%s" % (wsgiref.util.application_uri(environ),
+            "/".join(path), ";".join(params))
+
+    def _render_cached(self, environ, start_response, key):
+        # Pages also show the trees and compilers from the configuration.
+        generation = "%d %r" % (self.buildfarm.data_generation(),
+            self.buildfarm.config_stamp())
+        page = self.page_cache.get(key, generation)
+        if page is None:
+            response = []
+            def capture_response(status, headers, exc_info=None):
+                response[:] = [status, headers]
+            contents = "".join(self._render(environ, capture_response))
+            (status, headers) = response
+            if not status.startswith("200 "):
+                start_response(status, headers)
+                yield contents
+                return
+            try:
+                page = self.page_cache.put(key, generation, headers, contents)
+            except EnvironmentError:
+                # Still serve the page if the cache isn't writable.
+                page = CachedPage(headers, contents, int(time.time()))
+        headers = page.headers + [
+            ("ETag", page.etag),
+            ("Last-Modified", formatdate(page.created, usegmt=True)),
+            ("Cache-Control", "no-cache"),
+            ]
+        if page.not_modified(environ):
+            start_response("304 Not Modified",
+                [h for h in headers if h[0].lower() != "content-type"])
+            return
+        start_response("200 OK", headers)
+        yield page.contents
+
+    def _raw_log_request(self, environ):
+        """Check whether a request is for the raw logs of a build.
+
+        :return: Tuple with the build checksum and the subfunction
+            ("+stdout", "+stderr" or "+subunit"), or None
+        """
+        if cgi.parse_qs(environ.get("QUERY_STRING", "")).get("function"):
+            return None
+        parts = environ.get("PATH_INFO", "").strip("/").split("/")
+        if len(parts) >= 3 and parts[0] == "build" and parts[2] in RAW_LOGS:
+            return (parts[1], parts[2])
+        return None
+
+    def _open_gzipped_log(self, build, name, open_log):
+        """Open the gzip-compressed copy of a log, creating it if necessary.
+
+        The copies are kept in the fragment cache, so logs are only
+        compressed once.
+
+        :param name: Fragment name of the compressed log
+        :param open_log: Callable that opens the log
+        :return: File object, or None if the copy couldn't be created
+        """
+        checksum = build.log_checksum()
+        f = self.buildfarm.fragments.open(checksum, name)
+        if f is None:
+            try:
+                self.buildfarm.fragments.put_chunks(checksum, name,
+                    gzip_chunks(iter_file(open_log())))
+            except EnvironmentError:
+                return None
+            f = self.buildfarm.fragments.open(checksum, name)
+        return f
+
+    def _render_raw_log(self, environ, start_response, build_checksum, subfn):
+        try:
+            build = self.buildfarm.builds.get_by_checksum(build_checksum)
+        except NoSuchBuildError:
+            start_response('404 Page Not Found', [
+                ('Content-Type', 'text/html; charset=utf8')])
+            return ["No build with checksum %s found" % build_checksum]
+        (method, content_type, extension) = RAW_LOGS[subfn]
+        open_log = getattr(build, method)
+        gzip_name = "%s.gz" % extension
+        try:
+            f = open_log()
+        except NoTestOutput:
+            start_response('200 OK', [
+                ('Content-type', 'text/plain; charset=utf-8')])
+            return ["There was no test output"]
+        headers = [
+            ('Content-type', '%s; charset=utf-8' % content_type),
+            ('Content-Disposition', 'attachment; filename="%s.%s.%s-%s.%s"' % (build.tree, build.host, build.compiler, build.revision, extension)),
+            ('Accept-Ranges', 'bytes'),
+            ('Vary', 'Accept-Encoding'),
+            ]
+
+        range_header = environ.get("HTTP_RANGE")
+        if range_header is not None:
+            if isinstance(f, file):
+                size = os.fstat(f.fileno()).st_size
+                read_range = file_range
+            else:
+                # Compressed logs can't be seeked in, but the gzip copy
+                # records the size and is quick to decompress.
+                gzipped = self._open_gzipped_log(build, gzip_name, open_log)
+                if gzipped is not None:
+                    f.close()
+                    f = gzipped
+                    size = gzip_size(f)
+                    read_range = gunzip_range
+                else:
+                    range_header = None
+        if range_header is not None:
+            try:
+                requested = parse_range(range_header, size)
+            except ValueError:
+                f.close()
+                start_response('416 Requested Range Not Satisfiable', [
+                    ('Content-Range', 'bytes */%d' % size)])
+                return []
+            if requested is not None:
+                (start, length) = requested
+                start_response('206 Partial Content', headers + [
+                    ('Content-Range', 'bytes %d-%d/%d' % (start, start + length - 1, size)),
+                    ('Content-Length', str(length))])
+                return read_range(f, start, length)
+            f.close()
+            f = open_log()
+
+        if accepts_gzip(environ):
+            gzipped = self._open_gzipped_log(build, gzip_name, open_log)
+            if gzipped is not None:
+                f.close()
+                start_response('200 OK', headers + [
+                    ('Content-Encoding', 'gzip'),
+                    ('Content-Length', str(os.fstat(gzipped.fileno()).st_size))])
+                return file_response(environ, gzipped)
+        if isinstance(f, file):
+            headers.append(('Content-Length', str(os.fstat(f.fileno()).st_size)))
+        start_response('200 OK', headers)
+        return file_response(environ, f)
+
     def __call__(self, environ, start_response):
+        self.buildfarm.reload_config()
+        raw_log = self._raw_log_request(environ)
+        if raw_log is not None:
+            # Return the file wrapper itself, so that the server can send
+            # the file efficiently.
+            try:
+                return self._render_raw_log(environ, start_response, *raw_log)
+            finally:
+                self.buildfarm.rollback()
+        return self._render_response(environ, start_response)
+
+    def _render_response(self, environ, start_response):
+        try:
+            key = self._cache_key(environ)
+            if key is not None:
+                response = self._render_cached(environ, start_response, key)
+            else:
+                response = self._render(environ, start_response)
+            for chunk in response:
+                yield chunk
+        finally:
+            # Don't keep a read transaction open between requests, so that
+            # the next request sees newly imported builds.
+            self.buildfarm.rollback()
+
+    def _render(self, environ, start_response):
         form = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ)
         fn_name = get_param(form, 'function') or ''
         myself = wsgiref.util.application_uri(environ)
@@ -1192,13 +1989,16 @@ class BuildFarmApp(object):
                 else:
                     page = ViewBuildPage(self.buildfarm)
                     plain_logs = (get_param(form, "plain") is not None and get_param(form, "plain").lower() in ("yes", "1", "on", "true", "y"))
-                    yield "".join(self.html_page(form, page.render(myself, build, plain_logs)))
+                    for chunk in self.html_page(form, page.render(myself, build, plain_logs)):
+                        yield chunk
             elif fn_name == "View_Host":
                 page = ViewHostPage(self.buildfarm)
-                yield "".join(self.html_page(form, page.render_html(myself, get_param(form, 'host'))))
+                for chunk in self.html_page(form, page.render_html(myself, get_param(form, 'host'))):
+                    yield chunk
             elif fn_name == "Recent_Builds":
                 page = ViewRecentBuildsPage(self.buildfarm)
-                yield "".join(self.html_page(form, page.render(myself, get_param(form, "tree"), get_param(form, "sortby") or "age")))
+                for chunk in self.html_page(form, page.render(myself, get_param(form, "tree"), get_param(form, "sortby") or "age")):
+                    yield chunk
             elif fn_name == "Recent_Checkins":
                 # validate the tree
                 author = get_param(form, 'author')
@@ -1208,17 +2008,21 @@ class BuildFarmApp(object):
                 else:
                     gitstart = int(gitstart)
                 page = RecentCheckinsPage(self.buildfarm)
-                yield "".join(self.html_page(form, page.render(myself, tree, gitstart, author)))
+                for chunk in self.html_page(form, page.render(myself, tree, gitstart, author)):
+                    yield chunk
             elif fn_name == "Failed_Builds":
                 page = FailedBuildsPage(self.buildfarm)
-                yield "".join(self.html_page(form, page.render_html(myself, tree)))
+                for chunk in self.html_page(form, page.render_html(myself, tree)):
+                    yield chunk
             elif fn_name == "diff":
                 revision = get_param(form, 'revision')
                 page = DiffPage(self.buildfarm)
-                yield "".join(self.html_page(form, page.render(myself, tree, revision)))
+                for chunk in self.html_page(form, page.render(myself, tree, revision)):
+                    yield chunk
             elif fn_name == "Summary":
                 page = ViewSummaryPage(self.buildfarm)
-                yield "".join(self.html_page(form, page.render_html(myself)))
+                for chunk in self.html_page(form, page.render_html(myself)):
+                    yield chunk
             else:
                 yield "Unknown function %s" % fn_name
         else:
@@ -1230,7 +2034,8 @@ class BuildFarmApp(object):
                     start_response('200 OK', [
                         ('Content-type', 'text/html; charset=utf-8')])
                     page = ViewRecentBuildsPage(self.buildfarm)
-                    yield "".join(self.html_page(form, page.render(myself, tree, get_param(form, 'sortby') or 'age')))
+                    for chunk in self.html_page(form, page.render(myself, tree, get_param(form, 'sortby') or 'age')):
+                        yield chunk
                 elif subfn == "+recent-ids":
                     start_response('200 OK', [
                         ('Content-type', 'text/plain; charset=utf-8')])
@@ -1243,17 +2048,20 @@ class BuildFarmApp(object):
                 start_response('200 OK', [
                     ('Content-type', 'text/html; charset=utf-8')])
                 page = ViewHostPage(self.buildfarm)
-                yield "".join(self.html_page(form, page.render_html(myself, wsgiref.util.shift_path_info(environ))))
+                for chunk in self.html_page(form, page.render_html(myself, wsgiref.util.shift_path_info(environ))):
+                    yield chunk
             elif fn == "about":
                 start_response('200 OK', [
                     ('Content-type', 'text/html; charset=utf-8')])
-                lines = util.FileLoad(os.path.join(webdir, "about.html"))
-                yield "".join(self.html_page(form, lines))
+                lines = [util.FileLoad(os.path.join(webdir, "about.html"))]
+                for chunk in self.html_page(form, lines):
+                    yield chunk
             elif fn == "instructions":
                 start_response('200 OK', [
                     ('Content-type', 'text/html; charset=utf-8')])
-                lines = util.FileLoad(os.path.join(webdir, "instructions.html"))
-                yield "".join(self.html_page(form, lines))
+                lines = [util.FileLoad(os.path.join(webdir, "instructions.html"))]
+                for chunk in self.html_page(form, lines):
+                    yield chunk
             elif fn == "build":
                 build_checksum = wsgiref.util.shift_path_info(environ)
                 try:
@@ -1268,34 +2076,25 @@ class BuildFarmApp(object):
                 if subfn == "+plain":
                     start_response('200 OK', [
                         ('Content-type', 'text/html; charset=utf-8')])
-                    yield "".join(page.render(myself, build, True))
-                elif subfn == "+subunit":
-                    start_response('200 OK', [
-                        ('Content-type', 'text/x-subunit; charset=utf-8'),
-                        ('Content-Disposition', 'attachment; filename="%s.%s.%s-%s.subunit"' % (build.tree, build.host, build.compiler, build.revision))])
-                    try:
-                        yield build.read_subunit().read()
-                    except NoTestOutput:
-                        yield "There was no test output"
-                elif subfn == "+stdout":
-                    start_response('200 OK', [
-                        ('Content-type', 'text/plain; charset=utf-8'),
-                        ('Content-Disposition', 'attachment; filename="%s.%s.%s-%s.log"' % (build.tree, build.host, build.compiler, build.revision))])
-                    yield build.read_log().read()
-                elif subfn == "+stderr":
-                    start_response('200 OK', [
-                        ('Content-type', 'text/plain; charset=utf-8'),
-                        ('Content-Disposition', 'attachment; filename="%s.%s.%s-%s.err"' % (build.tree, build.host, build.compiler, build.revision))])
-                    yield build.read_err().read()
+                    for chunk in page.render(myself, build, True):
+                        yield chunk
                 elif subfn == "+subunit-diff":
                     start_response('200 OK', [
                         ('Content-type', 'text/plain; charset=utf-8')])
-                    subunit_this = build.read_subunit().readlines()
                     other_build_checksum = wsgiref.util.shift_path_info(environ)
                     other_build = self.buildfarm.builds.get_by_checksum(other_build_checksum)
-                    subunit_other = other_build.read_subunit().readlines()
-                    import difflib
-                    yield "".join(difflib.unified_diff(subunit_other, subunit_this))
+                    results_this = self.buildfarm.builds.get_test_results(build)
+                    results_other = self.buildfarm.builds.get_test_results(other_build)
+                    if results_this and results_other:
+                        yield "".join(render_test_results_diff(
+                            TestResultsDiff(results_other, results_this)))
+                    else:
+                        # No stored test results; fall back to comparing the
+                        # subunit streams.
+                        subunit_this = build.read_subunit().readlines()
+                        subunit_other = other_build.read_subunit().readlines()
+                        import difflib
+                        yield "".join(difflib.unified_diff(subunit_other, subunit_this))
 
                 elif subfn in ("", "limit", None):
                     if subfn == "limit":
@@ -1307,13 +2106,15 @@ class BuildFarmApp(object):
                         limit = 10
                     start_response('200 OK', [
                         ('Content-type', 'text/html; charset=utf-8')])
-                    yield "".join(self.html_page(form, page.render(myself, build, False, limit)))
+                    for chunk in self.html_page(form, page.render(myself, build, False, limit)):
+                        yield chunk
 
             elif fn in ("", None):
                 start_response('200 OK', [
                     ('Content-type', 'text/html; charset=utf-8')])
                 page = ViewSummaryPage(self.buildfarm)
-                yield "".join(self.html_page(form, page.render_html(myself)))
+                for chunk in self.html_page(form, page.render_html(myself)):
+                    yield chunk
             else:
                 start_response('404 Page Not Found', [
                     ('Content-type', 'text/html; charset=utf-8')])
@@ -1327,26 +2128,21 @@ if __name__ == '__main__':
                       default=False, action='store_true')
     parser.add_option("--port", help="Port to listen on [localhost:8000]",
         default="localhost:8000", type=str)
+    parser.add_option("--threads", help="Number of threads per process [1]",
+        default=1, type=int)
+    parser.add_option("--workers", help="Number of processes to fork [1]",
+        default=1, type=int)
     opts, args = parser.parse_args()
     from buildfarm import BuildFarm
-    buildfarm = BuildFarm()
-    buildApp = BuildFarmApp(buildfarm)
-    from wsgiref.simple_server import make_server
-    import mimetypes
-    mimetypes.init()
-
-    def standaloneApp(environ, start_response):
-        if environ['PATH_INFO']:
-            m = re.match("^/([a-zA-Z0-9_-]+)(\.[a-zA-Z0-9_-]+)?", environ['PATH_INFO'])
-            if m:
-                static_file = os.path.join(webdir, m.group(1)+m.group(2))
-                if os.path.exists(static_file):
-                    type = mimetypes.types_map[m.group(2)]
-                    start_response('200 OK', [('Content-type', type)])
-                    data = open(static_file, 'rb').read()
-                    yield data
-                    return
-        yield "".join(buildApp(environ, start_response))
+    from buildfarm.web.server import PerThreadApp, StaticFilesApp, make_server, serve
+
+    # Refuse to start if the schema is out of date, rather than failing
+    # on every request.
+    BuildFarm(readonly=True)
+
+    def create_app():
+        return BuildFarmApp(BuildFarm(readonly=True))
+
     try:
         (address, port) = opts.port.rsplit(":", 1)
     except ValueError:
@@ -1355,6 +2151,7 @@ if __name__ == '__main__':
     if opts.debug_storm:
         from storm.tracer import debug
         debug(True, stream=sys.stdout)
-    httpd = make_server(address, int(port), standaloneApp)
+    httpd = make_server(address, int(port),
+        StaticFilesApp(PerThreadApp(create_app), webdir), threads=opts.threads)
     print "Serving on %s:%d..." % (address, int(port))
-    httpd.serve_forever()
+    serve(httpd, workers=opts.workers)
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# Long-running server for the build farm web frontend
+#
+# Copyright (C) Jelmer Vernooij <jelmer@samba.org>   2010
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""Serving the web frontend from a long-running process.
+
+Unlike the CGI script, which opens the build farm for every request, the
+server keeps a `BuildFarmApp` (and with it the configuration and the
+database connection) for each thread in each worker process.
+"""
+
+import mimetypes
+import os
+import Queue
+import re
+import signal
+import SocketServer
+import threading
+from wsgiref.simple_server import WSGIServer, make_server as _make_server
+
+from buildfarm.web import file_response
+
+
+class PerThreadApp(object):
+    """WSGI application that uses a separate application object per thread.
+
+    The application objects are created on first use, so the server can
+    fork worker processes after this has been created.
+    """
+
+    def __init__(self, factory):
+        """Create a new PerThreadApp.
+
+        :param factory: Callable that creates a new WSGI application
+        """
+        self.factory = factory
+        self._local = threading.local()
+
+    def __call__(self, environ, start_response):
+        app = getattr(self._local, "app", None)
+        if app is None:
+            app = self._local.app = self.factory()
+        return app(environ, start_response)
+
+
+class StaticFilesApp(object):
+    """WSGI application that serves the static files in the web directory,
+    and passes all other requests on to another application."""
+
+    def __init__(self, app, webdir):
+        self.app = app
+        self.webdir = webdir
+        mimetypes.init()
+
+    def __call__(self, environ, start_response):
+        if environ['PATH_INFO']:
+            m = re.match("^/([a-zA-Z0-9_-]+)(\.[a-zA-Z0-9_-]+)$", environ['PATH_INFO'])
+            if m:
+                static_file = os.path.join(self.webdir, m.group(1)+m.group(2))
+                if os.path.exists(static_file):
+                    type = mimetypes.types_map.get(m.group(2), "application/octet-stream")
+                    start_response('200 OK', [('Content-type', type)])
+                    return file_response(environ, open(static_file, 'rb'))
+        return self.app(environ, start_response)
+
+
+class ThreadPoolMixIn:
+    """Handle requests in a fixed pool of threads.
+
+    Unlike `SocketServer.ThreadingMixIn`, which starts a new thread for each
+    request, the threads (and any per-thread state) are kept for the
+    lifetime of the server.
+    """
+
+    threads = 4
+
+    def _start_threads(self):
+        self._requests = Queue.Queue()
+        for i in range(self.threads):
+            t = threading.Thread(target=self._process_requests)
+            t.daemon = True
+            t.start()
+
+    def _process_requests(self):
+        while True:
+            (request, client_address) = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def serve_forever(self, poll_interval=0.5):
+        # Threads don't survive fork(), so start them in the process that
+        # handles the requests.
+        self._start_threads()
+        SocketServer.BaseServer.serve_forever(self, poll_interval)
+
+
+class ThreadPoolWSGIServer(ThreadPoolMixIn, WSGIServer):
+    """WSGI server that handles requests in a pool of threads."""
+
+
+def make_server(host, port, app, threads=1):
+    """Create a WSGI server.
+
+    :param host: Address to listen on
+    :param port: Port to listen on
+    :param app: WSGI application
+    :param threads: Number of threads to handle requests in
+    """
+    if threads > 1:
+        class server_class(ThreadPoolWSGIServer):
+            pass
+        server_class.threads = threads
+    else:
+        server_class = WSGIServer
+    return _make_server(host, port, app, server_class=server_class)
+
+
+def serve(server, workers=1):
+    """Serve requests until interrupted.
+
+    :param server: Server to run
+    :param workers: Number of processes to fork; they all accept
+        connections on the listening socket of the server
+    """
+    if workers <= 1:
+        server.serve_forever()
+        return
+    children = []
+    # Hold back interrupts until all workers have been forked and recorded,
+    # so that none of them is left running when the server is stopped.
+    interrupted = []
+    handler = signal.signal(signal.SIGINT,
+        lambda signum, frame: interrupted.append(signum))
+    try:
+        for i in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGINT, handler)
+                try:
+                    server.serve_forever()
+                finally:
+                    os._exit(0)
+            children.append(pid)
+        signal.signal(signal.SIGINT, handler)
+        if interrupted:
+            raise KeyboardInterrupt
+        while children:
+            (pid, status) = os.wait()
+            children.remove(pid)
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
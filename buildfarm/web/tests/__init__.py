@@ -0,0 +1,55 @@
+#!/usr/bin/python
+# Copyright (C) Jelmer Vernooij <jelmer@samba.org> 2010
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+from buildfarm import BuildFarm
+from buildfarm.tests import BuildFarmTestCase
+from buildfarm.web import BuildFarmApp
+
+import wsgiref.util
+
+
+class BuildFarmAppTestCase(BuildFarmTestCase):
+    """Test case class that provides a build farm with one host and one
+    build, and a web frontend for it."""
+
+    def setUp(self):
+        super(BuildFarmAppTestCase, self).setUp()
+        self.write_compilers(["cc"])
+        self.write_trees({"trivial": {"scm": "git", "repo": "git://foo", "branch": "master"}})
+        self.buildfarm = BuildFarm(self.path)
+        self.buildfarm.hostdb.createhost("charis", platform=u"Debian")
+        self.upload_mock_logfile(self.buildfarm.builds, "trivial", "charis",
+            "cc", stdout_contents="BUILD COMMIT REVISION: 12\n", mtime=1200)
+        self.buildfarm.commit()
+        self.app = BuildFarmApp(BuildFarm(self.path, readonly=True))
+
+    def request(self, path, query="", environ=None, **headers):
+        """Send a GET request to the web frontend.
+
+        :return: Tuple with status, dictionary with headers and body
+        """
+        if environ is None:
+            environ = {}
+        environ.update({"PATH_INFO": path, "QUERY_STRING": query})
+        for (name, value) in headers.iteritems():
+            environ["HTTP_" + name.upper()] = value
+        wsgiref.util.setup_testing_defaults(environ)
+        response = []
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, dict(headers)]
+        body = "".join(self.app(environ, start_response))
+        return (response[0], response[1], body)
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+# Copyright (C) Jelmer Vernooij <jelmer@samba.org> 2010
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+from buildfarm import BuildFarm
+from buildfarm.web import PageCache
+from buildfarm.web.tests import BuildFarmAppTestCase
+
+import os
+import testtools
+import tempfile
+import shutil
+
+
+class PageCacheTests(testtools.TestCase):
+
+    def setUp(self):
+        super(PageCacheTests, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.cache = PageCache(os.path.join(self.path, "pages"))
+
+    def test_missing(self):
+        self.assertIs(None, self.cache.get("/", 1))
+
+    def test_put_get(self):
+        headers = [("Content-type", "text/plain")]
+        page = self.cache.put("/", 1, headers, "contents")
+        cached = self.cache.get("/", 1)
+        self.assertEquals(headers, cached.headers)
+        self.assertEquals("contents", cached.contents)
+        self.assertEquals(page.etag, cached.etag)
+        self.assertEquals(page.created, cached.created)
+
+    def test_other_generation(self):
+        self.cache.put("/", 1, [], "contents")
+        self.assertIs(None, self.cache.get("/", 2))
+
+    def test_expired(self):
+        self.cache.max_age = 0
+        self.cache.put("/", 1, [], "contents")
+        self.assertIs(None, self.cache.get("/", 1))
+
+
+class BuildFarmAppCacheTests(BuildFarmAppTestCase):
+
+    def test_not_modified(self):
+        (status, headers, body) = self.request("/")
+        self.assertEquals("200 OK", status)
+        self.assertIn("ETag", headers)
+        (status, headers, body) = self.request("/",
+            if_none_match=headers["ETag"])
+        self.assertEquals("304 Not Modified", status)
+        self.assertEquals("", body)
+
+    def test_if_modified_since(self):
+        (status, headers, body) = self.request("/host/charis")
+        (status, headers, body) = self.request("/host/charis",
+            if_modified_since=headers["Last-Modified"])
+        self.assertEquals("304 Not Modified", status)
+
+    def test_invalidated_by_import(self):
+        (status, headers, body) = self.request("/", "function=Text_Summary")
+        self.upload_mock_logfile(self.buildfarm.builds, "trivial", "charis",
+            "cc", stdout_contents="BUILD COMMIT REVISION: 13\n")
+        self.buildfarm.bump_data_generation()
+        self.buildfarm.commit()
+        (status, new_headers, new_body) = self.request("/",
+            "function=Text_Summary", if_none_match=headers["ETag"])
+        self.assertEquals("200 OK", status)
+        self.assertNotEquals(body, new_body)
+        self.assertNotEquals(headers["ETag"], new_headers["ETag"])
+
+    def test_invalidated_by_config_change(self):
+        (status, headers, body) = self.request("/")
+        self.assertNotIn("other", body)
+        self.write_trees({
+            "trivial": {"scm": "git", "repo": "git://foo", "branch": "master"},
+            "other": {"scm": "git", "repo": "other.git", "branch": "master"}})
+        (status, headers, body) = self.request("/")
+        self.assertIn("other", body)
+
+    def test_not_cacheable(self):
+        (status, headers, body) = self.request("/about")
+        self.assertEquals("200 OK", status)
+        self.assertNotIn("ETag", headers)
+
+    def cached_pages(self):
+        path = os.path.join(self.path, "cache", "pages")
+        if not os.path.isdir(path):
+            return 0
+        return len(os.listdir(path))
+
+    def test_same_key_for_reordered_params(self):
+        self.request("/", "function=Recent_Builds;tree=trivial;sortby=host")
+        self.request("/", "sortby=host;tree=trivial;function=Recent+Builds")
+        self.assertEquals(1, self.cached_pages())
+
+    def test_unknown_params_not_cached(self):
+        (status, headers, body) = self.request("/", "function=Summary;junk=1")
+        self.assertEquals("200 OK", status)
+        self.assertNotIn("ETag", headers)
+        self.assertEquals(0, self.cached_pages())
+
+    def test_invalid_values_not_cached(self):
+        for query in ["function=Summary;compiler=unknown",
+                      "function=Recent_Builds;tree=trivial;sortby=unknown",
+                      "function=View_Host;host=unknown"]:
+            self.request("/", query)
+        self.request("/host/unknown")
+        self.request("/host/charis/junk")
+        self.assertEquals(0, self.cached_pages())
+
+    def assertGenerationBumped(self, change):
+        generation = self.buildfarm.data_generation()
+        change()
+        self.buildfarm.commit()
+        self.assertEquals(generation + 1,
+            BuildFarm(self.path).data_generation())
+
+    def test_host_changes_bump_generation(self):
+        hostdb = self.buildfarm.hostdb
+        self.assertGenerationBumped(
+            lambda: hostdb.createhost("newhost", platform=u"Debian"))
+        self.assertGenerationBumped(
+            lambda: hostdb["newhost"].update_platform(u"Fedora"))
+        self.assertGenerationBumped(
+            lambda: hostdb["newhost"].update_owner(u"Owner", u"owner@example.com"))
+        self.assertGenerationBumped(lambda: hostdb.deletehost("newhost"))
+
+    def test_build_remove_bumps_generation(self):
+        build = self.buildfarm.builds.get_build("trivial", "charis", "cc")
+        self.assertGenerationBumped(build.remove)
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+# Copyright (C) Jelmer Vernooij <jelmer@samba.org> 2010
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+from buildfarm.web import (
+    CHUNK_SIZE,
+    accepts_gzip,
+    find_log_config,
+    gunzip_range,
+    gzip_chunks,
+    gzip_size,
+    iter_file,
+    parse_range,
+    )
+from buildfarm.web.tests import BuildFarmAppTestCase
+
+import bz2
+from cStringIO import StringIO
+import gzip
+import os
+import testtools
+import wsgiref.util
+
+
+class FindLogConfigTests(testtools.TestCase):
+
+    def test_empty(self):
+        self.assertEquals((None, None, None), find_log_config(StringIO("")))
+
+    def test_found(self):
+        self.assertEquals(("Linux charis 2.6", "-O2", "--enable-developer"),
+            find_log_config(StringIO("Linux charis 2.6\nfoo\nCFLAGS=-O2\n"
+                "configure options: --enable-developer\nCFLAGS=-O0\n")))
+
+
+class IterFileTests(testtools.TestCase):
+
+    def test_chunks(self):
+        self.assertEquals(["abc", "def", "g"],
+            list(iter_file(StringIO("abcdefg"), chunk_size=3)))
+
+    def test_escape(self):
+        self.assertEquals("&lt;a&gt;&amp;" * 5,
+            "".join(iter_file(StringIO("<a>&" * 5), chunk_size=3, escape=True)))
+
+
+class ParseRangeTests(testtools.TestCase):
+
+    def test_range(self):
+        self.assertEquals((10, 11), parse_range("bytes=10-20", 100))
+
+    def test_open_ended(self):
+        self.assertEquals((90, 10), parse_range("bytes=90-", 100))
+
+    def test_suffix(self):
+        self.assertEquals((70, 30), parse_range("bytes=-30", 100))
+        self.assertEquals((0, 100), parse_range("bytes=-300", 100))
+
+    def test_end_past_size(self):
+        self.assertEquals((90, 10), parse_range("bytes=90-200", 100))
+
+    def test_unsatisfiable(self):
+        self.assertRaises(ValueError, parse_range, "bytes=100-", 100)
+        self.assertRaises(ValueError, parse_range, "bytes=-0", 100)
+
+    def test_ignored(self):
+        self.assertIs(None, parse_range("bytes=0-10,20-30", 100))
+        self.assertIs(None, parse_range("bytes=20-10", 100))
+        self.assertIs(None, parse_range("lines=1-2", 100))
+
+
+class AcceptsGzipTests(testtools.TestCase):
+
+    def test_missing(self):
+        self.assertFalse(accepts_gzip({}))
+
+    def test_gzip(self):
+        self.assertTrue(accepts_gzip({"HTTP_ACCEPT_ENCODING": "deflate, gzip"}))
+
+    def test_quality(self):
+        self.assertTrue(accepts_gzip({"HTTP_ACCEPT_ENCODING": "gzip;q=0.5"}))
+        self.assertFalse(accepts_gzip({"HTTP_ACCEPT_ENCODING": "gzip;q=0"}))
+
+
+class GzipTests(testtools.TestCase):
+
+    def compress(self, contents):
+        return StringIO("".join(gzip_chunks(iter_file(StringIO(contents), 7))))
+
+    def test_roundtrip(self):
+        f = self.compress("foo bar blah\n" * 1000)
+        self.assertEquals("foo bar blah\n" * 1000,
+            gzip.GzipFile(fileobj=f).read())
+
+    def test_size(self):
+        self.assertEquals(13000, gzip_size(self.compress("foo bar blah\n" * 1000)))
+
+    def test_range(self):
+        contents = "".join(["line %d\n" % i for i in range(100000)])
+        self.assertEquals(contents[500000:500100],
+            "".join(gunzip_range(self.compress(contents), 500000, 100)))
+        self.assertEquals(contents[-10:],
+            "".join(gunzip_range(self.compress(contents), len(contents) - 10, 10)))
+
+
+class RecordingFileWrapper(wsgiref.util.FileWrapper):
+
+    instances = []
+
+    def __init__(self, filelike, blksize=8192):
+        wsgiref.util.FileWrapper.__init__(self, filelike, blksize)
+        self.instances.append(self)
+
+
+class BuildLogTests(BuildFarmAppTestCase):
+
+    def setUp(self):
+        super(BuildLogTests, self).setUp()
+        self.build = self.buildfarm.get_build("trivial", "charis", "cc", "12")
+        self.uri = "/build/%s" % self.build.log_checksum()
+        RecordingFileWrapper.instances = []
+
+    def write_log(self, contents, compress=False):
+        os.remove(self.build.basename + ".log")
+        if compress:
+            f = bz2.BZ2File(self.build.basename + ".log.bz2", 'w')
+        else:
+            f = open(self.build.basename + ".log", 'w')
+        try:
+            f.write(contents)
+        finally:
+            f.close()
+
+    def test_stdout_file_wrapper(self):
+        (status, headers, body) = self.request(self.uri + "/+stdout",
+            environ={"wsgi.file_wrapper": RecordingFileWrapper})
+        self.assertEquals("200 OK", status)
+        self.assertEquals("BUILD COMMIT REVISION: 12\n", body)
+        self.assertEquals(1, len(RecordingFileWrapper.instances))
+
+    def test_stdout_compressed(self):
+        contents = "".join(["line %d\n" % i for i in range(50000)])
+        self.write_log(contents, compress=True)
+        environ = {"PATH_INFO": self.uri + "/+stdout", "QUERY_STRING": "",
+                   "wsgi.file_wrapper": RecordingFileWrapper}
+        wsgiref.util.setup_testing_defaults(environ)
+        chunks = list(self.app(environ, lambda status, headers: None))
+        self.assertEquals(contents, "".join(chunks))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(max(map(len, chunks)) <= CHUNK_SIZE)
+        self.assertEquals([], RecordingFileWrapper.instances)
+
+    def test_range(self):
+        (status, headers, body) = self.request(self.uri + "/+stdout",
+            range="bytes=6-11")
+        self.assertEquals("206 Partial Content", status)
+        self.assertEquals("COMMIT", body)
+        self.assertEquals("bytes 6-11/26", headers["Content-Range"])
+        self.assertEquals("6", headers["Content-Length"])
+
+    def test_range_unsatisfiable(self):
+        (status, headers, body) = self.request(self.uri + "/+stdout",
+            range="bytes=100-")
+        self.assertEquals("416 Requested Range Not Satisfiable", status)
+        self.assertEquals("bytes */26", headers["Content-Range"])
+
+    def test_range_compressed(self):
+        contents = "".join(["line %d\n" % i for i in range(50000)])
+        self.write_log(contents, compress=True)
+        (status, headers, body) = self.request(self.uri + "/+stdout",
+            range="bytes=-100")
+        self.assertEquals("206 Partial Content", status)
+        self.assertEquals(contents[-100:], body)
+        self.assertEquals("bytes %d-%d/%d" % (len(contents) - 100,
+            len(contents) - 1, len(contents)), headers["Content-Range"])
+
+    def test_gzip(self):
+        contents = "".join(["line %d\n" % i for i in range(50000)])
+        self.write_log(contents, compress=True)
+        (status, headers, body) = self.request(self.uri + "/+stdout",
+            accept_encoding="gzip")
+        self.assertEquals("200 OK", status)
+        self.assertEquals("gzip", headers["Content-Encoding"])
+        self.assertEquals(str(len(body)), headers["Content-Length"])
+        self.assertEquals(contents, gzip.GzipFile(fileobj=StringIO(body)).read())
+        # The compressed copy is only created once.
+        self.assertEquals(set([self.build.log_checksum()]),
+            self.buildfarm.fragments.checksums())
+        self.buildfarm.fragments.put_chunks = None
+        (status, headers, second_body) = self.request(self.uri + "/+stdout",
+            accept_encoding="gzip")
+        self.assertEquals(body, second_body)
+
+    def test_subunit_no_test_output(self):
+        (status, headers, body) = self.request(self.uri + "/+subunit")
+        self.assertEquals("200 OK", status)
+        self.assertEquals("There was no test output", body)
+
+    def test_stderr_missing(self):
+        (status, headers, body) = self.request(self.uri + "/+stderr")
+        self.assertEquals("200 OK", status)
+        self.assertEquals("", body)
+
+    def test_plain(self):
+        self.write_log("Linux charis\n<b>CFLAGS=-O2</b>\n")
+        (status, headers, body) = self.request(self.uri + "/+plain")
+        self.assertEquals("200 OK", status)
+        self.assertIn("<div id=\"buildLog\"><pre>Linux charis\n"
+            "&lt;b&gt;CFLAGS=-O2&lt;/b&gt;\n \n </pre></div>", body)
+        self.assertIn("<h2>No error log available</h2>", body)
+
+    def test_enhanced(self):
+        (status, headers, body) = self.request(self.uri)
+        self.assertEquals("200 OK", status)
+        self.assertIn("<h2>Build log:</h2>", body)
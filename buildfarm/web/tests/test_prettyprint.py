@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# Copyright (C) Jelmer Vernooij <jelmer@samba.org> 2010
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+from buildfarm.web import (
+    FailedBuildSearch,
+    LogPrettyPrinter,
+    keyword_pattern,
+    print_log_pretty,
+    )
+
+import cgi
+import os
+import testtools
+
+
+GOLDEN_DIR = os.path.join(os.path.dirname(__file__), "prettyprint")
+
+
+def read_golden(name):
+    f = open(os.path.join(GOLDEN_DIR, name), 'r')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+class GoldenOutputTests(testtools.TestCase):
+    """Compare the pretty-printed logs in prettyprint/ with the HTML that the
+    regular expression based pretty printer generated for them."""
+
+    def assertGolden(self, name):
+        (passed, failed) = print_log_pretty(cgi.escape(read_golden(name + ".log")))
+        self.assertEquals(read_golden(name + ".passed.html"), passed)
+        self.assertEquals(read_golden(name + ".failed.html"), failed)
+
+    def assertGoldenErrors(self, name):
+        (passed, failed) = print_log_pretty(cgi.escape(read_golden(name + ".log")))
+        self.assertEquals(read_golden(name + ".errors.html"),
+            FailedBuildSearch().find_errors(failed))
+
+    def test_samba_passed(self):
+        self.assertGolden("samba-passed")
+
+    def test_samba_failed(self):
+        self.assertGolden("samba-failed")
+
+    def test_samba_failed_errors(self):
+        self.assertGoldenErrors("samba-failed")
+
+    def test_test_killed(self):
+        self.assertGolden("test-killed")
+
+    def test_plain(self):
+        self.assertGolden("plain")
+
+    def test_odd(self):
+        self.assertGolden("odd")
+
+
+class LogPrettyPrinterTests(testtools.TestCase):
+
+    def test_empty(self):
+        (passed, failed) = print_log_pretty("")
+        self.assertEquals("", failed)
+        self.assertTrue(passed.startswith("<div class='action unit passed' id='action-1'>"))
+
+    def test_split_actions(self):
+        printer = LogPrettyPrinter()
+        self.assertEquals((["foo", "a ", "", "Running action test", "bar"], [
+            ("build", "FAILED", ["Running action build", "x", "ACTION FAILED: build"])]),
+            printer._split_actions(["foo", "a Running action build", "x",
+                "ACTION FAILED: build", "", "Running action test", "bar"]))
+
+    def test_unterminated_testsuite(self):
+        printer = LogPrettyPrinter()
+        testsuites = []
+        self.assertEquals(["", "testsuite: b", "x"],
+            list(printer._scan_testsuites(["testsuite: a", "testsuite-failure: a [",
+                "testsuite: b", "x"], testsuites)))
+        self.assertEquals([("a", [], "failure", None)], testsuites)
+
+    def test_reason(self):
+        printer = LogPrettyPrinter()
+        testsuites = []
+        self.assertEquals(["", "y"],
+            list(printer._scan_testsuites(["testsuite: a", "x",
+                "testsuite-error: a [", "why", "]", "y"], testsuites)))
+        self.assertEquals([("a", ["x"], "error", "[\nwhy\n]")], testsuites)
+
+    def test_large_log(self):
+        lines = []
+        for i in range(5000):
+            lines.append("testsuite: samba4.test%d\ntest: test%d\n"
+                "testsuite-failure: samba4.test%d [\nfailed\n]\n" % (i, i, i))
+        (passed, failed) = print_log_pretty(
+            "Running action test\n%sACTION FAILED: test\n" % "".join(lines))
+        self.assertEquals(4999, failed.count("<div class='test unit failed'"))
+
+
+class KeywordPatternTests(testtools.TestCase):
+
+    def test_single(self):
+        self.assertEquals("abc", keyword_pattern(["abc"]))
+
+    def test_prefix(self):
+        self.assertEquals("ab", keyword_pattern(["ab", "abc"]))
+
+    def test_branches(self):
+        self.assertEquals("(?:a(?:b|c)|d)", keyword_pattern(["ab", "ac", "d"]))
+
+
+class FailedBuildSearchTests(testtools.TestCase):
+
+    def find_errors(self, log):
+        return FailedBuildSearch().find_errors(log)
+
+    def test_no_keywords(self):
+        self.assertEquals("foo\nbar\n", self.find_errors("foo\nbar\n"))
+
+    def test_error(self):
+        self.assertEquals("a\n<br><font color='red'><b>foo Error bar</b></font><br>\nb",
+            self.find_errors("a\nfoo Error bar\nb"))
+
+    def test_error_at_start(self):
+        self.assertEquals("<br><font color='red'><b>ERROR: foo</b></font><br>",
+            self.find_errors("ERROR: foo"))
+
+    def test_fail(self):
+        self.assertEquals("<br><font color='red'><b>it failed</b></font><br>",
+            self.find_errors("it failed"))
+
+    def test_warning(self):
+        self.assertEquals("<font color='blue'><b>x.c:1: warning: unused</b></font>\n",
+            self.find_errors("x.c:1: warning: unused\n"))
+
+    def test_success_first(self):
+        self.assertEquals("error_count: 0 failures, success",
+            self.find_errors("error_count: 0 failures, success"))
+
+    def test_html(self):
+        self.assertEquals("<div class='test'> error</div>",
+            self.find_errors("<div class='test'> error</div>"))
+
+    def test_keyword_at_start_only(self):
+        self.assertEquals("misskip\n<font color='blue'><b>skip</b></font>",
+            self.find_errors("misskip\nskip"))
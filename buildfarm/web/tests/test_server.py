@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# Copyright (C) Jelmer Vernooij <jelmer@samba.org> 2010
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+from buildfarm.web import ViewHostPage
+from buildfarm.web.server import (
+    PerThreadApp,
+    StaticFilesApp,
+    ThreadPoolWSGIServer,
+    make_server,
+    serve,
+    )
+from buildfarm.web.tests import BuildFarmAppTestCase
+
+import os
+import shutil
+import signal
+import tempfile
+import testtools
+import threading
+import urllib2
+import wsgiref.util
+
+
+def hello_app(environ, start_response):
+    start_response("200 OK", [("Content-type", "text/plain")])
+    return ["hello from %d" % os.getpid()]
+
+
+class PerThreadAppTests(testtools.TestCase):
+
+    def test_app_per_thread(self):
+        apps = []
+        def factory():
+            apps.append(object())
+            return lambda environ, start_response: apps[-1]
+        app = PerThreadApp(factory)
+        self.assertEquals([], apps)
+        first = app({}, None)
+        self.assertIs(first, app({}, None))
+        results = []
+        t = threading.Thread(target=lambda: results.append(app({}, None)))
+        t.start()
+        t.join()
+        self.assertEquals(2, len(apps))
+        self.assertIsNot(first, results[0])
+
+
+class StaticFilesAppTests(testtools.TestCase):
+
+    def setUp(self):
+        super(StaticFilesAppTests, self).setUp()
+        self.webdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.webdir)
+        f = open(os.path.join(self.webdir, "build_farm.css"), "w")
+        try:
+            f.write("body {}")
+        finally:
+            f.close()
+        self.app = StaticFilesApp(hello_app, self.webdir)
+
+    def request(self, path, **kwargs):
+        environ = {"PATH_INFO": path}
+        environ.update(kwargs)
+        wsgiref.util.setup_testing_defaults(environ)
+        response = []
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, dict(headers)]
+        body = "".join(self.app(environ, start_response))
+        return (response[0], response[1], body)
+
+    def test_static_file(self):
+        (status, headers, body) = self.request("/build_farm.css")
+        self.assertEquals("200 OK", status)
+        self.assertEquals("text/css", headers["Content-type"])
+        self.assertEquals("body {}", body)
+
+    def test_static_file_wrapper(self):
+        files = []
+        def file_wrapper(f, blksize):
+            files.append(f)
+            return wsgiref.util.FileWrapper(f, blksize)
+        (status, headers, body) = self.request("/build_farm.css",
+            **{"wsgi.file_wrapper": file_wrapper})
+        self.assertEquals("body {}", body)
+        self.assertEquals(1, len(files))
+
+    def test_other(self):
+        (status, headers, body) = self.request("/build.cgi")
+        self.assertTrue(body.startswith("hello from"))
+
+
+class ServerTests(testtools.TestCase):
+
+    def get(self, server):
+        return urllib2.urlopen("http://127.0.0.1:%d/" % server.server_port,
+            timeout=10).read()
+
+    def test_make_server_single_thread(self):
+        server = make_server("127.0.0.1", 0, hello_app)
+        self.addCleanup(server.server_close)
+        self.assertNotIsInstance(server, ThreadPoolWSGIServer)
+
+    def test_thread_pool(self):
+        server = make_server("127.0.0.1", 0, hello_app, threads=2)
+        self.addCleanup(server.server_close)
+        self.assertIsInstance(server, ThreadPoolWSGIServer)
+        self.assertEquals(2, server.threads)
+        t = threading.Thread(target=server.serve_forever, args=(0.05,))
+        t.start()
+        self.addCleanup(t.join)
+        self.addCleanup(server.shutdown)
+        self.assertEquals("hello from %d" % os.getpid(), self.get(server))
+
+    def test_serve_workers(self):
+        server = make_server("127.0.0.1", 0, hello_app, threads=2)
+        self.addCleanup(server.server_close)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # SIGINT may be ignored if the tests run in the background.
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                serve(server, workers=2)
+            finally:
+                os._exit(0)
+        try:
+            body = self.get(server)
+        finally:
+            # Interrupting the parent makes it stop its workers.
+            os.kill(pid, signal.SIGINT)
+            os.waitpid(pid, 0)
+        self.assertTrue(body.startswith("hello from "))
+        self.assertNotEquals("hello from %d" % os.getpid(), body)
+        self.assertNotEquals("hello from %d" % pid, body)
+
+
+class PersistentAppTests(BuildFarmAppTestCase):
+    """Tests for state that is kept between requests by a long-running
+    server."""
+
+    def test_dead_hosts_per_request(self):
+        self.buildfarm.hostdb.createhost("dead", platform=u"Debian")
+        self.patch(self.buildfarm, "host_last_build", lambda host: 0)
+        page = ViewHostPage(self.buildfarm)
+        self.assertIn("Dead Hosts:", "".join(page.render_html("/", "dead")))
+        self.assertNotIn("Dead Hosts:", "".join(page.render_html("/", "charis")))
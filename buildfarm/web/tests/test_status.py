@@ -15,8 +15,8 @@
 #   along with this program; if not, write to the Free Software
 #   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
-from buildfarm.build import BuildStatus
-from buildfarm.web import html_build_status
+from buildfarm.build import BuildStatus, TestResultsDiff
+from buildfarm.web import html_build_status, render_test_results_diff
 
 import testtools
 
@@ -37,3 +37,17 @@ class BuildStatusHtmlTests(testtools.TestCase):
         self.assertEquals(
             '<span class="status passed">ok</span>/<span class="status failed">4</span>'
             '(<span class="status failed">timeout</span>)', html_build_status(status))
+
+
+class TestResultsDiffTextTests(testtools.TestCase):
+
+    def test_no_changes(self):
+        self.assertEquals("No changes in test results.\n",
+            "".join(render_test_results_diff(TestResultsDiff({"a": 0}, {"a": 0}))))
+
+    def test_changes(self):
+        self.assertEquals(
+            "Newly failing tests (1):\n  a\n\n"
+            "Tests no longer run (2):\n  b\n  c\n\n",
+            "".join(render_test_results_diff(
+                TestResultsDiff({"a": 0, "b": 0, "c": 1}, {"a": 1}))))
@@ -26,7 +26,7 @@ parser.add_option("--last", help="Print last builds.", action="store_true")
 
 (opts, args) = parser.parse_args()
 
-buildfarm = BuildFarm()
+buildfarm = BuildFarm(upgrade=False)
 
 if opts.tree:
     builds = buildfarm.get_tree_builds(opts.tree)
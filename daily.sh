@@ -6,7 +6,7 @@ set -x
 (
 date
 set -x
-sqlite3 `dirname $0`/db/hostdb.sqlite 'VACUUM;'
+sqlite3 `dirname $0`/db/hostdb.sqlite 'VACUUM; PRAGMA wal_checkpoint(TRUNCATE);'
 cd `dirname $0` && ./mail-dead-hosts.py
 
 echo "deleting old file that are not used any more"
@@ -15,9 +15,18 @@ find `dirname $0`/data/oldrevs -type f -mtime +10 -links 1 -print0 | xargs -i -0
 echo "deleting any really old data"
 find `dirname $0`/data -type f -mtime +120  -print0 | xargs -i -0 rm -f \{\}
 
+echo "deleting empty build directories"
+find `dirname $0`/data/oldrevs -mindepth 1 -type d -empty -delete
+
+echo "delete cached analysis of removed logs"
+./prune-cache.py
+
 echo "delete old cache data"
 find `dirname $0`/cache -type f -name "build.*" -mtime +1 -print0 | xargs -i -0 rm -f \{\}
 
+echo "delete cached pages"
+find `dirname $0`/cache/pages -type f -mmin +60 -print0 | xargs -i -0 rm -f \{\}
+
 echo "delete partially uploaded files (crashed rsync)"
 find `dirname $0`/data/upload -type f -mtime +2 -name ".build.*" -print0 | xargs -i -0 rm -f \{\}
 
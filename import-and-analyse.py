@@ -31,7 +31,7 @@ parser.add_option("--verbose", help="Be verbose", action="count")
 resource.setrlimit(resource.RLIMIT_RSS, (300000, 300000))
 resource.setrlimit(resource.RLIMIT_DATA, (300000, 300000))
 
-buildfarm = BuildFarm(timeout=40.0)
+buildfarm = BuildFarm(timeout=40.0, upgrade=False)
 
 smtp = smtplib.SMTP()
 smtp.connect()
@@ -14,12 +14,19 @@ from buildfarm.build import (
     BuildDiff,
     MissingRevisionInfo,
     NoSuchBuildError,
+    previous_build,
     )
 from buildfarm import BuildFarm
+from buildfarm.importer import (
+    ImportBatch,
+    discard_fragments,
+    prepare_builds,
+    )
 from buildfarm.web import (
     build_uri,
     )
 from email.mime.text import MIMEText
+import functools
 import optparse
 import resource
 import smtplib
@@ -27,16 +34,12 @@ import smtplib
 parser = optparse.OptionParser("import-and-analyse [options]")
 parser.add_option("--dry-run", help="Will cause the script to send output to stdout instead of to sendmail.", action="store_true")
 parser.add_option("--verbose", help="Be verbose", action="count")
+parser.add_option("--jobs", help="Number of processes to use for analysing logs.", type=int, default=1)
+parser.add_option("--batch-size", help="Maximum number of builds to import per transaction.", type=int, default=20)
+parser.add_option("--batch-time", help="Maximum number of seconds to keep a transaction open.", type=float, default=10.0)
 
-(opts, args) = parser.parse_args()
-
-resource.setrlimit(resource.RLIMIT_RSS, (300000, 300000))
-resource.setrlimit(resource.RLIMIT_DATA, (300000, 300000))
-
-buildfarm = BuildFarm(timeout=40.0)
-
-smtp = smtplib.SMTP()
-smtp.connect()
+# The defaults, for when this module is imported rather than run.
+opts = parser.get_default_values()
 
 
 def broken_build_check(builds, second_build, rev):
@@ -59,40 +62,39 @@ def broken_build_check(builds, second_build, rev):
             # Perhaps this is a dry run and rev is not in the database yet so get build itself
             third_build = builds.get_latest_build(second_build.tree, second_build.host, second_build.compiler)
         else:
-            third_build = builds.get_previous_build(second_build.tree, second_build.host, second_build.compiler, rev)
+            # The earlier builds are fetched in a single query, and only
+            # read as far as the loop below needs them.
+            history = iter(builds.get_build_history(second_build.tree,
+                second_build.host, second_build.compiler, before=second_build))
+            third_build = previous_build(history, second_build)
     except NoSuchBuildError:
         #cant send a nasty mail unless there are two builds
         return None
 
     #getting the first failed build in the sequence and send the mail to the commiters and authors of that build
+    new_status = second_build.status()
     while(True):
 
-        t = buildfarm.trees[second_build.tree]
-        diff = BuildDiff(t, third_build, second_build)
+        old_status = third_build.status()
 
-        if not diff.is_regression():
+        if not new_status.regressed_since(old_status):
             #checks if the builds have regressed else breaks the loop
             if opts.verbose >= 3:
-                print "... hasn't regressed since %s: %s" % (diff.old_rev, diff.old_status)
+                print "... hasn't regressed since %s: %s" % (third_build.revision_details(), old_status)
             break
 
         count += 1
         first_build = second_build
         second_build = third_build
         third_build = None
+        new_status = old_status
 
         if opts.dry_run:
             break
 
-        try:
-            rev = second_build.revision_details()
-        except MissingRevisionInfo:
-            #no rev
-            break
-
         try:
             #gets a previous build
-            third_build = builds.get_previous_build(second_build.tree, second_build.host, second_build.compiler, rev)
+            third_build = previous_build(history, second_build)
         except NoSuchBuildError:
             break
 
@@ -177,9 +179,28 @@ The build may have been broken by one of the following commits:
 
 #variable created for testing purposes
 if __name__ == '__main__':
+    (opts, args) = parser.parse_args()
+
+    resource.setrlimit(resource.RLIMIT_RSS, (300000, 300000))
+    resource.setrlimit(resource.RLIMIT_DATA, (300000, 300000))
+
+    buildfarm = BuildFarm(timeout=40.0, upgrade=False)
+
+    smtp = smtplib.SMTP()
+    smtp.connect()
+
     builds = buildfarm.builds
-    for build in buildfarm.get_new_builds():
+    batch = ImportBatch(buildfarm, max_builds=opts.batch_size,
+        max_time=opts.batch_time)
+    new_builds = list(buildfarm.get_new_builds())
+    if opts.dry_run:
+        fragment_cache = None
+    else:
+        fragment_cache = buildfarm.fragments
+    for (build, fragments) in prepare_builds(new_builds, jobs=opts.jobs,
+            fragments=fragment_cache):
         if build in builds:
+            discard_fragments(fragments)
             continue
 
         if not opts.dry_run:
@@ -188,12 +209,14 @@ if __name__ == '__main__':
                 build = builds.upload_build(old_build)
             except MissingRevisionInfo:
                 print "No revision info in %r, skipping" % build
+                discard_fragments(fragments)
                 continue
         try:
             rev = build.revision_details()
         except MissingRevisionInfo:
             #no point in sending mail as there is no rev and this is not added to database
             print "No revision info in %r, skipping" % build
+            discard_fragments(fragments)
             continue
 
         if opts.verbose >= 2:
@@ -201,10 +224,19 @@ if __name__ == '__main__':
             print str(build.status())
 
         x = broken_build_check(builds, build, rev)
-        if x:
-            send_mail(x[0], x[1], x[2])
-        if not opts.dry_run:
-            old_build.remove()
-            buildfarm.commit()
-
-smtp.quit()
+        if opts.dry_run:
+            if x:
+                send_mail(x[0], x[1], x[2])
+        else:
+            # Only send mail once the build has been committed, so that
+            # rerunning an interrupted import doesn't send it again.
+            if x:
+                notify = functools.partial(send_mail, x[0], x[1], x[2])
+            else:
+                notify = None
+            batch.add(old_build, build, fragments, notify=notify)
+    batch.commit()
+    if opts.verbose:
+        print batch.stats()
+
+    smtp.quit()
@@ -28,7 +28,7 @@ parser = optparse.OptionParser()
 parser.add_option("--dry-run", help="Don't actually send any emails.", action="store_true")
 (opts, args) = parser.parse_args()
 
-buildfarm = BuildFarm(timeout=40.0)
+buildfarm = BuildFarm(timeout=40.0, upgrade=False)
 
 smtp = smtplib.SMTP()
 smtp.connect()
@@ -0,0 +1,35 @@
+#!/usr/bin/python
+# Samba.org buildfarm
+# Copyright (C) 2010 Jelmer Vernooij <jelmer@samba.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Remove cached log analyses and rendered logs for builds whose logs
+have been deleted."""
+
+from buildfarm import BuildFarm
+import optparse
+
+parser = optparse.OptionParser("prune-cache [options]")
+parser.add_option("--verbose", help="Be verbose", action="count")
+(opts, args) = parser.parse_args()
+
+buildfarm = BuildFarm(timeout=40.0, upgrade=False)
+
+count = buildfarm.prune_analysis_cache()
+buildfarm.commit()
+
+if opts.verbose:
+    print "Removed cached data for %d builds" % count
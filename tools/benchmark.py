@@ -0,0 +1,980 @@
+#!/usr/bin/python
+# Benchmarks for the build farm
+# Copyright (C) Jelmer Vernooij <jelmer@samba.org> 2010
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""Benchmarks for the build farm, run against a synthetic data directory.
+
+Usage: benchmark.py [options] BENCHMARK
+"""
+
+import itertools
+import optparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from buildfarm import BuildFarm
+from buildfarm.build import Build, BuildStatus, NoSuchBuildError
+from buildfarm.sqldb import StormBuild
+
+TREES = ["samba", "tdb", "talloc", "ldb"]
+COMPILERS = ["cc", "gcc"]
+
+
+def create_buildfarm(path, hosts):
+    """Create an empty build farm data directory."""
+    for subdir in ["data", "data/upload", "data/oldrevs", "db", "web", "cache"]:
+        os.mkdir(os.path.join(path, subdir))
+    f = open(os.path.join(path, "web", "trees.conf"), "w")
+    try:
+        for tree in TREES:
+            f.write("[%s]\nscm = git\nrepo = %s.git\nbranch = master\n\n" % (tree, tree))
+    finally:
+        f.close()
+    f = open(os.path.join(path, "web", "compilers.list"), "w")
+    try:
+        f.write("".join(["%s\n" % c for c in COMPILERS]))
+    finally:
+        f.close()
+    buildfarm = BuildFarm(path)
+    for host in hosts:
+        buildfarm.hostdb.createhost(host, platform=u"Linux")
+    buildfarm.commit()
+    return buildfarm
+
+
+def synthetic_log(revision, size, failed=False):
+    """Generate the contents of a build log of roughly the specified size."""
+    lines = [
+        "Linux benchhost 2.6.32 #1 SMP x86_64 GNU/Linux\n",
+        "BUILD COMMIT REVISION: %s\n" % revision,
+        "CFLAGS=-O2 -g\n",
+        "Running action configure\n",
+        "checking for gcc... yes\n",
+        "ACTION PASSED: configure\n",
+        "CONFIGURE STATUS: 0\n",
+        "Running action test\n",
+        ]
+    i = 0
+    length = sum(map(len, lines))
+    while length < size:
+        if failed and i % 50 == 0:
+            test = ("testsuite: samba4.test%d\ntest: test%d\n"
+                    "failure: test%d [\nassertion failed\n]\n"
+                    "testsuite-failure: samba4.test%d\n" % (i, i, i, i))
+        else:
+            test = ("testsuite: samba4.test%d\ntest: test%d\n"
+                    "success: test%d\ntestsuite-success: samba4.test%d\n" % (i, i, i, i))
+        lines.append(test)
+        length += len(test)
+        i += 1
+    lines.append("ACTION %s: test\n" % (failed and "FAILED" or "PASSED"))
+    lines.append("TEST STATUS: %d\n" % (failed and 1 or 0))
+    return "".join(lines)
+
+
+def write_upload(path, tree, host, compiler, contents):
+    basename = os.path.join(path, "data", "upload",
+        "build.%s.%s.%s" % (tree, host, compiler))
+    f = open(basename + ".log", "w")
+    try:
+        f.write(contents)
+    finally:
+        f.close()
+    return Build(basename, tree, host, compiler)
+
+
+def populate_uploads(path, count, size):
+    hosts = ["host%d" % i for i in range(count / (len(TREES) * len(COMPILERS)) + 1)]
+    buildfarm = create_buildfarm(path, hosts)
+    n = 0
+    for host in hosts:
+        for tree in TREES:
+            for compiler in COMPILERS:
+                if n == count:
+                    return buildfarm
+                write_upload(path, tree, host, compiler,
+                    synthetic_log("%040x" % n, size, failed=(n % 3 == 0)))
+                n += 1
+    return buildfarm
+
+
+def import_uploads(buildfarm, jobs=1, batch_size=1):
+    """Import all uploaded builds.
+
+    :return: The `ImportBatch` used
+    """
+    from buildfarm.importer import ImportBatch, prepare_builds
+    batch = ImportBatch(buildfarm, max_builds=batch_size)
+    new_builds = list(buildfarm.get_new_builds())
+    for (build, fragments) in prepare_builds(new_builds, jobs=jobs,
+            fragments=buildfarm.fragments):
+        batch.add(build, buildfarm.builds.upload_build(build), fragments)
+    batch.commit()
+    return batch
+
+
+def bench_import(opts):
+    """Import uploaded builds serially and using a process pool."""
+
+    def run(jobs):
+        path = tempfile.mkdtemp()
+        try:
+            buildfarm = populate_uploads(path, opts.builds, opts.size * 1024)
+            start = time.time()
+            import_uploads(buildfarm, jobs, opts.batch_size)
+            return time.time() - start
+        finally:
+            shutil.rmtree(path)
+
+    print "Importing %d builds of %dkB" % (opts.builds, opts.size)
+    serial = run(1)
+    print "serial:      %6.2fs (%6.1f builds/s)" % (serial, opts.builds / serial)
+    parallel = run(opts.jobs)
+    print "%2d jobs:     %6.2fs (%6.1f builds/s)" % (opts.jobs, parallel, opts.builds / parallel)
+
+
+def bench_commit(opts):
+    """Import with a commit per build and with batched commits, while
+    a reader queries the summary."""
+    import threading
+
+    def run(batch_size):
+        path = tempfile.mkdtemp()
+        try:
+            buildfarm = populate_uploads(path, opts.builds, opts.size * 1024)
+            done = threading.Event()
+            waits = []
+
+            def reader():
+                reader_buildfarm = BuildFarm(path, timeout=40.0)
+                while not done.isSet():
+                    start = time.time()
+                    list(reader_buildfarm.get_summary_builds())
+                    reader_buildfarm.store.rollback()
+                    waits.append(time.time() - start)
+                    time.sleep(0.01)
+
+            t = threading.Thread(target=reader)
+            t.start()
+            try:
+                batch = import_uploads(buildfarm, batch_size=batch_size)
+            finally:
+                done.set()
+                t.join()
+            print "batch size %3d: %s" % (batch_size, batch.stats())
+            print "                reader: %d queries, max %.3fs, mean %.3fs" % (
+                len(waits), max(waits), sum(waits) / len(waits))
+        finally:
+            shutil.rmtree(path)
+
+    print "Importing %d builds of %dkB" % (opts.builds, opts.size)
+    run(1)
+    run(opts.batch_size)
+
+
+def populate_builds(buildfarm, count, hosts):
+    """Insert synthetic rows into the build table."""
+    from buildfarm.sqldb import populate_latest_build
+    statuses = [
+        BuildStatus([("CONFIGURE", 0), ("BUILD", 0), ("INSTALL", 0), ("TEST", 0)]),
+        BuildStatus([("CONFIGURE", 0), ("BUILD", 0), ("INSTALL", 0), ("TEST", 0)]),
+        BuildStatus([("CONFIGURE", 0), ("BUILD", 0), ("INSTALL", 0), ("TEST", 0)]),
+        BuildStatus([("CONFIGURE", 0), ("BUILD", 0), ("INSTALL", 0), ("TEST", 3)]),
+        BuildStatus([("CONFIGURE", 0), ("BUILD", 1)], set(["panic"])),
+        ]
+    host_ids = dict([(host.name, host.id) for host in buildfarm.hostdb.hosts()])
+    now = int(time.time())
+
+    def rows():
+        for i in xrange(count):
+            tree = TREES[i % len(TREES)]
+            host = hosts[(i / len(TREES)) % len(hosts)]
+            compiler = COMPILERS[(i / (len(TREES) * len(hosts))) % len(COMPILERS)]
+            revision = "%040x" % (i / 100)
+            status = statuses[(i / 7) % len(statuses)]
+            yield (buffer(tree), buffer(revision), buffer(host), host_ids[host],
+                   buffer(compiler), buffer("%040x" % i), now - count + i,
+                   buffer(status.__serialize__())) + status.summary_columns() + (
+                   buffer("data/oldrevs/build.%s.%s.%s-%s" % (tree, host, compiler, revision)), )
+
+    # Bypass Storm, which would create an object for every row.
+    cursor = buildfarm._get_store()._connection._raw_connection.cursor()
+    cursor.executemany("INSERT INTO build (tree, revision, host, host_id, "
+        "compiler, checksum, age, status, failed, panic, timeout, disk_full, "
+        "worst_stage, basename) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        rows())
+    populate_latest_build(buildfarm._get_store())
+    buildfarm.commit()
+
+
+def time_queries(buildfarm, hosts, repeat=3):
+    """Time each of the BuildFarm queries.
+
+    :return: list of (name, seconds) tuples, with the best time of each query
+    """
+    tree = TREES[0]
+    host = hosts[len(hosts) / 2]
+    compiler = COMPILERS[0]
+    latest = buildfarm.builds.get_latest_build(tree, host, compiler)
+    queries = [
+        ("get_build", lambda: buildfarm.builds.get_build(tree, host, compiler, latest.revision)),
+        ("get_by_checksum", lambda: buildfarm.builds.get_by_checksum(latest.checksum)),
+        ("get_latest_build", lambda: buildfarm.builds.get_latest_build(tree, host, compiler)),
+        ("get_previous_build", lambda: buildfarm.builds.get_previous_build(tree, host, compiler, latest.revision)),
+        ("get_old_builds[:20]", lambda: list(itertools.islice(buildfarm.builds.get_old_builds(tree, host, compiler), 20))),
+        ("get_host_builds", lambda: list(buildfarm.get_host_builds(host))),
+        ("get_tree_builds[:20]", lambda: list(itertools.islice(buildfarm.get_tree_builds(tree), 20))),
+        ("get_revision_builds", lambda: list(buildfarm.get_revision_builds(tree, latest.revision))),
+        ("get_summary_builds", lambda: list(buildfarm.get_summary_builds())),
+        ("dead_hosts", lambda: list(buildfarm.hostdb.dead_hosts(60 * 60))),
+        ("host_ages", lambda: list(buildfarm.hostdb.host_ages())),
+        ]
+    ret = []
+    for (name, fn) in queries:
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            fn()
+            times.append(time.time() - start)
+            buildfarm.store.rollback()
+        ret.append((name, min(times)))
+    return ret
+
+
+def bench_queries(opts):
+    """Time the BuildFarm queries on a large build table, before and after
+    the build indexes were added."""
+    from buildfarm.sqldb import SCHEMA_UPGRADES, add_build_indexes, upgrade_schema
+    path = tempfile.mkdtemp()
+    try:
+        hosts = ["host%d" % i for i in range(opts.hosts)]
+        buildfarm = create_buildfarm(path, hosts)
+        store = buildfarm._get_store()
+        store.execute("DROP INDEX build_tree_host_compiler_age")
+        store.execute("DROP INDEX build_host_age")
+        store.execute("PRAGMA user_version = %d" % SCHEMA_UPGRADES.index(add_build_indexes))
+        start = time.time()
+        populate_builds(buildfarm, opts.rows, hosts)
+        print "Inserted %d builds for %d hosts in %.1fs" % (
+            opts.rows, len(hosts), time.time() - start)
+        before = time_queries(buildfarm, hosts)
+        start = time.time()
+        upgrade_schema(store)
+        buildfarm.commit()
+        print "Upgraded schema in %.1fs" % (time.time() - start)
+        after = time_queries(buildfarm, hosts)
+        print "%-22s %10s %10s" % ("query", "before", "after")
+        for ((name, t1), (_, t2)) in zip(before, after):
+            print "%-22s %9.4fs %9.4fs" % (name, t1, t2)
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_regressions(opts):
+    """Find the first build in a long run of regressions, one build at a time
+    as broken_build_check used to, and by scanning the build history."""
+    from storm.tracer import install_tracer, remove_tracer
+    from buildfarm.build import previous_build
+
+    class QueryCounter(object):
+
+        queries = 0
+
+        def connection_raw_execute(self, connection, raw_cursor, statement,
+                                   params):
+            self.queries += 1
+
+    def walk_builds(builds, build):
+        # The loop used by broken_build_check before it scanned the history.
+        count = 1
+        prev = builds.get_previous_build(build.tree, build.host, build.compiler,
+            build.revision)
+        while build.status().regressed_since(prev.status()):
+            count += 1
+            build = prev
+            try:
+                prev = builds.get_previous_build(build.tree, build.host,
+                    build.compiler, build.revision_details())
+            except NoSuchBuildError:
+                break
+        return count
+
+    def scan_history(builds, build):
+        count = 1
+        history = iter(builds.get_build_history(build.tree, build.host,
+            build.compiler, before=build))
+        prev = previous_build(history, build)
+        new_status = build.status()
+        while True:
+            old_status = prev.status()
+            if not new_status.regressed_since(old_status):
+                break
+            count += 1
+            build = prev
+            new_status = old_status
+            try:
+                prev = previous_build(history, build)
+            except NoSuchBuildError:
+                break
+        return count
+
+    path = tempfile.mkdtemp()
+    try:
+        hosts = ["host%d" % i for i in range(opts.hosts)]
+        buildfarm = create_buildfarm(path, hosts)
+        populate_builds(buildfarm, opts.rows, hosts)
+        (tree, host, compiler) = (TREES[0], hosts[0], COMPILERS[0])
+        print "%-9s %-8s %10s %10s" % ("regressed", "method", "queries", "time")
+        for run in (10, 100, 1000):
+            # Append a run of builds that each fail one more test.
+            host_id = buildfarm.hostdb[host].id
+            cursor = buildfarm._get_store()._connection._raw_connection.cursor()
+            for i in range(run):
+                revision = "run%d-%d" % (run, i)
+                status = BuildStatus([("CONFIGURE", 0), ("TEST", 10 + i)])
+                cursor.execute("INSERT INTO build (tree, revision, host, "
+                    "host_id, compiler, checksum, age, status, failed, panic, "
+                    "timeout, disk_full, worst_stage, basename) VALUES (?, ?, "
+                    "?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (buffer(tree),
+                    buffer(revision), buffer(host), host_id, buffer(compiler),
+                    buffer(revision), int(time.time()),
+                    buffer(status.__serialize__())) + status.summary_columns() + (
+                    buffer("data/oldrevs/%s" % revision), ))
+            buildfarm.commit()
+            latest = buildfarm.builds.get_latest_build(tree, host, compiler)
+            for (name, fn) in (("walk", walk_builds), ("scan", scan_history)):
+                counter = QueryCounter()
+                install_tracer(counter)
+                start = time.time()
+                count = fn(buildfarm.builds, latest)
+                duration = time.time() - start
+                remove_tracer(counter)
+                buildfarm.rollback()
+                print "%-9d %-8s %10d %9.3fs" % (count - 1, name,
+                    counter.queries, duration)
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_status(opts):
+    """Decode serialized build statuses, in the old repr() based format and
+    in the current format."""
+    import buildfarm.build as build_module
+    statuses = []
+    for i in xrange(opts.statuses):
+        stages = [("CONFIGURE", 0), ("BUILD", i % 7 == 0 and 2 or 0),
+                  ("INSTALL", 0), ("TEST", i % 5), ("CC_CHECKER", 0)]
+        other_failures = set()
+        if i % 13 == 0:
+            other_failures.add("panic")
+        statuses.append(BuildStatus(stages[:2 + i % 4], other_failures))
+    old = [repr(status) for status in statuses]
+    new = [status.__serialize__() for status in statuses]
+    print "Decoding %d statuses (%d bytes old format, %d bytes new format)" % (
+        len(statuses), sum(map(len, old)), sum(map(len, new)))
+    for (name, fn, texts) in [
+            ("eval", lambda text: eval(text, vars(build_module)), old),
+            ("old format", BuildStatus.__deserialize__, old),
+            ("new format", BuildStatus.__deserialize__, new)]:
+        start = time.time()
+        for text in texts:
+            fn(text)
+        duration = time.time() - start
+        print "%-12s %6.2fs (%5.2f us/status)" % (name, duration,
+            duration * 1000000 / len(texts))
+
+
+def bench_pages(opts):
+    """Render the summary and failed builds pages, and compare with
+    decoding the build statuses in Python."""
+    from buildfarm.web import FailedBuildsPage, ViewSummaryPage
+
+    def summary_counts_python():
+        # What ViewSummaryPage did before the status columns existed.
+        host_count = {}
+        broken_count = {}
+        for (tree, status) in buildfarm.get_summary_builds(
+                min_age=time.time() - buildfarm.DEADAGE):
+            host_count[tree] = host_count.get(tree, 0) + 1
+            if status.failed:
+                broken_count[tree] = broken_count.get(tree, 0) + 1
+
+    def failed_builds_python():
+        # What FailedBuildsPage did before the status columns existed.
+        found = 0
+        for build in buildfarm.latest_tree_builds(TREES[0])[:100]:
+            if build.status().failed:
+                found += 1
+                if found == 15:
+                    break
+
+    path = tempfile.mkdtemp()
+    try:
+        hosts = ["host%d" % i for i in range(opts.hosts)]
+        buildfarm = create_buildfarm(path, hosts)
+        start = time.time()
+        populate_builds(buildfarm, opts.rows, hosts)
+        print "Inserted %d builds for %d hosts in %.1fs" % (
+            opts.rows, len(hosts), time.time() - start)
+        pages = [
+            ("summary (python)", summary_counts_python),
+            ("summary", lambda: "".join(ViewSummaryPage(buildfarm).render_text("myself"))),
+            ("failed (python)", failed_builds_python),
+            ("failed", lambda: "".join(FailedBuildsPage(buildfarm).render_html("myself", TREES[0]))),
+            ]
+        for (name, fn) in pages:
+            times = []
+            for i in range(3):
+                start = time.time()
+                fn()
+                times.append(time.time() - start)
+                buildfarm.store.rollback()
+            print "%-18s %9.4fs" % (name, min(times))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_tests(opts):
+    """Store test results for many builds and query the per-test history."""
+    path = tempfile.mkdtemp()
+    try:
+        hosts = ["host%d" % i for i in range(opts.hosts)]
+        buildfarm = create_buildfarm(path, hosts)
+        populate_builds(buildfarm, opts.rows, hosts)
+        store = buildfarm._get_store()
+        build_ids = [id for (id, ) in store.execute("SELECT id FROM build ORDER BY id")]
+        start = time.time()
+        for (i, build_id) in enumerate(build_ids):
+            results = []
+            for j in range(opts.tests):
+                if j % 10 == 0 and (i / 3 + j) % 7 == 0:
+                    result = 1
+                else:
+                    result = 0
+                results.append(("samba4.test%d" % j, result))
+            build = store.get(StormBuild, build_id)
+            buildfarm.builds.add_test_results(build, results)
+            if i % 1000 == 0:
+                buildfarm.commit()
+        buildfarm.commit()
+        duration = time.time() - start
+        print "Stored %d test results in %.1fs (%.0f results/s)" % (
+            len(build_ids) * opts.tests, duration,
+            len(build_ids) * opts.tests / duration)
+        queries = [
+            ("get_test_results", lambda: buildfarm.get_test_results("samba4.test10")),
+            ("get_flaky_tests (1 day)", lambda: list(buildfarm.get_flaky_tests(
+                TREES[0], time.time() - 24 * 60 * 60))),
+            ("get_flaky_tests (all)", lambda: list(buildfarm.get_flaky_tests(TREES[0]))),
+            ]
+        for (name, fn) in queries:
+            times = []
+            for i in range(3):
+                start = time.time()
+                fn()
+                times.append(time.time() - start)
+                buildfarm.store.rollback()
+            print "%-24s %9.4fs" % (name, min(times))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_concurrency(opts):
+    """Render the summary and host pages while the importer and the daily
+    VACUUM are running, with a rollback journal and in WAL mode."""
+    import multiprocessing
+    import sqlite3
+    import threading
+    from buildfarm.web import ViewHostPage, ViewSummaryPage
+    from storm.exceptions import OperationalError
+
+    class RollbackJournalBuildFarm(BuildFarm):
+        JOURNAL_MODE = "DELETE"
+        SYNCHRONOUS = "FULL"
+
+    def importer(cls, path):
+        import_uploads(cls(path, timeout=40.0), batch_size=opts.batch_size)
+        # Like daily.sh
+        conn = sqlite3.connect(os.path.join(path, "db", "hostdb.sqlite"),
+            timeout=40.0)
+        try:
+            conn.execute("VACUUM")
+        except sqlite3.OperationalError, e:
+            print "%s: VACUUM failed: %s" % (cls.JOURNAL_MODE, e)
+        conn.close()
+
+    def run(cls, readonly):
+        path = tempfile.mkdtemp()
+        try:
+            buildfarm = populate_uploads(path, opts.builds, opts.size * 1024)
+            hosts = [host.name for host in buildfarm.hostdb.hosts()]
+            populate_builds(buildfarm, opts.rows, hosts)
+            buildfarm.store.close()
+            pages = {
+                "summary": lambda bf: "".join(ViewSummaryPage(bf).render_html("myself")),
+                "host": lambda bf: "".join(ViewHostPage(bf).render_html("myself", hosts[0])),
+                }
+            stats = dict([(name, []) for name in pages])
+            errors = dict([(name, 0) for name in pages])
+            p = multiprocessing.Process(target=importer, args=(cls, path))
+
+            def reader(name):
+                while p.is_alive():
+                    start = time.time()
+                    try:
+                        # Like the CGI script: a new connection per request.
+                        reader_buildfarm = cls(path, readonly=readonly)
+                        pages[name](reader_buildfarm)
+                        reader_buildfarm.store.close()
+                    except OperationalError:
+                        errors[name] += 1
+                    else:
+                        stats[name].append(time.time() - start)
+
+            start = time.time()
+            p.start()
+            threads = [threading.Thread(target=reader, args=(name, )) for name in pages]
+            for t in threads:
+                t.start()
+            p.join()
+            for t in threads:
+                t.join()
+            print "%s: import and vacuum took %.1fs" % (cls.JOURNAL_MODE, time.time() - start)
+            for name in sorted(pages):
+                times = stats[name] or [0]
+                print "  %-8s %4d pages, %3d errors, max %.3fs, mean %.3fs" % (
+                    name, len(stats[name]), errors[name], max(times),
+                    sum(times) / len(times))
+        finally:
+            shutil.rmtree(path)
+
+    print "Importing %d builds of %dkB into %d existing builds" % (
+        opts.builds, opts.size, opts.rows)
+    run(RollbackJournalBuildFarm, readonly=False)
+    run(BuildFarm, readonly=True)
+
+
+CGI_SCRIPT = """
+import sys, wsgiref.handlers
+sys.path.insert(0, %(root)r)
+from buildfarm import BuildFarm
+from buildfarm.web import BuildFarmApp
+wsgiref.handlers.CGIHandler().run(BuildFarmApp(BuildFarm(%(path)r, readonly=True)))
+"""
+
+
+STREAM_SCRIPT = """
+import resource, sys, wsgiref.util
+sys.path.insert(0, %(root)r)
+from buildfarm import BuildFarm
+from buildfarm.web import BuildFarmApp
+app = BuildFarmApp(BuildFarm(%(path)r, readonly=True))
+environ = {"PATH_INFO": %(path_info)r, "QUERY_STRING": ""}
+wsgiref.util.setup_testing_defaults(environ)
+size = 0
+for chunk in app(environ, lambda status, headers: None):
+    size += len(chunk)
+print size, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+"""
+
+
+def bench_stream(opts):
+    """Measure the peak memory use of serving compressed build logs of
+    increasing size."""
+    import bz2
+    import subprocess
+    from buildfarm.importer import ImportBatch
+
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    print "%8s %-8s %10s %10s" % ("log", "view", "bytes", "max RSS")
+    for size in (1, opts.size / 4, opts.size):
+        path = tempfile.mkdtemp()
+        try:
+            buildfarm = populate_uploads(path, 1, 1024)
+            batch = ImportBatch(buildfarm)
+            for upload_build in buildfarm.get_new_builds():
+                build = buildfarm.builds.upload_build(upload_build)
+                batch.add(upload_build, build)
+            batch.commit()
+            # Analysing a large log takes a long time, so replace the log
+            # after importing it.
+            os.remove(build.basename + ".log")
+            f = bz2.BZ2File(build.basename + ".log.bz2", 'w')
+            try:
+                f.write(synthetic_log(build.revision, size * 1024))
+            finally:
+                f.close()
+            for view in ("+stdout", "+plain"):
+                script = STREAM_SCRIPT % {"root": root, "path": path,
+                    "path_info": "/build/%s/%s" % (build.log_checksum(), view)}
+                output = subprocess.Popen([sys.executable, "-c", script],
+                    stdout=subprocess.PIPE).communicate()[0]
+                (length, maxrss) = map(int, output.split())
+                print "%6dkB %-8s %10d %8dkB" % (size, view, length, maxrss)
+        finally:
+            shutil.rmtree(path)
+
+
+def bench_download(opts):
+    """Measure the bytes sent and the CPU time used for downloading a
+    compressed build log in full, gzip-encoded and as a tail range."""
+    import bz2
+    import resource
+    import wsgiref.util
+    from buildfarm.importer import ImportBatch
+    from buildfarm.web import BuildFarmApp
+
+    def cpu_time():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    path = tempfile.mkdtemp()
+    try:
+        buildfarm = populate_uploads(path, 1, 1024)
+        batch = ImportBatch(buildfarm)
+        for upload_build in buildfarm.get_new_builds():
+            build = buildfarm.builds.upload_build(upload_build)
+            batch.add(upload_build, build)
+        batch.commit()
+        os.remove(build.basename + ".log")
+        f = bz2.BZ2File(build.basename + ".log.bz2", 'w')
+        try:
+            f.write(synthetic_log(build.revision, opts.size * 1024))
+        finally:
+            f.close()
+        app = BuildFarmApp(BuildFarm(path, readonly=True))
+        requests = [
+            ("identity", {}),
+            ("gzip (first)", {"HTTP_ACCEPT_ENCODING": "gzip"}),
+            ("gzip", {"HTTP_ACCEPT_ENCODING": "gzip"}),
+            ("tail 64kB", {"HTTP_RANGE": "bytes=-65536"}),
+            ]
+        print "Downloading a %dkB log" % opts.size
+        for (name, headers) in requests:
+            environ = {"PATH_INFO": "/build/%s/+stdout" % build.log_checksum(),
+                       "QUERY_STRING": ""}
+            environ.update(headers)
+            wsgiref.util.setup_testing_defaults(environ)
+            start = cpu_time()
+            sent = sum(map(len, app(environ, lambda status, headers: None)))
+            print "%-14s %10d bytes %8.3fs CPU" % (name, sent, cpu_time() - start)
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_prettyprint(opts):
+    """Measure the time taken to pretty-print build logs of 1, 10 and 50MB."""
+    import cgi
+    from buildfarm.web import print_log_pretty
+
+    print "%8s %10s %10s" % ("log", "time", "MB/s")
+    for size in (1, 10, 50):
+        log = cgi.escape(synthetic_log("12", size * 1024 * 1024, failed=True))
+        start = time.time()
+        print_log_pretty(log)
+        duration = time.time() - start
+        print "%6dMB %9.2fs %10.1f" % (size, duration, size / duration)
+
+
+def bench_highlight(opts):
+    """Compare the time taken to highlight errors in the failed part of
+    build logs with the single regular expression used previously."""
+    import cgi
+    from buildfarm.web import FailedBuildSearch, print_log_pretty
+
+    class RegexFailedBuildSearch(FailedBuildSearch):
+
+        def highlight_errors(self, m):
+            if m.group(9) or m.group(12):
+                return "<br><font color='red'><b>" + m.group() + "</b></font><br>"
+            elif m.group(15):
+                return "<font color='blue'><b>" + m.group() + "</b></font>"
+            else:
+                return m.group()
+
+        def find_errors(self, highlightedlog):
+            return re.sub("""(^.*<.?div.*$)|((^.*error_.*$)|(^.*failed_.*$)|(^pass.*$)|(^.* pass.*$)|(^.*success.*$)|(^.*copyright.*$))|((^.* error.*$)|(^error.*$))|((^.* fail.*$)|(^fail.*$))|((^.*warning.*$)|(^none.*$)|(^.* skip.*$)|(^skip.*$)|(^.* unknown.*$)|(^.* no .*$)|(^.* not .*$)|(^.*severe.*$)|(^.* fault.*$)|(^.* invalid.*$)|(^.* incorrect.*$)|(^.*unable .*$)|(^.*cannot .*$)|(^.*conflict.*$)|(^.* corrupt.*$)|(^.* missing.*$)|(^.*abort.*$)|(^.*denied.*$)|(^.* terminate.*$)|(^.*overflow.*$)|(^.* wrong .*$)|(^.*forbidden.*$)|(^.*disabled.*$)|(^.*disconnect.*$)|(^.*unavailable.*$)|(^.*undefined.*$)|(^.* unresolved.*$)|(^.*problem.*$)|(^.*exception.*$))""", self.highlight_errors, highlightedlog, 0, re.M|re.I)
+
+    print "%8s %10s %10s %10s" % ("log", "regex", "keywords", "identical")
+    for size in (1, 10, 50):
+        log = cgi.escape(synthetic_log("12", size * 1024 * 1024, failed=True))
+        failed = print_log_pretty(log)[1]
+        del log
+        times = []
+        outputs = []
+        for search in (RegexFailedBuildSearch(), FailedBuildSearch()):
+            start = time.time()
+            outputs.append(search.find_errors(failed))
+            times.append(time.time() - start)
+        print "%6dMB %9.2fs %9.2fs %10s" % (size, times[0], times[1],
+            outputs[0] == outputs[1])
+
+
+def bench_history(opts):
+    """Time the recent checkins queries on a long history, by walking the
+    repository and using the commit index."""
+    from dulwich.objects import Commit, Tree
+    from dulwich.repo import Repo
+    from buildfarm.history import GitBranch
+
+    path = tempfile.mkdtemp()
+    try:
+        repo = Repo.init(os.path.join(path, "repo"), mkdir=True)
+        tree = Tree()
+        repo.object_store.add_object(tree)
+
+        def add_commits(count, parent, start=0):
+            commits = []
+            for i in range(count):
+                c = Commit()
+                c.tree = tree.id
+                c.parents = [parent] if parent else []
+                c.author = c.committer = "Author %d <author%d@example.com>" % (
+                    i % 50, i % 50)
+                c.commit_time = c.author_time = 1300000000 + (start + i) * 60
+                c.commit_timezone = c.author_timezone = 0
+                c.message = "Commit %d\n" % i
+                commits.append((c, None))
+                parent = c.id
+            repo.object_store.add_objects(commits)
+            repo.refs["refs/heads/master"] = parent
+            return parent
+
+        head = add_commits(opts.commits, None)
+        walked = GitBranch(repo.path)
+        indexed = GitBranch(repo.path, index_path=os.path.join(path,
+            "history", "repo.sqlite"))
+
+        start = time.time()
+        indexed.index.update(repo, "master")
+        print "initial index of %d commits: %.2fs" % (opts.commits,
+            time.time() - start)
+        add_commits(10, head, opts.commits)
+        start = time.time()
+        indexed.index.update(indexed.repo, "master")
+        print "update with 10 new commits: %.3fs" % (time.time() - start)
+
+        print "%-24s %10s %10s" % ("query", "walk", "index")
+        queries = [
+            ("first page", dict(limit=11)),
+            ("page 100", dict(limit=11, offset=1000)),
+            ("author, page 10", dict(limit=11, offset=100,
+                author="author7@example.com")),
+            ]
+        for (name, kwargs) in queries:
+            times = []
+            for branch in (walked, indexed):
+                start = time.time()
+                list(branch.log(**kwargs))
+                times.append(time.time() - start)
+            print "%-24s %9.3fs %9.3fs" % (name, times[0], times[1])
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_diffs(opts):
+    """Time rendering the changes and highlighted diffs of commits, with an
+    empty and with a warm commit cache."""
+    from dulwich.objects import Blob, Commit, Tree
+    from dulwich.repo import Repo
+    from buildfarm.history import GitBranch
+    from buildfarm.web import DiffPage
+
+    path = tempfile.mkdtemp()
+    try:
+        repo = Repo.init(os.path.join(path, "repo"), mkdir=True)
+        objects = []
+        files = {}
+        parent = None
+        revisions = []
+        for i in range(20):
+            for j in range(50):
+                blob = Blob.from_string("".join(["line %d of %d.c, version %d\n" % (
+                    k, j, i if k % 10 == i % 10 else 0) for k in range(200)]))
+                objects.append((blob, None))
+                files["lib/file%d.c" % j] = blob.id
+            subtree = Tree()
+            for (name, sha) in files.iteritems():
+                subtree.add(name.split("/")[1], 0100644, sha)
+            tree = Tree()
+            tree.add("lib", 040000, subtree.id)
+            c = Commit()
+            c.tree = tree.id
+            c.parents = [parent] if parent else []
+            c.author = c.committer = "Author <author@example.com>"
+            c.commit_time = c.author_time = 1300000000 + i * 60
+            c.commit_timezone = c.author_timezone = 0
+            c.message = "Commit %d\n" % i
+            objects.extend([(subtree, None), (tree, None), (c, None)])
+            parent = c.id
+            revisions.append(c.id)
+        repo.object_store.add_objects(objects)
+        repo.refs["refs/heads/master"] = parent
+
+        page = DiffPage(None)
+        branch = GitBranch(repo.path, cache_path=os.path.join(path, "commits"))
+        print "%-8s %10s" % ("cache", "per commit")
+        for name in ("empty", "warm"):
+            start = time.time()
+            for revision in revisions[1:]:
+                branch.changes_summary(revision)
+                page.diff_html(branch, revision)
+            print "%-8s %9.4fs" % (name, (time.time() - start) / (len(revisions) - 1))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_repos(opts):
+    """Time looking up recent commits in a packed repository, opening the
+    repository for every lookup and reusing it from the repository pool."""
+    from dulwich.objects import Blob, Commit, Tree
+    from dulwich.repo import Repo
+    from buildfarm.history import GitBranch, repositories
+
+    path = tempfile.mkdtemp()
+    try:
+        repo = Repo.init(os.path.join(path, "repo"), mkdir=True)
+        objects = []
+        parent = None
+        for i in range(opts.commits):
+            blob = Blob.from_string("version %d\n" % i)
+            tree = Tree()
+            tree.add("VERSION", 0100644, blob.id)
+            c = Commit()
+            c.tree = tree.id
+            c.parents = [parent] if parent else []
+            c.author = c.committer = "Author <author@example.com>"
+            c.commit_time = c.author_time = 1300000000 + i * 60
+            c.commit_timezone = c.author_timezone = 0
+            c.message = "Commit %d\n" % i
+            objects.extend([(blob, None), (tree, None), (c, None)])
+            parent = c.id
+        repo.object_store.add_objects(objects)
+        repo.refs["refs/heads/master"] = parent
+
+        def lookup(branch):
+            for rev in branch.log(limit=10):
+                branch.changes_summary(rev.revision)
+
+        print "%-8s %10s" % ("repo", "per lookup")
+        for (name, pooled) in (("reopen", False), ("pool", True)):
+            start = time.time()
+            for i in range(opts.requests):
+                if pooled:
+                    branch = GitBranch(repo.path, repo=repositories.get(repo.path))
+                else:
+                    branch = GitBranch(repo.path)
+                lookup(branch)
+            print "%-8s %9.4fs" % (name, (time.time() - start) / opts.requests)
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_web(opts):
+    """Compare requests per second for the summary page when run as a CGI
+    script and when served by a persistent server."""
+    import subprocess
+    import threading
+    import urllib2
+    from buildfarm.web import BuildFarmApp
+    from buildfarm.web.server import PerThreadApp, make_server
+
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    path = tempfile.mkdtemp()
+    try:
+        hosts = ["host%d" % i for i in range(opts.hosts)]
+        buildfarm = create_buildfarm(path, hosts)
+        populate_builds(buildfarm, opts.rows, hosts)
+        buildfarm.commit()
+
+        script = CGI_SCRIPT % {"root": root, "path": path}
+        env = dict(os.environ, REQUEST_METHOD="GET", PATH_INFO="/",
+            QUERY_STRING="", SERVER_NAME="localhost", SERVER_PORT="80",
+            SCRIPT_NAME="/build.cgi", GATEWAY_INTERFACE="CGI/1.1")
+
+        def cgi_request():
+            p = subprocess.Popen([sys.executable, "-c", script], env=env,
+                stdout=subprocess.PIPE)
+            output = p.communicate()[0]
+            assert p.returncode == 0 and "200 OK" in output
+
+        httpd = make_server("localhost", 0, PerThreadApp(
+            lambda: BuildFarmApp(BuildFarm(path, readonly=True))),
+            threads=opts.jobs)
+        httpd.RequestHandlerClass.log_message = lambda *args: None
+        t = threading.Thread(target=httpd.serve_forever)
+        t.daemon = True
+        t.start()
+        url = "http://localhost:%d/" % httpd.server_address[1]
+
+        def server_request():
+            urllib2.urlopen(url).read()
+
+        for (name, fn) in [("cgi", cgi_request), ("server", server_request)]:
+            fn()
+            start = time.time()
+            for i in range(opts.requests):
+                fn()
+            duration = time.time() - start
+            print "%-8s %8.1f requests/s" % (name, opts.requests / duration)
+        httpd.shutdown()
+    finally:
+        shutil.rmtree(path)
+
+
+benchmarks = {
+    "commit": bench_commit,
+    "concurrency": bench_concurrency,
+    "diffs": bench_diffs,
+    "download": bench_download,
+    "highlight": bench_highlight,
+    "history": bench_history,
+    "import": bench_import,
+    "pages": bench_pages,
+    "prettyprint": bench_prettyprint,
+    "queries": bench_queries,
+    "regressions": bench_regressions,
+    "repos": bench_repos,
+    "status": bench_status,
+    "stream": bench_stream,
+    "tests": bench_tests,
+    "web": bench_web,
+    }
+
+parser = optparse.OptionParser("benchmark.py [options] %s" % "|".join(sorted(benchmarks)))
+parser.add_option("--builds", help="Number of builds to use.", type=int, default=200)
+parser.add_option("--size", help="Size of each build log, in kB.", type=int, default=256)
+parser.add_option("--jobs", help="Number of processes to use.", type=int, default=4)
+parser.add_option("--batch-size", help="Number of builds to import per transaction.", type=int, default=20)
+parser.add_option("--rows", help="Number of rows in the build table.", type=int, default=1000000)
+parser.add_option("--hosts", help="Number of hosts.", type=int, default=200)
+parser.add_option("--tests", help="Number of tests per build.", type=int, default=100)
+parser.add_option("--requests", help="Number of HTTP requests to make.", type=int, default=50)
+parser.add_option("--commits", help="Number of commits in the repository.", type=int, default=20000)
+parser.add_option("--statuses", help="Number of build statuses to decode.", type=int, default=100000)
+(opts, args) = parser.parse_args()
+
+if len(args) != 1 or args[0] not in benchmarks:
+    parser.print_usage()
+    sys.exit(1)
+
+benchmarks[args[0]](opts)
@@ -10,14 +10,17 @@ from buildfarm.build import (
     LogFileMissing,
     MissingRevisionInfo,
     NoTestOutput,
+    parse_test_results,
     revision_from_log,
     extract_test_output,
+    StormBuildAnalysis,
     )
 from buildfarm.hostdb import NoSuchHost
+from buildfarm.web import cache_build_html
 
 from buildfarm import BuildFarm, StormBuild
 
-buildfarm = BuildFarm()
+buildfarm = BuildFarm(upgrade=False)
 
 store = buildfarm._get_store()
 
@@ -36,9 +39,13 @@ for build in store.find(StormBuild, StormBuild.status_str == None):
             err.close()
     finally:
         log.close()
-    build.status_str = status.__serialize__()
+    build.set_status(status)
     print "Updating status for %r" % build
 
+for build in store.find(StormBuild, StormBuild.status_str.like("BuildStatus(%")):
+    build.set_status(build.status())
+    print "Converting status for %r" % build
+
 
 for build in store.find(StormBuild, StormBuild.revision == None):
     try:
@@ -61,5 +68,28 @@ for build in store.find(StormBuild, StormBuild.host_id == None):
     except NoSuchHost, e:
         print "Unable to find host %s" % e.name
 
+analysed = set([str(c) for (c,) in store.execute("SELECT checksum FROM build_analysis")])
+for build in store.find(StormBuild, StormBuild.basename != None):
+    if build.checksum in analysed:
+        continue
+    try:
+        analysis = build.analyse()
+    except LogFileMissing:
+        continue
+    store.add(StormBuildAnalysis.from_analysis(analysis))
+    analysed.add(analysis.checksum)
+    cache_build_html(buildfarm, build)
+    print "Caching analysis for %r" % build
+
+with_results = set([id for (id,) in store.execute("SELECT DISTINCT build FROM test_result")])
+for build in store.find(StormBuild, StormBuild.basename != None):
+    if build.id in with_results:
+        continue
+    try:
+        subunit = build.read_subunit()
+    except (LogFileMissing, NoTestOutput):
+        continue
+    buildfarm.builds.add_test_results(build, parse_test_results(subunit))
+    print "Storing test results for %r" % build
 
 buildfarm.commit()
@@ -0,0 +1,38 @@
+#!/usr/bin/python
+# Move old builds into per-tree/host directories
+# Copyright (C) Jelmer Vernooij <jelmer@samba.org> 2010
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""Migrate data/oldrevs from the flat layout to data/oldrevs/TREE/HOST/."""
+
+import optparse
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from buildfarm import BuildFarm
+
+parser = optparse.OptionParser("shard_oldrevs.py [options]")
+parser.add_option("--verbose", help="Be verbose", action="count")
+(opts, args) = parser.parse_args()
+
+buildfarm = BuildFarm(timeout=40.0, upgrade=False)
+
+count = buildfarm.builds.shard_old_builds()
+buildfarm.commit()
+
+if opts.verbose:
+    print "Moved %d files" % count
@@ -38,6 +38,6 @@ if CGI_DEBUG:
 
 from buildfarm import BuildFarm
 from buildfarm.web import BuildFarmApp
-buildfarm = BuildFarm()
+buildfarm = BuildFarm(readonly=True)
 buildApp = BuildFarmApp(buildfarm)
 handler.run(buildApp)